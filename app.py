@@ -1,13 +1,14 @@
-from flask import Flask, redirect, url_for, render_template, request, session, flash
+from flask import Flask, Response, redirect, url_for, render_template, stream_template, request, session, flash, jsonify, abort
 import os
 from datetime import timezone, timedelta
 from tardriver import TarDriver
+from tarexport import ReportExport
 import logging
 import threading
 
 
-TOKEN = #TRELLO USER TOKEN
-API_KEY = #TRELLO USER API KEY
+TOKEN = os.environ.get('TRELLO_TOKEN', '')         #TRELLO USER TOKEN
+API_KEY = os.environ.get('TRELLO_API_KEY', '')     #TRELLO USER API KEY
 
 
 app = Flask(__name__)
@@ -39,6 +40,10 @@ def settings():
         lunch_hours = request.form.getlist('lunch-hours')
         workdays = request.form.getlist('work-days') 
         database_update = request.form.getlist('database-update-period') 
+        first_weekday = request.form.getlist('first-weekday')
+        holidays = request.form.getlist('holidays')
+        workday_exceptions = request.form.getlist('workday-exceptions')
+        sync_now = request.form.getlist('sync-now')
         
         if len(work_hours) > 0:
             tar.set_workhours(workhours = work_hours)
@@ -52,6 +57,18 @@ def settings():
         if len(database_update) > 0:
             tar.set_database_update_period(database_update[0])            
 
+        if len(first_weekday) > 0:
+            tar.set_first_weekday(first_weekday = first_weekday[0])
+
+        if len(holidays) > 0:
+            tar.set_holidays(holidays = holidays[0])
+
+        if len(workday_exceptions) > 0:
+            tar.set_workday_exceptions(workday_exceptions = workday_exceptions[0])
+
+        if len(sync_now) > 0:
+            tar.trigger_sync()
+
     return render_template("settings.html", tar_driver = tar)
 
 
@@ -61,33 +78,95 @@ def reports():
         boards = request.form.getlist('boards')
         lists = request.form.getlist('lists')
         members = request.form.getlist('members')
-        tar.filter_dates.clear()
-        tar.filter_dates.append(request.form.getlist('report-dates')[0].translate(str.maketrans('T',' ')))
-        tar.filter_dates.append(request.form.getlist('report-dates')[1].translate(str.maketrans('T',' ')))
-        print(tar.filter_dates)
-
-        if len(boards) > 0 and len(lists) > 0 and len(members) > 0:
-            tar.get_project_report(board_id = boards[0], lists = lists, members = members)
-            return render_template("report.html", tar_driver = tar)
+        #отчетный период относится только к этому отчету
+        filter_dates = [date.translate(str.maketrans('T',' ')) for date in request.form.getlist('report-dates')[0:2]]
+
+        if request.form.get('report-mode') == 'team':
+            #сводный отчет: несколько досок, списки выбираются по имени
+            list_names = request.form.getlist('list-names')
+            if len(boards) > 0 and len(list_names) > 0 and len(members) > 0:
+                job_id = tar.submit_team_report(board_ids = boards, list_names = list_names, members = members, filter_dates = filter_dates)
+                return redirect(url_for("report", job_id = job_id))
+
+        elif len(boards) > 0 and len(lists) > 0 and len(members) > 0:
+            job_id = tar.submit_report(board_id = boards[0], lists = lists, members = members, filter_dates = filter_dates)
+            return redirect(url_for("report", job_id = job_id))
         
     return render_template("reports.html", tar_driver = tar, remove=remove_pattern)
 
 
+@app.route("/report/<job_id>")
+def report(job_id):
+    #Страница отчета: пока фоновая задача строит отчет - страница ожидания с прогрессом,
+    #затем сортировка и разбиение на страницы на сервере, строки отдаются клиенту по мере отрисовки
+    job = tar.get_report_job(job_id)
+    if job is None:
+        abort(404)
+
+    if job.status != 'done':
+        return render_template("report_wait.html", tar_driver = tar, job = job.get_status())
+
+    report_page = tar.get_report_page(page = request.args.get('page', 1, type = int),
+                                      page_size = request.args.get('size', 100, type = int),
+                                      sort_by = request.args.get('sort', 'person'),
+                                      descending = request.args.get('order', 'asc') == 'desc',
+                                      job_id = job_id)
+    return stream_template("report.html", tar_driver = tar, report = report_page)
+
+
+@app.route("/report/<job_id>/export.<export_format>")
+def report_export(job_id, export_format):
+    #Выгрузка готового отчета в CSV / XLSX; subtotals=person,board,list - промежуточные итоги по сотрудникам, доскам и (или) статусам
+    job = tar.get_report_job(job_id)
+    if job is None or job.status != 'done' or export_format not in ('csv', 'xlsx'):
+        abort(404)
+
+    rows = tar.iter_report_rows(job_id = job_id,
+                                sort_by = request.args.get('sort', 'person'),
+                                descending = request.args.get('order', 'asc') == 'desc',
+                                subtotals = [group for group in request.args.get('subtotals', '').split(',') if group])
+    export = ReportExport(rows)
+
+    if export_format == 'csv':
+        return Response(export.csv(), mimetype = 'text/csv; charset=utf-8',
+                        headers = {'Content-Disposition': f'attachment; filename=report-{job_id}.csv'})
+
+    return Response(export.xlsx(), mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    headers = {'Content-Disposition': f'attachment; filename=report-{job_id}.xlsx'})
+
+
+@app.route("/metrics")
+def metrics():
+    #Метрики TarDriver в текстовом формате Prometheus
+    return Response(tar.get_metrics(), mimetype = 'text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route("/report/<job_id>/status")
+def report_status(job_id):
+    job = tar.get_report_job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.get_status())
+
+
 
 
 if __name__ == "__main__":
     tar = TarDriver(trello_apiKey = API_KEY, trello_token = TOKEN, local_timezone = 'Asia/Tomsk')
 
-    #thread_updating_database = threading.Thread(target = tar.update_database, args=[False, ])
-    #thread_running_flask = threading.Thread(target = app.run)
+    #Сохраненная БД используется сразу, изменения в Trello догоняет первый цикл фоновой синхронизации;
+    #полная загрузка из Trello - только при пустой БД
+    if not tar.warm_start():
+        tar.fill_database()
 
-    #thread_updating_database.start()
-    #thread_running_flask.start()
-
-    tar.fill_database()
+    #Фоновая синхронизация БД (планировщик TarDriver.sync_scheduler в отдельном потоке)
+    tar.start_sync()
 
     app.run()
 
+    tar.stop_sync()
+    tar.close_database()
+
 
 
 
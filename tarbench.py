@@ -0,0 +1,500 @@
+from datetime import datetime, timezone, timedelta
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import subprocess
+import threading
+import shutil
+import statistics
+import argparse
+import tempfile
+import platform
+import random
+import json
+import gzip
+import time
+import os
+
+
+#Замеры производительности TarDriver без Trello и сети.
+#
+#FakeTrelloClient по зерну seed генерирует доски, списки, карточки, участников команды (доска КАДРЫ) и историю
+#перемещений карточек и отвечает на те же запросы, что TarDriver делает к TrelloClient (list_boards, fetch_json,
+#get_card). Каждый замер повторяется repeat раз, результат (min / median / mean / max, секунды) пишется в JSON,
+#который можно сравнить с результатом другого коммита:
+#
+#   python tarbench.py --boards 5 --lists 6 --cards 200 --members 10 --seed 1 --output bench.json
+#   python tarbench.py --output bench-new.json --compare bench.json
+#
+#Замеры trello_calls_* отправляют запросы py-trello на локальный HTTP-сервер (FakeTrelloHandler): без пула соединений
+#(модуль requests, соединение на каждый запрос) и через общую TrelloSession с keep-alive и сжатием ответов.
+
+
+#Имена списков досок проектов (как в TarDriver.basic_template), дальше - 'Список N'
+LIST_NAMES = ['Перечень Задач', 'Комплекс Задач', 'В Работе', 'Согласование выполнения', 'Завершены', 'Отменены']
+
+
+class FakeBoard:
+
+    #Доска в том виде, в каком ее отдает TrelloClient.list_boards()
+    def __init__(self, board_id, name, date_last_activity):
+        self.id = board_id
+        self.name = name
+        self.date_last_activity = date_last_activity
+
+
+class FakeCard:
+
+    #Карточка в том виде, в каком ее отдает TrelloClient.get_card(): текущий список, дата создания и перемещения
+    def __init__(self, client, card):
+        self.id = card['id']
+        self.name = card['name']
+        self.list_id = card['idList']
+        self.board_id = card['idBoard']
+        self.created_date = datetime.fromtimestamp(int(card['id'][0:8], 16), timezone.utc)
+        self.client = client
+
+
+    def list_movements(self):
+        return [{'source': action['data']['listBefore'],
+                 'destination': action['data']['listAfter'],
+                 'datetime': datetime.fromisoformat(action['date'].replace('Z', '+00:00'))}
+                for action in self.client.actions[self.board_id] if action['data']['card']['id'] == self.id]
+
+
+class FakeTrelloClient:
+
+    #Синтетический Trello в памяти: boards досок проектов по lists списков и cards карточек, members участников,
+    #у каждой карточки до movements перемещений между списками за последние history_days дней
+    def __init__(self, boards = 5, lists = 6, cards = 200, members = 10, movements = 8, history_days = 365, seed = 1, team_board_name = 'КАДРЫ'):
+        self.random = random.Random(seed)
+        #история заканчивается за час до запуска: simulate_activity двигает время вперед на секунду за перемещение,
+        #чтобы дата изменения доски в каждом цикле была больше сохраненной (TarDriver сравнивает их с точностью до секунды)
+        self.now = datetime.now(timezone.utc).replace(microsecond = 0) - timedelta(hours = 1)
+        self.boards = {}                    #{board_id: JSON доски без списков и карточек}
+        self.lists = {}                     #{board_id: [JSON списка, ...]}
+        self.cards = {}                     #{board_id: {card_id: JSON карточки}}
+        self.actions = {}                   #{board_id: [действие, ...]} от новых к старым
+        self.members = []
+        self.requests = 0
+
+        started = self.now - timedelta(days = history_days)
+
+        #доска команды: одна карточка на участника, имя карточки - ФИО
+        self.members = [{'id': self.new_id(started), 'username': f'user{number}', 'fullName': f'Участник {number}'} for number in range(members)]
+        team_board_id = self.new_board(team_board_name, ['Штат'], started)
+        for member in self.members:
+            self.new_card(team_board_id, member['fullName'], self.lists[team_board_id][0], [member['id']], started)
+
+        for board_number in range(boards):
+            board_id = self.new_board(f'Проект {board_number + 1}', [LIST_NAMES[number] if number < len(LIST_NAMES) else f'Список {number + 1}' for number in range(lists)], started)
+            board_lists = self.lists[board_id]
+
+            for card_number in range(cards):
+                created = started + timedelta(seconds = self.random.randint(0, history_days * 86400 - 1))
+                card_members = [member['id'] for member in self.random.sample(self.members, min(len(self.members), self.random.randint(1, 3)))]
+                card = self.new_card(board_id, f'Задача {board_number + 1}.{card_number + 1}', board_lists[0], card_members, created)
+
+                #перемещения в случайные моменты между созданием карточки и текущим временем
+                moved = sorted(self.random.randint(int(created.timestamp()) + 1, int(self.now.timestamp()) - 1) for _ in range(self.random.randint(0, movements)))
+                for timestamp in moved:
+                    self.move_card(board_id, card, self.random.choice([list_ for list_ in board_lists if list_['id'] != card['idList']]),
+                                   datetime.fromtimestamp(timestamp, timezone.utc))
+
+            self.actions[board_id].sort(key = lambda action: action['date'], reverse = True)
+
+
+    def new_id(self, created):
+        #Идентификатор в формате Trello: 8 hex-цифр времени создания + 16 случайных
+        return '%08x' % int(created.timestamp()) + ''.join(self.random.choice('0123456789abcdef') for _ in range(16))
+
+
+    def new_board(self, name, list_names, created):
+        board_id = self.new_id(created)
+        self.boards[board_id] = {'id': board_id, 'name': name, 'desc': '', 'dateLastActivity': self.format_date(self.now)}
+        self.lists[board_id] = [{'id': self.new_id(created), 'name': list_name, 'closed': False} for list_name in list_names]
+        self.cards[board_id] = {}
+        self.actions[board_id] = []
+        return board_id
+
+
+    def new_card(self, board_id, name, list_, members, created):
+        card = {'id': self.new_id(created), 'name': name, 'idList': list_['id'], 'idMembers': members, 'idBoard': board_id,
+                'closed': False, 'dateLastActivity': self.format_date(created)}
+        self.cards[board_id][card['id']] = card
+        return card
+
+
+    def move_card(self, board_id, card, list_, moved):
+        list_before = next(before for before in self.lists[board_id] if before['id'] == card['idList'])
+        self.actions[board_id].append({'id': self.new_id(moved),
+                                       'type': 'updateCard',
+                                       'date': self.format_date(moved),
+                                       'data': {'card': {'id': card['id'], 'name': card['name'], 'idList': list_['id']},
+                                                'old': {'idList': list_before['id']},
+                                                'listBefore': {'id': list_before['id'], 'name': list_before['name']},
+                                                'listAfter': {'id': list_['id'], 'name': list_['name']}}})
+        card['idList'] = list_['id']
+        card['dateLastActivity'] = self.format_date(moved)
+
+
+    def format_date(self, value):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.") + '%03dZ' % (value.microsecond // 1000)
+
+
+    def simulate_activity(self, moves = 20):
+        #Перемещение moves случайных карточек досок проектов "сейчас" - изменения для цикла update_database
+        project_boards = [board_id for board_id in self.boards if self.cards[board_id] and len(self.lists[board_id]) > 1]
+        for _ in range(moves):
+            board_id = self.random.choice(project_boards)
+            card = self.random.choice(list(self.cards[board_id].values()))
+            self.now = min(self.now + timedelta(seconds = 1), datetime.now(timezone.utc).replace(microsecond = 0))
+            moved = self.now
+            self.move_card(board_id, card, self.random.choice([list_ for list_ in self.lists[board_id] if list_['id'] != card['idList']]), moved)
+            self.actions[board_id].sort(key = lambda action: action['date'], reverse = True)
+            self.boards[board_id]['dateLastActivity'] = self.format_date(moved)
+
+
+    #Методы TrelloClient, которые вызывает TarDriver
+
+    def list_boards(self):
+        return [FakeBoard(board_id, board['name'], datetime.fromisoformat(board['dateLastActivity'].replace('Z', '+00:00')))
+                for board_id, board in self.boards.items()]
+
+
+    def get_card(self, card_id):
+        return FakeCard(self, self.find_card(card_id))
+
+
+    def fetch_json(self, uri_path, http_method = 'GET', headers = None, query_params = None, post_args = None, files = None):
+        self.requests += 1
+        query_params = query_params or {}
+        path = uri_path.strip('/').split('/')
+
+        if path[0] == 'cards':
+            return dict(self.find_card(path[1]))
+
+        if path[0] == 'members':
+            return [dict(card) for cards in self.cards.values() for card in cards.values() if path[1] in card['idMembers']]
+
+        board_id = path[1]
+        if len(path) == 3 and path[2] == 'actions':
+            return self.filter_actions(board_id, query_params.get('filter', 'all'), query_params.get('since'),
+                                       query_params.get('before'), int(query_params.get('limit', 50)))
+
+        snapshot = dict(self.boards[board_id])
+        snapshot['lists'] = [dict(list_) for list_ in self.lists[board_id]]
+        snapshot['cards'] = [dict(card) for card in self.cards[board_id].values()]
+        snapshot['members'] = [dict(member) for member in self.members]
+        if 'actions' in query_params:
+            snapshot['actions'] = self.filter_actions(board_id, query_params['actions'], None, None, int(query_params.get('actions_limit', 50)))
+        return snapshot
+
+
+    def find_card(self, card_id):
+        for cards in self.cards.values():
+            if card_id in cards:
+                return cards[card_id]
+        raise KeyError(f'Card "{card_id}" not found')
+
+
+    def filter_actions(self, board_id, action_filter, since, before, limit):
+        #Действия доски от новых к старым, как их отдает /boards/{id}/actions
+        action_types = action_filter.split(',')
+        if before is not None:
+            before = next((action['date'] for action in self.actions[board_id] if action['id'] == before), before)
+
+        result = []
+        for action in self.actions[board_id]:
+            if since is not None and action['date'] <= since:
+                break
+            if before is not None and action['date'] >= before:
+                continue
+            if 'all' in action_types or action['type'] in action_types or \
+                    any(action['type'] + ':' + field in action_types for field in action['data'].get('old', {})):
+                result.append(action)
+                if len(result) >= limit:
+                    break
+        return result
+
+
+class FakeTrelloHandler(BaseHTTPRequestHandler):
+
+    #Ответ на любой GET - история карточки в формате Trello, сжатая gzip, если клиент его принимает
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True          #заголовки и тело пишутся отдельно - без TCP_NODELAY keep-alive ждет задержанный ACK
+    payload = json.dumps([{'id': f'{index:024x}', 'type': 'updateCard', 'date': '2024-01-01T00:00:00.000Z',
+                           'data': {'listBefore': {'id': f'{index:024x}', 'name': 'В Работе'},
+                                    'listAfter': {'id': f'{index + 1:024x}', 'name': 'Завершены'}}}
+                          for index in range(50)]).encode('utf-8')
+    payload_gzip = gzip.compress(payload)
+
+    def do_GET(self):
+        compressed = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body = self.payload_gzip if compressed else self.payload
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TarBenchmark:
+
+    #Набор замеров TarDriver на FakeTrelloClient. Вывод TarDriver (print) во время замеров подавляется
+    def __init__(self, boards = 5, lists = 6, cards = 200, members = 10, movements = 8, seed = 1, repeat = 3,
+                 database_backend = 'tinydb', update_moves = 20, http_calls = 200):
+        self.params = {'boards': boards, 'lists': lists, 'cards': cards, 'members': members, 'movements': movements,
+                       'seed': seed, 'repeat': repeat, 'database_backend': database_backend, 'update_moves': update_moves,
+                       'http_calls': http_calls}
+        self.repeat = repeat
+        self.database_backend = database_backend
+        self.update_moves = update_moves
+        self.http_calls = http_calls
+        self.results = {}
+        self.directory = tempfile.mkdtemp(prefix = 'tarbench-')
+        self.databases = 0                  #число созданных файлов БД
+        self.devnull = open(os.devnull, 'w')
+
+
+    def new_client(self):
+        params = self.params
+        return FakeTrelloClient(boards = params['boards'], lists = params['lists'], cards = params['cards'],
+                                members = params['members'], movements = params['movements'], seed = params['seed'])
+
+
+    def new_database_path(self):
+        self.databases += 1
+        return os.path.join(self.directory, f'tar_database_{self.databases}' + ('.sqlite3' if self.database_backend == 'sqlite' else '.json'))
+
+
+    def new_driver(self, client, database_path = None):
+        from tardriver import TarDriver
+
+        with redirect_stdout(self.devnull):
+            return TarDriver(trello_client = client, database_backend = self.database_backend, database_path = database_path or self.new_database_path())
+
+
+    def measure(self, name, function, setup = None):
+        #Замер function(*setup()) repeat раз; setup в замер не входит
+        timings = []
+        for _ in range(self.repeat):
+            args = setup() if setup is not None else ()
+            with redirect_stdout(self.devnull):
+                started = time.perf_counter()
+                function(*args)
+                timings.append(time.perf_counter() - started)
+
+        self.results[name] = {'runs': len(timings),
+                              'min': round(min(timings), 6),
+                              'median': round(statistics.median(timings), 6),
+                              'mean': round(statistics.mean(timings), 6),
+                              'max': round(max(timings), 6)}
+        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] {name}: median {self.results[name]["median"]:.4f} s')
+        return self.results[name]
+
+
+    def run(self):
+        #TarDriver использует файлы в текущем каталоге (tar_database.json для переноса в SQLite) - работаем во временном
+        current_directory = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            self.run_fill_database()
+            database_path = self.new_database_path()
+            driver, client = self.prepare_driver(database_path)
+            self.run_update_database(driver, client)
+            self.run_project_report(driver)
+            self.run_filter_work_hours(driver)
+            self.run_pages(driver)
+            with redirect_stdout(self.devnull):
+                driver.close_database()
+            self.run_warm_start(client, database_path)
+            self.run_trello_calls()
+        finally:
+            os.chdir(current_directory)
+            shutil.rmtree(self.directory, ignore_errors = True)
+        return self.results
+
+
+    def prepare_driver(self, database_path = None):
+        client = self.new_client()
+        driver = self.new_driver(client, database_path = database_path)
+        with redirect_stdout(self.devnull):
+            driver.fill_database()
+        return driver, client
+
+
+    def run_fill_database(self):
+        def setup():
+            return (self.new_driver(self.new_client()),)
+
+        def fill_database(driver):
+            driver.fill_database()
+            driver.close_database()
+
+        self.measure('fill_database', fill_database, setup)
+
+
+    def run_update_database(self, driver, client):
+        #Цикл синхронизации после перемещения update_moves карточек и цикл без изменений в Trello
+        self.measure('update_database', lambda: driver.update_database(update_on_change = True),
+                     setup = lambda: client.simulate_activity(self.update_moves) or ())
+        self.measure('update_database_idle', lambda: driver.update_database(update_on_change = True))
+
+
+    def run_project_report(self, driver):
+        #Отчет по самой большой доске проекта: все списки, все участники; без кэша отчетов и из кэша
+        board_id = max((board['board_id'] for board in driver.local_boards.all()), key = lambda board_id: len(driver.local_cards.find(board_id = board_id)))
+        lists = [list_['list_id'] for list_ in driver.get_lists_by_board_id(board_id)]
+        members = list(driver.team.keys())
+        driver.filter_dates = [(datetime.now() - timedelta(days = 365)).strftime("%Y-%m-%d %H:%M:%S"), datetime.now().strftime("%Y-%m-%d %H:%M:%S")]
+
+        def setup():
+            driver.report_cache.invalidate()
+            driver.report_key = None
+            return ()
+
+        self.measure('get_project_report', lambda: driver.get_project_report(board_id, lists, members), setup)
+        self.measure('get_project_report_cached', lambda: driver.get_project_report(board_id, lists, members))
+
+
+    def run_filter_work_hours(self, driver, intervals = 1000):
+        #Рабочее время по длинным (до 5 лет) промежуткам: по одному и одним пакетом
+        generator = random.Random(self.params['seed'])
+        now = datetime.now(timezone.utc)
+        dates = []
+        for _ in range(intervals):
+            start = now - timedelta(seconds = generator.randint(86400, 5 * 365 * 86400))
+            dates.append((start, start + timedelta(seconds = generator.randint(3600, int((now - start).total_seconds())))))
+
+        def filter_work_hours():
+            for start_date, end_date in dates:
+                driver.filter_work_hours(start_date, end_date)
+
+        self.measure('filter_work_hours', filter_work_hours)
+        self.measure('filter_work_hours_batch', lambda: driver.filter_work_hours_batch(dates, disable_filter = True))
+
+
+    def run_warm_start(self, client, database_path):
+        #Перезапуск по заполненной БД: создание TarDriver и warm_start() до готовности отвечать на запросы
+        drivers = []
+
+        def close_drivers():
+            with redirect_stdout(self.devnull):
+                while drivers:
+                    drivers.pop().close_database()
+            return ()
+
+        def warm_start():
+            drivers.append(self.new_driver(client, database_path = database_path))
+            drivers[-1].warm_start()
+
+        self.measure('warm_start', warm_start, setup = close_drivers)
+        close_drivers()
+
+
+    def run_pages(self, driver):
+        #Отрисовка страниц Flask через тестовый клиент, без HTTP-сервера
+        import app as tar_app
+
+        tar_app.tar = driver
+        client = tar_app.app.test_client()
+
+        for page in ('projects', 'team', 'reports'):
+            def render(page = page):
+                response = client.get('/' + page)
+                response.get_data()
+                if response.status_code != 200:
+                    raise RuntimeError(f'/{page}: HTTP {response.status_code}')
+            self.measure(f'page_{page}', render)
+
+
+    def run_trello_calls(self, workers = 8):
+        #http_calls запросов py-trello из workers потоков (как при построении отчета) к локальному HTTP-серверу
+        from trello import TrelloClient
+        from tarrequests import TrelloRequestScheduler, TrelloSession
+        import requests
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTrelloHandler)
+        server.daemon_threads = True
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        api_root = f'http://127.0.0.1:{server.server_address[1]}/1'
+
+        def trello_calls(http_service):
+            scheduler = TrelloRequestScheduler(http_service = http_service, rate = None, coalesce = False, api_root = api_root)
+            client = TrelloClient(api_key = 'bench', token = 'bench', http_service = scheduler)
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                list(executor.map(lambda index: client.fetch_json(f'/cards/{index:024x}/actions', query_params = {'filter': 'updateCard'}),
+                                  range(self.http_calls)))
+
+        try:
+            self.measure('trello_calls_requests', lambda: trello_calls(requests))
+            self.measure('trello_calls_session', trello_calls, setup = lambda: (TrelloSession(pool_size = workers + 2),))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    def get_report(self):
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except OSError:
+            commit = ''
+        return {'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'commit': commit,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'params': self.params,
+                'results': self.results}
+
+
+def compare_reports(report, previous):
+    #Сравнение медиан с предыдущим результатом: {замер: отношение новое / старое}
+    ratios = {}
+    for name, result in report['results'].items():
+        previous_result = previous.get('results', {}).get(name)
+        if previous_result and previous_result['median'] > 0:
+            ratios[name] = round(result['median'] / previous_result['median'], 3)
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'TarDriver benchmarks on a synthetic Trello')
+    parser.add_argument('--boards', type = int, default = 5, help = 'project boards')
+    parser.add_argument('--lists', type = int, default = 6, help = 'lists per board')
+    parser.add_argument('--cards', type = int, default = 200, help = 'cards per board')
+    parser.add_argument('--members', type = int, default = 10, help = 'team members')
+    parser.add_argument('--movements', type = int, default = 8, help = 'max list movements per card')
+    parser.add_argument('--seed', type = int, default = 1)
+    parser.add_argument('--repeat', type = int, default = 3, help = 'runs of every benchmark')
+    parser.add_argument('--backend', choices = ['tinydb', 'sqlite'], default = 'tinydb', help = 'database backend')
+    parser.add_argument('--update-moves', type = int, default = 20, help = 'card moves before every update_database cycle')
+    parser.add_argument('--http-calls', type = int, default = 200, help = 'Trello API calls to the local HTTP server')
+    parser.add_argument('--output', default = 'tarbench.json', help = 'JSON file with results')
+    parser.add_argument('--compare', help = 'previous JSON results to compare medians with')
+    args = parser.parse_args()
+
+    benchmark = TarBenchmark(boards = args.boards, lists = args.lists, cards = args.cards, members = args.members,
+                             movements = args.movements, seed = args.seed, repeat = args.repeat,
+                             database_backend = args.backend, update_moves = args.update_moves, http_calls = args.http_calls)
+    benchmark.run()
+    report = benchmark.get_report()
+
+    if args.compare:
+        with open(args.compare, encoding = 'utf-8') as file_:
+            report['compare'] = {'file': args.compare, 'ratios': compare_reports(report, json.load(file_))}
+        for name, ratio in report['compare']['ratios'].items():
+            print(f'{name}: x{ratio}')
+
+    with open(args.output, 'w', encoding = 'utf-8') as file_:
+        json.dump(report, file_, ensure_ascii = False, indent = 4)
+    print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Results written to "{args.output}"')
+
+
+if __name__ == "__main__":
+    main()
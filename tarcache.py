@@ -0,0 +1,202 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class BoardCache:
+
+    #Кэш метаданных досок и их списков: {board_id: {'board_name': ..., 'lists': {list_id: list_name}}}.
+    #Записи живут ttl секунд, отсутствующая или устаревшая запись загружается через loader(board_id).
+    #Общий для построения отчетов и цикла синхронизации, поэтому защищен блокировкой
+    def __init__(self, loader, ttl = 600):
+        self.loader = loader
+        self.ttl = ttl
+        self.boards = {}
+        self.lock = threading.RLock()
+
+
+    def put(self, board_id, board_name, lists):
+        #Сохранение метаданных доски: lists - {list_id: list_name}
+        with self.lock:
+            self.boards[board_id] = {'board_name': board_name, 'lists': dict(lists), 'loaded': time.monotonic()}
+
+
+    def get_board(self, board_id):
+        with self.lock:
+            board = self.boards.get(board_id)
+            if board is not None and time.monotonic() - board['loaded'] < self.ttl:
+                return board
+
+        board_name, lists = self.loader(board_id)
+        self.put(board_id, board_name, lists)
+
+        with self.lock:
+            return self.boards[board_id]
+
+
+    def get_lists(self, board_id):
+        return self.get_board(board_id)['lists']
+
+
+    def get_list_name(self, board_id, list_id, default = ''):
+        #Имя списка; для списков, которых нет на доске (например, удаленных), возвращается default
+        lists = self.get_lists(board_id)
+        if list_id not in lists:
+            #список мог появиться после загрузки записи - перечитываем доску один раз
+            self.invalidate(board_id)
+            lists = self.get_lists(board_id)
+        return lists.get(list_id, default)
+
+
+    def invalidate(self, board_id = None):
+        #Сброс записи доски (или всего кэша, если board_id не указан)
+        with self.lock:
+            if board_id is None:
+                self.boards.clear()
+            else:
+                self.boards.pop(board_id, None)
+
+
+class BoardAggregates:
+
+    #Материализованные агрегаты для страниц проектов и команды:
+    #  число карточек доски по имени списка, состав участников доски,
+    #  число задач участника по имени списка (по всем доскам),
+    #  представление карточек доски с исполнителями и временем входа в текущий список.
+    #Пересчитываются по одной доске при ее добавлении, удалении и синхронизации, поэтому страница
+    #читает готовые значения из словарей, а не сканирует таблицы cards / cards_has_persons
+    def __init__(self):
+        self.board_lists = {}           #{board_id: {list_name: число карточек}}
+        self.board_members = {}         #{board_id: {person_id: person_name}} - в порядке появления
+        self.board_person_lists = {}    #{board_id: {(person_id, list_name): число задач}} - вклад доски в person_lists
+        self.person_lists = {}          #{(person_id, list_name): число задач}
+        self.board_tasks = {}           #{board_id: {list_name: [{'card_id', 'card_name', 'list_entered', 'members'}]}}
+        self.lock = threading.RLock()
+
+
+    def set_board(self, board_id, cards, cards_has_persons):
+        #Пересчет агрегатов доски по ее строкам из таблиц cards и cards_has_persons
+        board_lists = {}
+        for card in cards:
+            board_lists[card.get('list_name')] = board_lists.get(card.get('list_name'), 0) + 1
+
+        board_members = {}
+        board_person_lists = {}
+        card_members = {}
+        for row in cards_has_persons:
+            board_members.setdefault(row['person_id'], row.get('person_name'))
+            key = (row['person_id'], row.get('list_name'))
+            board_person_lists[key] = board_person_lists.get(key, 0) + 1
+            card_members.setdefault(row['card_id'], []).append(row.get('person_name'))
+
+        board_tasks = {}
+        for card in cards:
+            board_tasks.setdefault(card.get('list_name'), []).append({'card_id': card['card_id'],
+                                                                      'card_name': card.get('card_name'),
+                                                                      'list_entered': card.get('card_list_entered'),
+                                                                      'members': card_members.get(card['card_id'], [])})
+
+        with self.lock:
+            self.remove_board(board_id)
+            self.board_lists[board_id] = board_lists
+            self.board_members[board_id] = board_members
+            self.board_person_lists[board_id] = board_person_lists
+            self.board_tasks[board_id] = board_tasks
+            for key, count in board_person_lists.items():
+                self.person_lists[key] = self.person_lists.get(key, 0) + count
+
+
+    def remove_board(self, board_id):
+        with self.lock:
+            self.board_lists.pop(board_id, None)
+            self.board_members.pop(board_id, None)
+            self.board_tasks.pop(board_id, None)
+            for key, count in self.board_person_lists.pop(board_id, {}).items():
+                self.person_lists[key] -= count
+                if self.person_lists[key] <= 0:
+                    del self.person_lists[key]
+
+
+    def clear(self):
+        with self.lock:
+            self.board_lists.clear()
+            self.board_members.clear()
+            self.board_person_lists.clear()
+            self.person_lists.clear()
+            self.board_tasks.clear()
+
+
+    def list_count(self, board_id, list_name):
+        with self.lock:
+            return self.board_lists.get(board_id, {}).get(list_name, 0)
+
+
+    def members(self, board_id):
+        with self.lock:
+            return list(self.board_members.get(board_id, {}).items())
+
+
+    def person_list_count(self, person_id, list_name):
+        with self.lock:
+            return self.person_lists.get((person_id, list_name), 0)
+
+
+    def tasks(self, board_id, list_name):
+        with self.lock:
+            return list(self.board_tasks.get(board_id, {}).get(list_name, []))
+
+
+class ReportCache:
+
+    #LRU-кэш готовых отчетов: {ключ запроса: строки отчета}.
+    #Ключ включает версию рабочего календаря и отметку синхронизации доски, поэтому устаревший результат не
+    #может быть выдан; кроме того, записи доски сбрасываются при ее синхронизации, а весь кэш - при изменении настроек.
+    #Размер ограничен числом записей и суммарным числом строк
+    def __init__(self, max_entries = 32, max_rows = 200000):
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.entries = OrderedDict()        #{ключ: строки отчета}, от давно использованных к недавним
+        self.rows = 0                       #суммарное число строк в кэше
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+
+    def put(self, key, lines):
+        with self.lock:
+            if key in self.entries:
+                self.rows -= len(self.entries.pop(key))
+            if len(lines) > self.max_rows:
+                return
+
+            self.entries[key] = lines
+            self.rows += len(lines)
+
+            while len(self.entries) > self.max_entries or self.rows > self.max_rows:
+                _, evicted_lines = self.entries.popitem(last = False)
+                self.rows -= len(evicted_lines)
+                self.evictions += 1
+
+
+    def invalidate(self, board_id = None):
+        #Сброс отчетов доски (board_id - первый элемент ключа), сводных отчетов с этой доской
+        #(ключ ('team', (board_id, ...), ...)) или всего кэша
+        with self.lock:
+            for key in [key for key in self.entries if board_id is None or key[0] == board_id or (key[0] == 'team' and board_id in key[1])]:
+                self.rows -= len(self.entries.pop(key))
+
+
+    def get_stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'rows': self.rows, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -1,52 +1,132 @@
-from tinydb import TinyDB, Query, where
 from trello import TrelloClient
 from datetime import datetime, timezone, timedelta
 from pytz import timezone as tz
-import time
 import math
 from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from workcalendar import WorkCalendar
+from tarcache import BoardCache, BoardAggregates, ReportCache
+from tarsync import SyncScheduler
+from tarjobs import ReportJobs
+from tarstorage import AtomicJSONStorage, BufferedMiddleware, TarDatabase
+from tarsqlite import SQLiteDatabase
+from tarmetrics import metrics, trello_operation
+from tarrequests import TrelloRequestScheduler, TrelloSession
+import threading
 
 
 class TarDriver:
 
+    #Действия Trello, которые применяются к локальным таблицам точечно
+    sync_action_types = ['createCard', 'copyCard', 'convertToCardFromCheckItem', 'moveCardToBoard', 'moveCardFromBoard',
+                         'updateCard', 'deleteCard', 'addMemberToCard', 'removeMemberFromCard', 'createList', 'updateList',
+                         'moveListToBoard', 'moveListFromBoard', 'updateBoard']
+    #Действия, после которых доска перезагружается целиком
+    full_refresh_action_types = ['moveListToBoard', 'moveListFromBoard', 'updateBoard']
+    #Максимум действий за один запрос; если их больше - доска перезагружается целиком
+    sync_actions_limit = 1000
+    #Действия, после которых карточка оказывается в новом списке (время входа в текущий список)
+    list_entry_action_types = ['updateCard:idList', 'createCard', 'copyCard', 'convertToCardFromCheckItem', 'moveCardToBoard']
+    #Поля сортировки отчета: {параметр sort: поле строки отчета}
+    report_sort_fields = {'person': 'person_name', 'card': 'card_name', 'list': 'list_name', 'board': 'board_name', 'time': 'list_seconds'}
+
+
     #Конструктор класса
     def __init__(self, 
                         trello_apiKey = '',                                 #apiKey для подключения к trello
                         trello_token = '',  #apiToken для подключения к trello
-                        local_timezone = 'Asia/Tomsk'): 
+                        local_timezone = 'Asia/Tomsk',
+                        board_cache_ttl = 600,                              #время жизни кэша досок и списков, секунды
+                        report_workers = 8,                                 #число параллельных запросов к Trello при построении отчета
+                        trello_client = None,                               #готовый клиент Trello (например, локальная заглушка для тестов)
+                        database_flush_writes = 1000,                       #запись БД на диск после стольких изменений
+                        database_flush_delay = 5.0,                         #... или если изменения не записаны дольше, секунд
+                        database_backend = 'tinydb',                        #хранилище локальной БД: 'tinydb' или 'sqlite'
+                        database_path = None,                               #файл БД (по умолчанию tar_database.json / tar_database.sqlite3)
+                        report_cache_entries = 32,                          #число отчетов в кэше
+                        report_cache_rows = 200000,                         #суммарное число строк отчетов в кэше
+                        report_job_workers = 2,                             #число одновременно строящихся отчетов
+                        trello_rate_limit = 7.5,                            #запросов к Trello в секунду (None - без ограничения)
+                        trello_burst = 15,                                  #запросов к Trello подряд без ожидания (burst + 10 * rate < 100 за 10 с)
+                        trello_max_retries = 5,                             #повторов запроса при ответах 429 / 5xx и ошибках соединения
+                        trello_api_root = None,                             #адрес API Trello (например, локальный сервер для проверок)
+                        trello_pool_size = None,                            #соединений с Trello в пуле (None - report_workers + 2)
+                        trello_timeout = (5, 30),                           #тайм-аут запроса к Trello: (подключение, чтение), секунды
+                        trello_http_session = None):                        #готовая сессия requests для запросов к Trello (общая для нескольких TarDriver)
 
 
         self.API_KEY = trello_apiKey
         self.TOKEN = trello_token
         self.local_timezone = tz(local_timezone)
+        self.timezone_transitions = None                                    #переходы local_timezone для filter_work_hours_batch
         self.filter_dates = []
         self.database_is_updating = False
+        self.board_cache = BoardCache(loader = self.load_board_metadata, ttl = board_cache_ttl)
+        self.report_workers = max(1, int(report_workers))
+        self.team = {}                                                      #{person_id: person_fullname} - участники команды
+        self.team_cards_pending = set()                                     #участники, связи карточек которых еще не перестроены
+        self.aggregates = BoardAggregates()                                 #агрегаты досок и участников для страниц
+        self.report_cache = ReportCache(max_entries = report_cache_entries, max_rows = report_cache_rows)
+        self.report_key = None                                              #ключ отчета, записанного в таблицу report
+        self.report_jobs = ReportJobs(runner = self.run_report_job, workers = report_job_workers)
+
+
+        #Счетчик запросов к Trello для статистики синхронизации
+        self.api_calls = 0
+        self.api_calls_lock = threading.Lock()
+
+        #Пул постоянных соединений с Trello, общий для потока синхронизации и потоков отчетов:
+        #по соединению на поток отчета, поток синхронизации и запас
+        if trello_http_session is not None:
+            self.http_session = trello_http_session
+        else:
+            pool_size = trello_pool_size if trello_pool_size else self.report_workers + 2
+            self.http_session = TrelloSession(pool_size = pool_size, timeout = trello_timeout)
 
+        #Все HTTP-запросы клиента Trello идут через планировщик: ограничение частоты, повторы, объединение одинаковых запросов
+        self.request_scheduler = TrelloRequestScheduler(http_service = self.http_session, rate = trello_rate_limit, burst = trello_burst,
+                                                        max_retries = trello_max_retries, api_root = trello_api_root)
 
         #Подключение к Trello
         try:
-            self.trello_client = TrelloClient(
-                                            api_key=self.API_KEY,
-                                            token=self.TOKEN,
-            )
+            if trello_client is not None:
+                self.trello_client = trello_client
+            else:
+                self.trello_client = TrelloClient(
+                                                api_key=self.API_KEY,
+                                                token=self.TOKEN,
+                                                http_service=self.request_scheduler,
+                )
         except Exception as err:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to connect to Trello via API: {err}')
         else:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Connection to Trello established successful')
+            self.trello_client.fetch_json = self.count_api_calls(self.trello_client.fetch_json)
         
 
         #Создание файла БД и таблиц в БД
         try:
-            self.db = TinyDB('tar_database.json')
+            if database_backend == 'sqlite':
+                #SQLite в режиме WAL; при первом запуске переносим данные из tar_database.json рядом с файлом БД (см. tarsqlite.py)
+                self.db = SQLiteDatabase(database_path or 'tar_database.sqlite3')
+                self.db.migrate_from_json()
+            elif database_backend == 'tinydb':
+                #изменения копятся в памяти и пишутся на диск атомарно при flush_database() (см. tarstorage.py)
+                self.db = TarDatabase(database_path or 'tar_database.json', storage = BufferedMiddleware(AtomicJSONStorage, max_pending_writes = database_flush_writes, max_delay = database_flush_delay))
+            else:
+                raise ValueError(f'Unknown database backend "{database_backend}"')
             #self.db.drop_tables()      !!!!!!!!!!!!!!!!!!!!!
 
+            #таблицы с индексами по полям поиска (tarstorage.IndexedTable / tarsqlite.SQLiteTable)
             self.report = self.db.table('report')
             self.worktime = self.db.table('worktime')
-            self.local_boards = self.db.table('boards')
-            self.local_lists = self.db.table('lists')
-            self.local_cards = self.db.table('cards')
-            self.local_persons = self.db.table('persons')
-            self.local_cards_has_persons = self.db.table('cards_has_persons')
+            self.local_boards = self.db.table('boards', indexes = ['board_id'])
+            self.local_lists = self.db.table('lists', indexes = ['list_id', 'board_id'])
+            self.local_cards = self.db.table('cards', indexes = ['card_id', 'board_id', 'list_id', ('board_id', 'list_name')])
+            self.local_persons = self.db.table('persons', indexes = ['person_id'])
+            self.local_cards_has_persons = self.db.table('cards_has_persons', indexes = ['card_id', 'board_id', 'list_id', 'person_id', ('board_id', 'list_name')])
+            self.card_movements = self.db.table('card_movements', indexes = ['card_id', 'board_id', 'action_id'])
 
         except Exception as err:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to setup tar_database: {err}')
@@ -83,8 +163,9 @@ class TarDriver:
                                 {5:  'Отменены', 'cards': []}
         ]
 
-        self.db.drop_table('worktime')
-        self.worktime.insert({ 'work_day_starts': '09:00:00', 
+        #Настройки по умолчанию; сохраненные пользователем настройки не перезаписываются,
+        #в существующую запись добавляются только отсутствующие в ней поля
+        worktime_defaults = { 'work_day_starts': '09:00:00', 
                                'work_day_ends': '18:00:00', 
                                'work_day_duration': '09:00:00', 
                                'lunch_hours_starts': '13:00:00', 
@@ -93,46 +174,247 @@ class TarDriver:
                                'day_work_hours': '08:00:00',
                                'work_days': '5', 
                                'week_work_hours': '1 day, 16:00:00',
-                               'update_period': '00:02:00'
-        })
+                               'update_period': '00:02:00',
+                               'first_weekday': '0',
+                               'weekday_schedules': {},
+                               'holidays': [],
+                               'workday_exceptions': []
+        }
+
+        worktime_rows = self.worktime.all()
+        if len(worktime_rows) == 0:
+            self.worktime.insert(worktime_defaults)
+        else:
+            missing_fields = {field: value for field, value in worktime_defaults.items() if field not in worktime_rows[0]}
+            if missing_fields:
+                self.worktime.update(missing_fields)
+
+        #Рабочий календарь в памяти, пересобирается при изменении настроек
+        self.refresh_work_calendar()
+
+        #Агрегаты по уже сохраненным в БД доскам
+        self.refresh_aggregates()
+
+        #Фоновая синхронизация локальной БД с периодом update_period
+        self.sync_scheduler = SyncScheduler(cycle = self.sync_cycle, period = lambda: self.work_calendar.update_period)
+
+
+    def fetch_board_snapshot(self, board_id):
+        #Снимок доски одним вложенным запросом: поля доски, все списки, открытые карточки, участники
+        #и последние действия входа карточек в списки (переносы и копии с других досок; перемещения внутри доски
+        #берутся из полной истории card_movements - см. add_board)
+        return self.trello_client.fetch_json('/boards/' + board_id,
+                                             query_params={'fields': 'name,desc,dateLastActivity',
+                                                           'lists': 'all',
+                                                           'list_fields': 'name,closed',
+                                                           'cards': 'open',
+                                                           'card_fields': 'name,idList,idMembers,dateLastActivity',
+                                                           'members': 'all',
+                                                           'member_fields': 'username,fullName',
+                                                           'actions': ','.join(self.list_entry_action_types),
+                                                           'actions_limit': self.sync_actions_limit,
+                                                           'action_fields': 'type,date,data'})
+
+
+    def build_board_rows(self, snapshot, list_entered = None):
+        #Строки таблиц boards / lists / cards / cards_has_persons из снимка доски за один проход.
+        #Участники карточек сопоставляются с командой через словарь self.team.
+        #list_entered - {card_id: дата входа в текущий список} по полной истории перемещений (get_cards_list_entered)
+        board_id = snapshot['id']
+        board_name = snapshot['name']
+        now = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        list_names = {list_['id']: list_['name'] for list_ in snapshot.get('lists', [])}
+
+        rows = {'boards': [{'board_id': board_id, 
+                            'board_name': board_name, 
+                            'board_description': snapshot.get('desc', ''),
+                            'board_last_modified': str(self.parse_trello_date(snapshot.get('dateLastActivity')))}],
+                'lists': [],
+                'cards': [],
+                'cards_has_persons': []}
+
+        for list_id, list_name in list_names.items():
+            rows['lists'].append({'list_id': list_id, 
+                                  'list_name': list_name, 
+                                  'list_last_modified': now, 
+                                  'board_id': board_id, 
+                                  'board_name': board_name})
+
+        #время входа карточки в текущий список - последнее перемещение или создание. Действия снимка ограничены
+        #sync_actions_limit последними и дополняют историю перемещений переносами и копиями карточек с других досок
+        list_entered = dict(list_entered or {})
+        for action in snapshot.get('actions', []):
+            card_id = action.get('data', {}).get('card', {}).get('id')
+            if card_id is not None and action['date'] > list_entered.get(card_id, ''):
+                list_entered[card_id] = action['date']
+
+        for card in snapshot.get('cards', []):
+            card_row, card_persons = self.build_card_rows(board_id, board_name, card, list_names.get(card['idList'], ''), list_entered.get(card['id']))
+            rows['cards'].append(card_row)
+            rows['cards_has_persons'].extend(card_persons)
+
+        #отметка синхронизации: действия доски после этой даты применяются инкрементально (sync_board_actions)
+        rows['boards'][0]['board_last_action'] = snapshot.get('dateLastActivity') or datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+        return rows
+
+
+    def build_card_rows(self, board_id, board_name, card, list_name, list_entered = None):
+        #Строка таблицы cards и строки cards_has_persons для карточки из JSON Trello.
+        #list_entered - дата входа в текущий список; если перемещений не найдено - дата создания карточки (из ее id)
+        if list_entered is None:
+            try:
+                list_entered = datetime.fromtimestamp(int(card['id'][0:8], 16), timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            except ValueError:
+                list_entered = ''
+
+        card_row = {'card_id': card['id'],  
+                    'card_name': card['name'], 
+                    'list_id': card['idList'], 
+                    'list_name': list_name,
+                    'board_id': board_id, 
+                    'board_name': board_name,
+                    'card_list_entered': list_entered}
+
+        card_persons = []
+        for person_id in card.get('idMembers', []):
+            if person_id in self.team:
+                card_persons.append({'card_id': card['id'], 
+                                     'card_name': card['name'], 
+                                     'person_id': person_id, 
+                                     'person_name': self.team[person_id],
+                                     'list_id': card['idList'],
+                                     'list_name': list_name,
+                                     'board_id': board_id,
+                                     'board_name': board_name})
+
+        return card_row, card_persons
+
+
+    def fetch_board_movements(self, board_id, since = None):
+        #История перемещений карточек доски между списками (действия updateCard:idList) после даты since.
+        #Trello отдает действия от новых к старым не более sync_actions_limit за запрос - листаем страницы через before
+        actions = []
+        before = None
+        while True:
+            query_params = {'filter': 'updateCard:idList', 'fields': 'type,date,data', 'limit': self.sync_actions_limit}
+            if since is not None:
+                query_params['since'] = since
+            if before is not None:
+                query_params['before'] = before
+
+            page = self.trello_client.fetch_json('/boards/' + board_id + '/actions', query_params = query_params)
+            actions.extend(page)
+            if len(page) < self.sync_actions_limit:
+                return actions
+            before = page[-1]['id']
+
+
+    def build_movement_row(self, board_id, action):
+        #Строка таблицы card_movements из действия updateCard:idList (None, если это не перемещение между списками)
+        data = action.get('data', {})
+        if 'listBefore' not in data or 'listAfter' not in data:
+            return None
+        return {'action_id': action['id'],
+                'card_id': data.get('card', {}).get('id'),
+                'board_id': board_id,
+                'list_before_id': data['listBefore'].get('id'),
+                'list_after_id': data['listAfter'].get('id'),
+                'movement_date': action['date']}
+
+
+    def store_card_movements(self, board_id, actions):
+        #Добавление перемещений в card_movements без повторов (по action_id)
+        known_actions = {row['action_id'] for row in self.card_movements.find(board_id = str(board_id))}
+        rows = []
+        for action in actions:
+            row = self.build_movement_row(board_id, action)
+            if row is not None and row['action_id'] not in known_actions:
+                known_actions.add(row['action_id'])
+                rows.append(row)
+        self.card_movements.insert_multiple(rows)
+        return len(rows)
+
+
+    def update_card_movements(self, board_id):
+        #Загрузка истории перемещений доски: полностью при первом добавлении доски, иначе только новые действия
+        known_dates = [row['movement_date'] for row in self.card_movements.find(board_id = str(board_id))]
+        return self.store_card_movements(board_id, self.fetch_board_movements(board_id, since = max(known_dates) if known_dates else None))
+
+
+    def backfill_card_movements(self):
+        #Загрузка истории перемещений досок без отметки board_movements_loaded (БД, записанная до появления
+        #card_movements, или перенесенная из tar_database.json): без истории отчет по локальным таблицам считал бы,
+        #что карточки не перемещались. Доска, историю которой загрузить не удалось, остается без отметки -
+        #отчеты по ней идут в Trello, а загрузка повторяется следующим циклом синхронизации. Возвращает число досок
+        loaded = 0
+        for board_row in self.local_boards.all():
+            if board_row.get('board_movements_loaded'):
+                continue
+
+            board_id = board_row['board_id']
+            try:
+                self.store_card_movements(board_id, self.fetch_board_movements(board_id))
+
+                #время входа в текущий список было взято из ограниченного снимка доски
+                list_entered = self.get_cards_list_entered(board_id)
+                for card in self.local_cards.find(board_id = str(board_id)):
+                    if list_entered.get(card['card_id'], '') > (card.get('card_list_entered') or ''):
+                        self.local_cards.update_where({'card_list_entered': list_entered[card['card_id']]}, card_id = card['card_id'])
+
+                self.local_boards.update_where({'board_movements_loaded': True}, board_id = str(board_id))
+                self.refresh_board_aggregates(board_id)
+                self.report_cache.invalidate(board_id)
+            except Exception as err:
+                print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to load card movements of "{board_row.get("board_name", board_id)}": {err}')
+            else:
+                loaded += 1
+
+        if loaded > 0:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Card movements loaded for {loaded} boards')
+        return loaded
+
+
+    def is_movements_loaded(self, board_id):
+        #Загружена ли в card_movements полная история перемещений доски
+        board_row = self.local_boards.find_one(board_id = str(board_id))
+        return board_row is not None and bool(board_row.get('board_movements_loaded'))
+
+
+    def get_cards_list_entered(self, board_id):
+        #Время входа карточек доски в текущий список по сохраненной истории перемещений: {card_id: дата последнего перемещения}
+        list_entered = {}
+        for row in self.card_movements.find(board_id = str(board_id)):
+            if row['movement_date'] > list_entered.get(row['card_id'], ''):
+                list_entered[row['card_id']] = row['movement_date']
+        return list_entered
+
+
+    def parse_trello_date(self, value):
+        #Дата из JSON Trello ('2020-01-01T10:00:00.000Z') в datetime с часовым поясом
+        if not value:
+            return datetime.now(timezone.utc)
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
 
 
     def add_board(self, board):
-        #Добавление новой доски в БД
+        #Добавление новой доски в БД по снимку доски (один запрос к Trello на доску)
         try:
-            self.local_boards.insert({'board_id': board.id, 'board_name': board.name, 'board_description': board.description,'board_last_modified': str(board.date_last_activity)})
-
-            for list_ in board.list_lists():
-                self.local_lists.insert( {'list_id': list_.id, 
-                                          'list_name': list_.name, 
-                                          'list_last_modified': str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 
-                                          'board_id': board.id, 
-                                          'board_name': board.name}
-                                        )
-
-                for card in list_.list_cards():
-
-                    self.local_cards.insert( {'card_id': card.id,  
-                                              'card_name': card.name, 
-                                              'list_id': list_.id, 
-                                              'list_name': list_.name,
-                                              'board_id': board.id, 
-                                              'board_name': board.name}
-                                            )
-
-                    if len(card.member_id) > 0:
-                        for person in self.team:
-                            if person.id in card.member_id:
-                                query_result = self.local_persons.get(where('person_id') == str(person.id))
-                                self.local_cards_has_persons.insert({'card_id': card.id, 
-                                                                         'card_name': card.name, 
-                                                                         'person_id': person.id, 
-                                                                         'person_name': query_result['person_fullname'],
-                                                                         'list_id': list_.id,
-                                                                         'list_name': list_.name,
-                                                                         'board_id': board.id,
-                                                                         'board_name': board.name}
-                                                                    )
+            snapshot = self.fetch_board_snapshot(board.id)
+            #сначала история перемещений: если она не загрузилась, доска не добавляется и будет добавлена следующим циклом.
+            #По ней же определяется время входа карточек в текущий список
+            self.update_card_movements(board.id)
+            rows = self.build_board_rows(snapshot, self.get_cards_list_entered(board.id))
+            rows['boards'][0]['board_movements_loaded'] = True
+
+            self.local_boards.insert_multiple(rows['boards'])
+            self.local_lists.insert_multiple(rows['lists'])
+            self.local_cards.insert_multiple(rows['cards'])
+            self.local_cards_has_persons.insert_multiple(rows['cards_has_persons'])
+
+            self.board_cache.put(board.id, snapshot['name'], {list_['list_id']: list_['list_name'] for list_ in rows['lists']})
+            self.aggregates.set_board(board.id, rows['cards'], rows['cards_has_persons'])
+            self.report_cache.invalidate(board.id)
 
         except Exception as err:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to add "{board.name}": {err}')
@@ -140,47 +422,206 @@ class TarDriver:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] "{board.name}" added successful')
 
 
-    def delete_board(self, board_id, board_name = ''):
-        #Удаление доски из БД
+    def delete_board(self, board_id, board_name = '', keep_movements = False):
+        #Удаление доски из БД. keep_movements = True - история перемещений карточек остается
+        #(полная перезагрузка доски, после которой догружаются только новые перемещения)
         try:
             #Удаляем записи из таблицы local_cards_has_persons
-            self.local_cards_has_persons.remove(where('board_id') == str(board_id))
+            self.local_cards_has_persons.remove_where(board_id = str(board_id))
             #Удаляем записи из таблицы local_cards
-            self.local_cards.remove(where('board_id') == str(board_id))
+            self.local_cards.remove_where(board_id = str(board_id))
             #Удаляем записи из таблицы local_lists
-            self.local_lists.remove(where('board_id') == str(board_id))
+            self.local_lists.remove_where(board_id = str(board_id))
             #Удаляем записи из таблицы local_boards
-            self.local_boards.remove(where('board_id') == str(board_id))
+            self.local_boards.remove_where(board_id = str(board_id))
+            #Удаляем историю перемещений карточек доски
+            if not keep_movements:
+                self.card_movements.remove_where(board_id = str(board_id))
+            #Сбрасываем доску в кэше метаданных, агрегатах и кэше отчетов
+            self.board_cache.invalidate(board_id)
+            self.aggregates.remove_board(board_id)
+            self.report_cache.invalidate(board_id)
         except Exception as err:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to delete {board_id}: {err}')
         else:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] {board_id} deleted successful')
 
 
-    def update_board(self, board):
-        #Обновление доски в БД
-        datetime_format = "%Y-%m-%d %H:%M:%S.%f%z"
-
-        try:
-            query_result = self.local_boards.get(where('board_id') == str(board.id))
+    def update_board(self, board, incremental = True):
+        #Обновление доски в БД: если доска менялась, применяем ее действия с последней синхронизации,
+        #а полная перезагрузка (delete_board + add_board) остается запасным вариантом
+        #Возвращает True, если доска была обновлена
+        query_result = self.local_boards.find_one(board_id = str(board.id))
 
-        except Exception as err:
-            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Updating "{board.name}"...{err}')
-            self.delete_board(board_id = board.id, board_name = board.name)
+        if query_result is None:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Updating "{board.name}"...')
             self.add_board(board = board)
-        else:
-            board_date_last_activity = self.unify_time(datetime.strptime(query_result['board_last_modified'], datetime_format))
-            
-            if self.unify_time(board.date_last_activity) > board_date_last_activity:
-                print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Updating "{board.name}"...')
-                self.delete_board(board_id = board.id, board_name = board.name)
-                self.add_board(board = board)
+            return True
+
+        board_date_last_activity = self.unify_time(datetime.fromisoformat(query_result['board_last_modified']))
+
+        if board.date_last_activity is None or self.unify_time(board.date_last_activity) <= board_date_last_activity:
+            return False
+
+        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Updating "{board.name}"...')
+
+        if incremental and query_result.get('board_last_action'):
+            try:
+                if self.sync_board_actions(board = board, board_row = query_result):
+                    self.refresh_board_aggregates(board.id)
+                    self.report_cache.invalidate(board.id)
+                    return True
+            except Exception as err:
+                print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to apply actions of "{board.name}": {err}')
+
+        self.delete_board(board_id = board.id, board_name = board.name, keep_movements = True)
+        self.add_board(board = board)
+        return True
+
+
+    def sync_board_actions(self, board, board_row):
+        #Инкрементальная синхронизация: запрашиваем только действия доски после отметки board_last_action
+        #и применяем их точечными вставками / изменениями / удалениями. Возвращает False, если нужна полная перезагрузка
+        actions = self.trello_client.fetch_json('/boards/' + board.id + '/actions',
+                                                query_params={'filter': ','.join(self.sync_action_types),
+                                                              'since': board_row['board_last_action'],
+                                                              'limit': self.sync_actions_limit})
+
+        if len(actions) >= self.sync_actions_limit:
+            return False
+
+        if any(action['type'] in self.full_refresh_action_types for action in actions):
+            return False
+
+        #Trello отдает действия от новых к старым
+        for action in sorted(actions, key=itemgetter('date')):
+            self.apply_board_action(board_id = board.id, board_name = board_row['board_name'], action = action)
+
+        last_action = max([action['date'] for action in actions] + [board_row['board_last_action']])
+        self.local_boards.update_where({'board_last_modified': str(board.date_last_activity), 'board_last_action': last_action}, board_id = str(board.id))
+
+        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] "{board.name}": {len(actions)} actions applied')
+        return True
+
+
+    def apply_board_action(self, board_id, board_name, action):
+        #Применение одного действия Trello к таблицам cards / lists / cards_has_persons
+        action_type = action['type']
+        data = action.get('data', {})
+        card = data.get('card', {})
+
+        if action_type == 'createCard':
+            list_ = data.get('list', {})
+            self.upsert_card(board_id, board_name, {'id': card['id'], 'name': card.get('name', ''), 'idList': list_.get('id'), 'idMembers': []}, list_.get('name', ''), list_entered = action['date'])
+
+        elif action_type in ('copyCard', 'convertToCardFromCheckItem', 'moveCardToBoard'):
+            self.upsert_card(board_id, board_name, self.fetch_card_json(card['id']), list_entered = action['date'])
+
+        elif action_type in ('deleteCard', 'moveCardFromBoard'):
+            self.remove_card(card['id'])
+
+        elif action_type == 'updateCard':
+            old = data.get('old', {})
+
+            if 'closed' in old:
+                if card.get('closed'):
+                    #карточка в архиве - в БД хранятся только открытые карточки
+                    self.remove_card(card['id'])
+                else:
+                    self.upsert_card(board_id, board_name, self.fetch_card_json(card['id']))
+                return
+
+            if 'idList' in old:
+                self.store_card_movements(board_id, [action])
+                list_after = data.get('listAfter', {})
+                fields = {'list_id': list_after.get('id'), 'list_name': list_after.get('name', '')}
+                self.local_cards.update_where(dict(fields, card_list_entered = action['date']), card_id = str(card['id']))
+                self.local_cards_has_persons.update_where(fields, card_id = str(card['id']))
+
+            if 'name' in old:
+                self.local_cards.update_where({'card_name': card.get('name', '')}, card_id = str(card['id']))
+                self.local_cards_has_persons.update_where({'card_name': card.get('name', '')}, card_id = str(card['id']))
+
+        elif action_type == 'addMemberToCard':
+            person_id = data.get('idMember')
+            query_result = self.local_cards.find_one(card_id = str(card['id']))
+            if person_id in self.team and query_result is not None and \
+                    self.local_cards_has_persons.find_one(card_id = str(card['id']), person_id = str(person_id)) is None:
+                self.local_cards_has_persons.insert({'card_id': card['id'], 
+                                                     'card_name': query_result['card_name'], 
+                                                     'person_id': person_id, 
+                                                     'person_name': self.team[person_id],
+                                                     'list_id': query_result['list_id'],
+                                                     'list_name': query_result['list_name'],
+                                                     'board_id': board_id,
+                                                     'board_name': board_name})
+
+        elif action_type == 'removeMemberFromCard':
+            self.local_cards_has_persons.remove_where(card_id = str(card['id']), person_id = str(data.get('idMember')))
+
+        elif action_type in ('createList', 'updateList'):
+            list_ = data.get('list', {})
+            list_row = {'list_id': list_['id'], 
+                        'list_name': list_.get('name', ''), 
+                        'list_last_modified': str(datetime.now().strftime("%Y-%m-%d %H:%M:%S")), 
+                        'board_id': board_id, 
+                        'board_name': board_name}
+            if not self.local_lists.update_where(list_row, list_id = str(list_['id'])):
+                self.local_lists.insert(list_row)
+
+            if 'name' in data.get('old', {}):
+                self.local_cards.update_where({'list_name': list_.get('name', '')}, list_id = str(list_['id']))
+                self.local_cards_has_persons.update_where({'list_name': list_.get('name', '')}, list_id = str(list_['id']))
+
+            self.board_cache.invalidate(board_id)
+
+
+    def fetch_card_json(self, card_id):
+        #Текущие поля карточки, нужные для строк cards / cards_has_persons
+        return self.trello_client.fetch_json('/cards/' + card_id, query_params={'fields': 'name,idList,idMembers,closed'})
+
+
+    def upsert_card(self, board_id, board_name, card, list_name = None, list_entered = None):
+        #Замена строк карточки в cards и cards_has_persons
+        if card.get('closed'):
+            self.remove_card(card['id'])
+            return
+
+        if list_name is None:
+            list_name = self.board_cache.get_list_name(board_id, card['idList'])
+
+        if list_entered is None:
+            #карточка осталась в том же списке - сохраняем прежнее время входа в список
+            query_result = self.local_cards.find_one(card_id = str(card['id']))
+            if query_result is not None and query_result.get('list_id') == card['idList']:
+                list_entered = query_result.get('card_list_entered')
+
+        card_row, card_persons = self.build_card_rows(board_id, board_name, card, list_name, list_entered)
+
+        if not self.local_cards.update_where(card_row, card_id = str(card['id'])):
+            self.local_cards.insert(card_row)
+        self.local_cards_has_persons.remove_where(card_id = str(card['id']))
+        self.local_cards_has_persons.insert_multiple(card_persons)
+
+
+    def remove_card(self, card_id):
+        #Удаление карточки из cards и cards_has_persons
+        self.local_cards.remove_where(card_id = str(card_id))
+        self.local_cards_has_persons.remove_where(card_id = str(card_id))
 
 
     def fill_main_boards(self):
-        #Заполнение таблиц local_boards, local_lists, local_cards
+        #Заполнение таблиц local_boards, local_lists, local_cards. Таблицы заполняются заново (без повторов строк
+        #при повторном вызове), история перемещений card_movements сохраняется и только дополняется
         print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Filling "local_boards / local_lists / local_cards" tables...')
         try:
+            self.local_cards_has_persons.truncate()
+            self.local_cards.truncate()
+            self.local_lists.truncate()
+            self.local_boards.truncate()
+            self.aggregates.clear()
+            self.report_cache.invalidate()
+
             for board in self.trello_client.list_boards():
                 self.add_board(board = board)
         except Exception as err:
@@ -190,18 +631,38 @@ class TarDriver:
    
 
     def fill_persons(self, team_board_name='КАДРЫ'):
-        #Заполнение таблицы local_persons
+        #Заполнение таблицы local_persons по доске команды: запрашиваются только списки, открытые карточки и участники
+        #доски (без действий), таблица перезаписывается, только если состав команды изменился
         try:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Filling "local_persons" table...')
             for board in self.trello_client.list_boards():
                 if board.name == team_board_name:
-                    self.team = board.get_members(filters='all')
-                    for list_ in board.list_lists():
-                        for card in list_.list_cards():
-                            if len(card.member_id) > 0:
-                                for person in self.team:
-                                    if person.id in card.member_id:
-                                        self.local_persons.insert({'person_id': person.id, 'person_username': person.username, 'person_fullname': card.name, 'status': list_.name, 'last_modified': str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))})                       
+                    team_board = self.trello_client.fetch_json('/boards/' + board.id,
+                                                               query_params={'fields': 'name',
+                                                                             'lists': 'all',
+                                                                             'list_fields': 'name',
+                                                                             'cards': 'open',
+                                                                             'card_fields': 'name,idList,idMembers',
+                                                                             'members': 'all',
+                                                                             'member_fields': 'username,fullName'})
+                    members = {member['id']: member for member in team_board.get('members', [])}
+                    list_names = {list_['id']: list_['name'] for list_ in team_board.get('lists', [])}
+                    now = str(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+                    persons = []
+                    for card in team_board.get('cards', []):
+                        for person_id in card.get('idMembers', []):
+                            if person_id in members:
+                                persons.append({'person_id': person_id, 'person_username': members[person_id]['username'], 'person_fullname': card['name'], 'status': list_names.get(card['idList'], ''), 'last_modified': now})
+
+                    #команда заменяет прежнюю только после успешного запроса к Trello и только если она изменилась
+                    def person_key(person):
+                        return (person['person_id'], person.get('person_username'), person.get('person_fullname'), person.get('status'))
+
+                    if [person_key(person) for person in persons] != [person_key(person) for person in self.local_persons.all()]:
+                        self.local_persons.truncate()
+                        self.local_persons.insert_multiple(persons)
+                    self.team = self.build_team(persons)
                     break
         except Exception as err:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to fill "local_persons" table: {err}')
@@ -209,153 +670,345 @@ class TarDriver:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] "local_persons" table filled successful')
 
 
+    def build_team(self, persons):
+        #Словарь команды {person_id: person_fullname} по строкам local_persons; у участника с несколькими карточками
+        #на доске команды - имя из первой. Используется и при загрузке из Trello, и при запуске по сохраненной БД
+        team = {}
+        for person in persons:
+            team.setdefault(person['person_id'], person['person_fullname'])
+        return team
+
+
     def fill_cards_has_persons(self):
-        #Заполнение таблицы cards_has_persons
+        #Заполнение таблицы cards_has_persons по снимкам досок
         try:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Filling "cards_has_persons" table...')
+            #строки всех досок собираются до очистки таблицы: ошибка запроса не оставляет таблицу заполненной частично.
+            #Карточки, которых нет в local_cards (доска еще не загружена), пропускаются - их добавит add_board
+            card_ids = {card['card_id'] for card in self.local_cards.all()}
+            rows = []
             for board in self.trello_client.list_boards():
-                for list_ in board.list_lists():
-                    for card in list_.list_cards():
-                        if len(card.member_id) > 0:
-                            for person in self.team:
-                                if person.id in card.member_id:
-                                    query_result = self.local_persons.get(where('person_id') == str(person.id))
-                                    self.local_cards_has_persons.insert({'card_id': card.id, 
-                                                                         'card_name': card.name, 
-                                                                         'person_id': person.id, 
-                                                                         'person_name': query_result['person_fullname'],
-                                                                         'list_id': list_.id,
-                                                                         'list_name': list_.name,
-                                                                         'board_id': board.id,
-                                                                         'board_name': board.name}
-                                                                         )
+                rows.extend(row for row in self.build_board_rows(self.fetch_board_snapshot(board.id))['cards_has_persons'] if row['card_id'] in card_ids)
+            self.local_cards_has_persons.truncate()
+            self.local_cards_has_persons.insert_multiple(rows)
+            self.refresh_aggregates()
         except Exception as err:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to fill "cards_has_persons" table: {err}')
         else:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] "cards_has_persons" table filled successful')
 
     
+    def update_team_cards(self, person_ids):
+        #Перестройка связей cards_has_persons участников person_ids по их открытым карточкам в Trello
+        #(один запрос на участника, остальные строки таблицы не трогаются). Новые строки собираются целиком
+        #и заменяют прежние только после того, как все запросы прошли успешно; ошибка запроса пробрасывается
+        person_ids = set(person_ids)
+        rows = []
+        for person_id in person_ids:
+            if person_id not in self.team:
+                continue    #участник удален из команды - его строки только удаляются
+            cards = self.trello_client.fetch_json('/members/' + person_id + '/cards', query_params = {'filter': 'open', 'fields': 'name,idList,idBoard'})
+            for card in cards:
+                card_row = self.local_cards.find_one(card_id = str(card['id']))
+                if card_row is None:
+                    continue    #доска еще не загружена - строки появятся при ее добавлении
+                rows.append({'card_id': card_row['card_id'],
+                             'card_name': card_row['card_name'],
+                             'person_id': person_id,
+                             'person_name': self.team[person_id],
+                             'list_id': card_row['list_id'],
+                             'list_name': card_row['list_name'],
+                             'board_id': card_row['board_id'],
+                             'board_name': card_row['board_name']})
+
+        for person_id in person_ids:
+            self.local_cards_has_persons.remove_where(person_id = person_id)
+        self.local_cards_has_persons.insert_multiple(rows)
+
+        self.refresh_aggregates()
+        self.report_cache.invalidate()
+        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Cards of {len(person_ids)} team members updated: {len(rows)} assignments')
+
+
     def fill_database(self):
-        self.fill_persons()
-        self.fill_main_boards()
+        with metrics.timer('tar_sync_phase_seconds', phase = 'fill_persons'):
+            self.fill_persons()
+        with metrics.timer('tar_sync_phase_seconds', phase = 'fill_main_boards'):
+            self.fill_main_boards()
+        with metrics.timer('tar_sync_phase_seconds', phase = 'flush'):
+            self.flush_database()
+
+
+    def warm_start(self):
+        #Запуск по сохраненной БД без полной загрузки из Trello: проверка целостности таблиц, команда из local_persons,
+        #агрегаты для страниц. Догоняющая синхронизация выполняется первым циклом фонового планировщика (start_sync):
+        #он перечитывает команду и заново связывает с карточками изменившихся участников (update_team_cards).
+        #Возвращает False, если БД пуста и нужна полная загрузка fill_database()
+        if len(self.local_boards) == 0 or len(self.local_persons) == 0:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] tar_database is empty, full fill required')
+            return False
+
+        with metrics.timer('tar_sync_phase_seconds', phase = 'warm_start'):
+            repaired = self.check_database()
+            self.backfill_card_movements()
+            self.team = self.build_team(self.local_persons.all())
+            self.refresh_aggregates()
+            self.flush_database()
+
+        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Warm start: {len(self.local_boards)} boards, {len(self.local_cards)} cards, {len(self.team)} persons, {sum(repaired.values())} rows repaired')
+        return True
+
+
+    def check_database(self):
+        #Проверка целостности сохраненной БД: повторяющиеся строки (после прежних повторных заполнений), лишние записи
+        #настроек и строки, ссылающиеся на отсутствующие доски и карточки, удаляются. Возвращает {проверка: число строк}
+        repaired = {'duplicates': 0, 'orphans': 0, 'worktime': 0}
+
+        #из повторов остается последняя вставленная строка
+        for table, key_fields in ((self.local_boards, ['board_id']),
+                                  (self.local_lists, ['list_id']),
+                                  (self.local_cards, ['card_id']),
+                                  (self.local_persons, ['person_id', 'person_fullname', 'status']),  #у участника может быть несколько карточек
+                                  (self.local_cards_has_persons, ['card_id', 'person_id']),
+                                  (self.card_movements, ['action_id'])):
+            keys = set()
+            duplicate_ids = []
+            for document in reversed(table.all()):
+                key = tuple(document.get(field) for field in key_fields)
+                if key in keys:
+                    duplicate_ids.append(document.doc_id)
+                keys.add(key)
+            if duplicate_ids:
+                repaired['duplicates'] += len(table.remove(doc_ids = duplicate_ids))
+
+        #настройки - одна запись
+        worktime_ids = [document.doc_id for document in self.worktime.all()]
+        if len(worktime_ids) > 1:
+            repaired['worktime'] += len(self.worktime.remove(doc_ids = worktime_ids[1:]))
+
+        #строки без доски или карточки
+        board_ids = {board['board_id'] for board in self.local_boards.all()}
+        for table in (self.local_lists, self.local_cards):
+            orphan_ids = [document.doc_id for document in table.all() if document.get('board_id') not in board_ids]
+            if orphan_ids:
+                repaired['orphans'] += len(table.remove(doc_ids = orphan_ids))
+
+        card_ids = {card['card_id'] for card in self.local_cards.all()}
+        orphan_ids = [document.doc_id for document in self.local_cards_has_persons.all() if document.get('card_id') not in card_ids]
+        if orphan_ids:
+            repaired['orphans'] += len(self.local_cards_has_persons.remove(doc_ids = orphan_ids))
+
+        if sum(repaired.values()) > 0:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] tar_database repaired: {repaired}')
+        return repaired
+
+
+    def flush_database(self):
+        #Запись накопленных изменений БД на диск
+        try:
+            self.db.flush()
+        except Exception as err:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to flush tar_database: {err}')
+
+
+    def close_database(self):
+        #Завершение фоновых отчетов, запись оставшихся изменений и закрытие БД
+        self.report_jobs.shutdown()
+        self.flush_database()
+        self.db.close()
 
     
     def update_database(self, update_on_change = False):
-        
-        time_format = "%H:%M:%S"
+        #Обновление локальной БД: либо один цикл синхронизации (update_on_change = True),
+        #либо запуск фонового планировщика sync_scheduler
+        if update_on_change:
+            return self.sync_cycle()
 
-        self.db.drop_table('persons')
-        self.fill_persons()
+        self.sync_scheduler.start()
 
-        update = True
 
-        while update:
+    def sync_cycle(self):
+        #Один цикл синхронизации: команда перечитывается перед сравнением досок (участники карточек сопоставляются
+        #с self.team). Доски сравниваются по множествам id, поэтому добавленные,
+        #удаленные и измененные доски обрабатываются в одном цикле. Возвращает статистику цикла
+        self.database_is_updating = True
+        api_calls_before = self.api_calls
+        stats = {'boards_added': 0, 'boards_deleted': 0, 'boards_updated': 0, 'team_changed': False}
+        team_before = dict(self.team)
 
-            self.database_is_updating = True
+        try:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Checking for updates...')
 
-            update_period_time = (time.strptime(self.get_update_period(), time_format))
-            update_period_seconds = timedelta(hours=update_period_time.tm_hour, minutes=update_period_time.tm_min, seconds=update_period_time.tm_sec).total_seconds()
+            with metrics.timer('tar_sync_phase_seconds', phase = 'update_persons'):
+                self.fill_persons()
+
+            #доски, история перемещений которых еще не загружена (или не загрузилась при запуске)
+            with metrics.timer('tar_sync_phase_seconds', phase = 'backfill_movements'):
+                self.backfill_card_movements()
+
+            with metrics.timer('tar_sync_phase_seconds', phase = 'list_boards'):
+                trello_boards = {board.id: board for board in self.trello_client.list_boards()}
+                local_boards = {board['board_id']: board for board in self.local_boards.all()}
+
+            with metrics.timer('tar_sync_phase_seconds', phase = 'add_boards'):
+                for board_id in trello_boards.keys() - local_boards.keys(): #в trello добавили доску
+                    self.add_board(board = trello_boards[board_id])
+                    stats['boards_added'] += 1
+
+            with metrics.timer('tar_sync_phase_seconds', phase = 'delete_boards'):
+                for board_id in local_boards.keys() - trello_boards.keys(): #в trello удалили доску
+                    self.delete_board(board_id = board_id, board_name = local_boards[board_id]['board_name'])
+                    stats['boards_deleted'] += 1
+
+            with metrics.timer('tar_sync_phase_seconds', phase = 'update_boards'):
+                for board_id in trello_boards.keys() & local_boards.keys(): #обновляем измененные доски
+                    if self.update_board(board = trello_boards[board_id]):
+                        stats['boards_updated'] += 1
+
+            #участники, добавленные в команду, удаленные или переименованные после прошлой загрузки, есть на карточках
+            #и неизмененных досок - их связи с карточками перестраиваются. При ошибке участники остаются в
+            #team_cards_pending и перестраиваются следующим циклом
+            self.team_cards_pending |= {person_id for person_id in team_before.keys() | self.team.keys() if team_before.get(person_id) != self.team.get(person_id)}
+            if self.team_cards_pending:
+                stats['team_changed'] = True
+                with metrics.timer('tar_sync_phase_seconds', phase = 'update_team_cards'):
+                    try:
+                        self.update_team_cards(self.team_cards_pending)
+                    except Exception as err:
+                        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Failed to update cards of {len(self.team_cards_pending)} team members: {err}')
+                    else:
+                        self.team_cards_pending = set()
 
-            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Checking for updates...')
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Checking for updates finished')
+        finally:
+            stats['boards_touched'] = stats['boards_added'] + stats['boards_deleted'] + stats['boards_updated']
+            stats['api_calls'] = self.api_calls - api_calls_before
+            with metrics.timer('tar_sync_phase_seconds', phase = 'flush'):
+                self.flush_database()
+            self.database_is_updating = False
 
-            trello_boards = self.trello_client.list_boards()
-            local_boards = self.local_boards.all()
+        return stats
 
-            if len(trello_boards) > len(local_boards): #в trello добавили доску
-                #ищем какую
-                tempBoards = []
 
-                for board in local_boards:
-                    tempBoards.append(board['board_id'])   
+    def start_sync(self):
+        #Запуск фоновой синхронизации
+        self.sync_scheduler.start()
 
-                for board in trello_boards:
-                    if board.id not in tempBoards: #новая доска обнаружена
-                        self.add_board(board = board)
-            
-                print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Checking for updates finished')
 
-            elif len(trello_boards) < len(local_boards): #в trello удалили доску
-                #ищем какую
-                tempBoards = []
+    def stop_sync(self, timeout = None):
+        #Остановка фоновой синхронизации
+        self.sync_scheduler.stop(timeout = timeout)
 
-                for board in trello_boards:
-                    tempBoards.append(board.id)   
 
-                for board in local_boards:
-                    if board['board_id'] not in tempBoards: #новая доска обнаружена
-                        self.delete_board(board_id = board['board_id'], board_name = board['board_name'])
-                
-                print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Checking for updates finished')
+    def trigger_sync(self):
+        #Внеочередной цикл синхронизации
+        if self.sync_scheduler.is_running():
+            self.sync_scheduler.trigger_now()
+        else:
+            self.sync_scheduler.run_cycle()
 
-            else: #обновляем все доски. Новых / удаленных не обнаружено
-                for board in trello_boards:
-                    self.update_board(board = board)
-                
-                print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Checking for updates finished')
 
-                if not update_on_change:
-                    time.sleep(update_period_seconds)
-                    
-                    self.database_is_updating = False
+    def get_request_stats(self):
+        #Статистика планировщика запросов к Trello: очередь, время ожидания лимита, повторы, объединенные запросы
+        return self.request_scheduler.get_stats()
 
-            
+
+    def get_http_stats(self):
+        #Статистика пула соединений с Trello: запросов, открыто и переиспользовано соединений, среднее время запроса
+        if not hasattr(self.http_session, 'get_stats'):
+            return {}
+        return self.http_session.get_stats()
+
+
+    def get_sync_stats(self):
+        #Статистика последних циклов синхронизации: длительность, затронутые доски, запросы к Trello
+        return self.sync_scheduler.get_stats()
+
+
+    def count_api_calls(self, fetch_json):
+        #Обертка fetch_json клиента Trello, считающая запросы к API; в метрики пишутся число запросов,
+        #ошибок и время ответа по операциям (метод и путь запроса без идентификаторов)
+        def counted_fetch_json(uri_path, *args, **kwargs):
+            with self.api_calls_lock:
+                self.api_calls += 1
+            operation = trello_operation(kwargs.get('http_method', args[0] if args else 'GET'), uri_path)
+            metrics.inc('tar_trello_requests_total', operation = operation)
+            try:
+                with metrics.timer('tar_trello_request_seconds', operation = operation):
+                    return fetch_json(uri_path, *args, **kwargs)
+            except Exception:
+                metrics.inc('tar_trello_errors_total', operation = operation)
+                raise
+        return counted_fetch_json
+
+
+    def get_metrics(self):
+        #Метрики в текстовом формате Prometheus (см. tarmetrics.py); состояние пула соединений снимается в момент запроса
+        http_stats = self.get_http_stats()
+        if http_stats:
+            metrics.set_gauge('tar_trello_connections', http_stats['connections'], state = 'opened')
+            metrics.set_gauge('tar_trello_connections', http_stats['idle_connections'], state = 'idle')
+            metrics.set_gauge('tar_trello_connections', http_stats['reused'], state = 'reused')
+        return metrics.render()
+
+
+    def refresh_board_aggregates(self, board_id):
+        #Пересчет агрегатов одной доски по локальным таблицам
+        self.aggregates.set_board(board_id, self.local_cards.find(board_id = str(board_id)), self.local_cards_has_persons.find(board_id = str(board_id)))
 
 
+    def refresh_aggregates(self):
+        #Пересчет агрегатов всех досок (при запуске по сохраненной БД)
+        self.aggregates.clear()
+        for board in self.local_boards.all():
+            self.refresh_board_aggregates(board['board_id'])
+
 
     def get_persons_active_tasks(self, person_id, active_list_name = 'В Работе'):
-        query_result = self.local_cards_has_persons.search((where('person_id') == str(person_id)) & (where('list_name') == str(active_list_name)))
-        return len(query_result)
+        return self.aggregates.person_list_count(str(person_id), str(active_list_name))
 
 
     # !!!!! Изменить чтоб читал пользователей доски, возможно вернуть board_has_persons
     def get_project_members(self, board_id):
-        temp_persons = []
-        board_persons = []
-        query_result = self.local_cards_has_persons.search(where('board_id') == str(board_id))
-        for result in query_result:
-            if result['person_id'] not in temp_persons:
-                temp_persons.append(result['person_id'])
-                board_persons.append({'person_id': result['person_id'], 'person_name': result['person_name']})
-        return board_persons
+        return [{'person_id': person_id, 'person_name': person_name} for person_id, person_name in self.aggregates.members(str(board_id))]
 
 
     def get_tasks_on_board(self, board_id, list_name = 'В работе'):
+        #Задачи списка доски из представления карточек (BoardAggregates.board_tasks) одним обращением;
+        #card_in_work_time - рабочее время с момента входа карточки в текущий список
         tasks = []
-        query_result = self.local_cards.search(where('board_id') == str(board_id))
-        for result in query_result:
-
-            if result['list_name'] == list_name:
-
-                query_result_ = self.local_cards_has_persons.search(where('list_id') == str(result['list_id']))
-                for result_ in query_result_:
-                    if result_['card_name'] == result['card_name']:
-                        task = {'task_name': result['card_name'], 'task_member': result_['person_name'], 'card_in_work_time': result['card_in_work_time']}
-                        tasks.append(task)
-                        break
+        now = self.unify_time(datetime.now(timezone.utc))
+        for card in self.aggregates.tasks(str(board_id), str(list_name)):
+            if len(card['members']) > 0:
+                card_in_work_time = ''
+                if card['list_entered']:
+                    card_in_work_time = str(self.filter_work_hours(self.unify_time(self.parse_trello_date(card['list_entered'])), now))
+                task = {'task_name': card['card_name'], 'task_member': card['members'][0], 'card_in_work_time': card_in_work_time}
+                tasks.append(task)
 
         return tasks
 
 
     def get_lists_by_board_id(self, board_id):
-        query_result = self.local_lists.search((where('board_id') == str(board_id)))
+        query_result = self.local_lists.find(board_id = str(board_id))
         return query_result
 
 
     def get_active_tasks_by_person(self, person_id):
-        query_result = self.local_cards_has_persons.search((where('person_id') == str(person_id)) & ((where('list_name') == str('В Работе'))))
+        query_result = self.local_cards_has_persons.find(person_id = str(person_id), list_name = str('В Работе'))
         return query_result
 
 
     def get_curr_stage_percent(self, board_id, board_template):
-        tasks_planned = self.local_cards.search((where('board_id') == str(board_id)) & (where('list_name') == str('Комплекс задач')))
-        tasks_in_progress = self.local_cards.search((where('board_id') == str(board_id)) & (where('list_name') == str('В Работе')))
-        tasks_on_hold = self.local_cards.search((where('board_id') == str(board_id)) & (where('list_name') == str('Согласование Выполнения')))
-        tasks_done = self.local_cards.search((where('board_id') == str(board_id)) & (where('list_name') == str('Завершены')))
+        tasks_planned = self.aggregates.list_count(str(board_id), 'Комплекс задач')
+        tasks_in_progress = self.aggregates.list_count(str(board_id), 'В Работе')
+        tasks_on_hold = self.aggregates.list_count(str(board_id), 'Согласование Выполнения')
+        tasks_done = self.aggregates.list_count(str(board_id), 'Завершены')
 
-        if (len(tasks_planned) + len(tasks_in_progress) + len(tasks_on_hold) + len(tasks_done)) == 0:
+        if (tasks_planned + tasks_in_progress + tasks_on_hold + tasks_done) == 0:
             return 0
         else:
-            return round((len(tasks_done) / (len(tasks_planned) + len(tasks_in_progress) + len(tasks_on_hold) + len(tasks_done))) * 100.0)
+            return round((tasks_done / (tasks_planned + tasks_in_progress + tasks_on_hold + tasks_done)) * 100.0)
 
 
     def create_new_project(self, project_template, project_name = 'Новый проект', project_description = ''):        
@@ -405,7 +1058,7 @@ class TarDriver:
 
             
     def get_workhours(self):
-        return self.worktime.get(where('work_day_starts') != None)
+        return self.work_calendar.settings
 
 
     def set_lunch_hours(self, lunch_hours = ['13:00:00', '14:00:00']):
@@ -430,26 +1083,30 @@ class TarDriver:
 
 
     def get_lunch_hours(self):
-        return self.worktime.get(where('lunch_hours_starts') != None)
+        return self.work_calendar.settings
 
 
     def calculate_work_hours(self):
-        format_ = '%H:%M:%S'
-        str_work_day_duration = self.worktime.get(where('work_day_duration') != None)['work_day_duration']
-        str_lunch_duration = self.worktime.get(where('lunch_duration') != None)['lunch_duration']
-        
-        time_work_day_duration = datetime.strptime(str_work_day_duration, format_).time()
-        time_lunch_duration = datetime.strptime(str_lunch_duration, format_).time()
-        
-        day_work_hours = timedelta(hours = time_work_day_duration.hour, minutes = time_work_day_duration.minute, seconds = time_work_day_duration.second) \
-                                            - timedelta(hours = time_lunch_duration.hour, minutes = time_lunch_duration.minute, seconds = time_lunch_duration.second)
-                
-        self.worktime.update({ 'day_work_hours': str(day_work_hours)})
+        #Пересчет производных полей worktime и пересборка рабочего календаря
+        calendar = WorkCalendar.from_worktime(self.worktime.all()[0])
+
+        self.worktime.update({ 'day_work_hours': str(timedelta(seconds = calendar.base_day_seconds))})
+        self.worktime.update({ 'week_work_hours': str(timedelta(seconds = calendar.week_seconds))})
+
+        self.refresh_work_calendar()
+
 
-        work_days = self.worktime.get(where('work_days') != None)['work_days']
+    def refresh_work_calendar(self):
+        #Сборка рабочего календаря из таблицы worktime. Версия увеличивается при каждом изменении настроек
+        version = self.work_calendar.version + 1 if hasattr(self, 'work_calendar') else 0
+        self.work_calendar = WorkCalendar.from_worktime(self.worktime.all()[0], version = version)
 
-        week_work_hours = timedelta(seconds = int(work_days) * day_work_hours.total_seconds())
-        self.worktime.update({ 'week_work_hours': str(week_work_hours)})
+        #отчеты, посчитанные по прежнему календарю, больше не нужны
+        if hasattr(self, 'report_cache'):
+            self.report_cache.invalidate()
+
+        #настройки пользователя сразу сохраняются на диск
+        self.flush_database()
 
 
     def is_integer(self, n):
@@ -464,18 +1121,94 @@ class TarDriver:
     def set_workdays(self, workdays = '5'):
         if self.is_integer(workdays):
             if (int(workdays) >= 1) and (int(workdays) <= 7):
-                self.worktime.update({'work_days': str(workdays)})
+                self.worktime.update({'work_days': str(int(float(workdays)))})
+                self.calculate_work_hours()
         else:
             print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] workdays not a number')
 
 
     def get_workdays(self):
         try:
-            return ((self.worktime.get(where('work_days') != None))['work_days'])
+            return self.work_calendar.settings['work_days']
         except:
             return '--:--'
 
 
+    def set_first_weekday(self, first_weekday = '0'):
+        #Первый день недели: 0 - понедельник, 6 - воскресенье
+        if self.is_integer(first_weekday):
+            if (int(first_weekday) >= 0) and (int(first_weekday) <= 6):
+                self.worktime.update({'first_weekday': str(int(float(first_weekday)))})
+                self.calculate_work_hours()
+        else:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] first weekday not a number')
+
+
+    def get_first_weekday(self):
+        return self.work_calendar.settings.get('first_weekday', '0')
+
+
+    def parse_dates(self, dates):
+        #Список дат 'ГГГГ-ММ-ДД' из строки через запятую или из списка
+        format_ = '%Y-%m-%d'
+        if isinstance(dates, str):
+            dates = dates.split(',')
+
+        return sorted({str(datetime.strptime(date_.strip(), format_).date()) for date_ in dates if date_.strip()})
+
+
+    def set_holidays(self, holidays = []):
+        #Праздничные (нерабочие) даты
+        try:
+            holidays = self.parse_dates(holidays)
+        except Exception as err:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] {err}')
+        else:
+            self.worktime.update({'holidays': holidays})
+            self.refresh_work_calendar()
+
+
+    def get_holidays(self):
+        return ', '.join(self.work_calendar.settings.get('holidays', []))
+
+
+    def set_workday_exceptions(self, workday_exceptions = []):
+        #Рабочие даты вне обычной рабочей недели (например, перенесенные рабочие субботы)
+        try:
+            workday_exceptions = self.parse_dates(workday_exceptions)
+        except Exception as err:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] {err}')
+        else:
+            self.worktime.update({'workday_exceptions': workday_exceptions})
+            self.refresh_work_calendar()
+
+
+    def get_workday_exceptions(self):
+        return ', '.join(self.work_calendar.settings.get('workday_exceptions', []))
+
+
+    def set_weekday_schedule(self, weekday, workhours = ['09:00:00', '18:00:00'], lunch_hours = ['13:00:00', '14:00:00']):
+        #Отдельный график для дня недели (0 - понедельник). Пустой workhours убирает отдельный график
+        format_ = '%H:%M:%S'
+        weekday_schedules = dict(self.work_calendar.settings.get('weekday_schedules', {}))
+
+        if not workhours:
+            weekday_schedules.pop(str(weekday), None)
+        else:
+            try:
+                hours = [str(datetime.strptime(value, format_).time()) for value in list(workhours) + list(lunch_hours)]
+            except Exception as err:
+                print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] {err}')
+                return
+            else:
+                if not ((hours[0] < hours[1]) and (hours[2] <= hours[3])):
+                    return
+                weekday_schedules[str(weekday)] = hours
+
+        self.worktime.update({'weekday_schedules': weekday_schedules})
+        self.calculate_work_hours()
+
+
     def set_database_update_period(self, update_period = '01:00:00'):
         format_ = '%H:%M:%S'
         try:
@@ -484,11 +1217,12 @@ class TarDriver:
             pass
         else:     
             self.worktime.update({ 'update_period': str(update_period)})
+            self.refresh_work_calendar()
 
 
     def get_update_period(self):
         try:
-            return ((self.worktime.get(where('update_period') != None))['update_period'])
+            return self.work_calendar.settings['update_period']
         except:
             return '--:--'
 
@@ -498,230 +1232,543 @@ class TarDriver:
 
 
     def filter_work_hours(self, start_date, end_date):
-        time_format = "%H:%M:%S"
-        
-        result_time = timedelta(hours=0, minutes=0, seconds=0)
-        calculated_end_time = timedelta(hours=0, minutes=0, seconds=0)
-        twelve_hours_delta = timedelta(hours=12, minutes=0)
-        twenty_four_hours_delta = timedelta(hours=23, minutes=59, seconds=59)
-
-        work_day_starts = self.worktime.get(where('work_day_starts') != None)['work_day_starts']
-        work_day_ends = self.worktime.get(where('work_day_ends') != None)['work_day_ends']
-        lunch_starts = self.worktime.get(where('lunch_hours_starts') != None)['lunch_hours_starts']
-        lunch_ends = self.worktime.get(where('lunch_hours_ends') != None)['lunch_hours_ends']
-        day_work_hours = self.worktime.get(where('day_work_hours') != None)['day_work_hours']
-
-        work_day_starts = datetime.strptime(work_day_starts, time_format).time()
-        work_day_ends = datetime.strptime(work_day_ends, time_format).time()
-        lunch_starts = datetime.strptime(lunch_starts, time_format).time()
-        lunch_ends = datetime.strptime(lunch_ends, time_format).time()
-        day_work_hours = datetime.strptime(day_work_hours, time_format).time()
-
-        while start_date <= end_date: 
-            till_the_end_of_he_day_delta = twenty_four_hours_delta - timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)
-            calculated_end_time =  (start_date + till_the_end_of_he_day_delta)
-
-            if calculated_end_time >= end_date:
-                if calculated_end_time.time() > end_date.time():
-                    calculated_end_time = end_date
-
-            if start_date.weekday() < 5: #этот день не выходной // сделать параметром чтоб менять первый день недели
-                if (calculated_end_time.time() < work_day_starts):#промежуток кончился раньше рабочего дня
-                    pass
-
-                elif (calculated_end_time.time() > work_day_starts) and (calculated_end_time.time() <= lunch_starts):#промежуток кончился после начала рабочего дня но раньше обеда:
-                    
-                    if start_date.time() <= work_day_starts:
-                        result_time += timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
-                                                    timedelta(hours=work_day_starts.hour, minutes=work_day_starts.minute, seconds=work_day_starts.second)
+        #Рабочее время в промежутке [start_date, end_date] по рабочему календарю (без обращений к БД)
+        return timedelta(seconds = self.work_calendar.work_seconds(start_date, end_date))
 
-                    else:
-                        result_time += timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
-                                                    timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)
-
-                elif (calculated_end_time.time() > lunch_starts) and (calculated_end_time.time() < lunch_ends):#промежуток кончился после начала обеда но раньше конца обеда:
-                    if start_date.time() <= work_day_starts:
-                        result_time += timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
-                                                    timedelta(hours=work_day_starts.hour, minutes=work_day_starts.minute, seconds=work_day_starts.second)
-
-                    elif (start_date.time() > work_day_starts) and (start_date.time() < lunch_starts):
-                        result_time += timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
-                                                    timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)
-
-                    elif (start_date.time() >= lunch_starts):
-                        pass
-
-                elif (calculated_end_time.time() >= lunch_ends) and (calculated_end_time.time() < work_day_ends):#промежуток кончился после конца обеда но раньше конца дня
-                    if start_date.time() <= work_day_starts:
-                        result_time += (timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
-                                                    timedelta(hours=work_day_starts.hour, minutes=work_day_starts.minute, seconds=work_day_starts.second)) + \
-                                                    (timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
-                                                    timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second))
-
-                    elif (start_date.time() > work_day_starts) and (start_date.time() < lunch_starts):
-                        result_time += (timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
-                                                    timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)) + \
-                                                    (timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
-                                                    timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second))     
-
-                    elif (start_date.time() >= lunch_starts) and (start_date.time() < lunch_ends):
-                        result_time += (timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
-                                        timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second)) 
-
-                    elif (start_date.time() >= lunch_ends):
-                        result_time += (timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
-                                        timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)) 
-
-                elif (calculated_end_time.time() >= work_day_ends):#промежуток кончился позже рабочего дня
-                    if start_date.time() <= work_day_starts:
-                        result_time += timedelta(hours=day_work_hours.hour, minutes=day_work_hours.minute, seconds=day_work_hours.second)
-                    
-                    elif (start_date.time() > work_day_starts) and (start_date.time() < lunch_starts):
-                        result_time += (timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
-                                                    timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)) + \
-                                                    (timedelta(hours=work_day_ends.hour, minutes=work_day_ends.minute, seconds=work_day_ends.second) - \
-                                                    timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second))  
-                    
-                    elif (start_date.time() >= lunch_starts) and (start_date.time() < lunch_ends):
-                        result_time += (timedelta(hours=work_day_ends.hour, minutes=work_day_ends.minute, seconds=work_day_ends.second) - \
-                                        timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second))
-
-                    elif (start_date.time() >= lunch_ends) and (start_date.time() <= work_day_ends):
-                        result_time += (timedelta(hours=work_day_ends.hour, minutes=work_day_ends.minute, seconds=work_day_ends.second) - \
-                                        timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second))
-
-                    elif (start_date.time() > work_day_ends):
-                        pass
-
-            start_date += (till_the_end_of_he_day_delta + timedelta(minutes=1))
-
-        return result_time
 
-    
-    def filter_reports_time(self, start_date, end_date, disable_filter = False):
-        
+    def get_filter_dates(self, filter_dates = None):
+        #Границы отчетного периода (filter_dates или общий self.filter_dates) в локальном времени (local_timezone)
+        if filter_dates is None:
+            filter_dates = self.filter_dates
         datetime_format = "%Y-%m-%d %H:%M:%S"
-        filter_start_date = self.unify_time(datetime.strptime(self.filter_dates[0], datetime_format))
-        filter_end_date = self.unify_time(datetime.strptime(self.filter_dates[1], datetime_format))
+        filter_start_date = self.local_timezone.localize(datetime.strptime(filter_dates[0], datetime_format))
+        filter_end_date = self.local_timezone.localize(datetime.strptime(filter_dates[1], datetime_format))
+        return filter_start_date, filter_end_date
 
-        result_time = timedelta(hours=0, minutes=0, seconds=0)
 
-        if not disable_filter:
+    def filter_work_hours_batch(self, intervals, disable_filter = False, filter_dates = None):
+        #Рабочее время (в секундах) сразу для всех промежутков [(start_date, end_date), ...] отчета.
+        #Промежутки обрезаются по отчетному периоду (get_filter_dates), затем считаются одним векторным проходом
+        #рабочего календаря по префиксным суммам рабочих секунд каждого дня отчетного окна
+        if len(intervals) == 0:
+            return np.zeros(0, dtype=np.int64)
 
-            #1
-            if (start_date < filter_start_date) and (end_date < filter_start_date):
-                return result_time
-            #2
-            elif (start_date < filter_start_date) and ((end_date > filter_start_date) and (end_date < filter_end_date)):
-                start_date = filter_start_date
-
-                return self.filter_work_hours(start_date = start_date, end_date = end_date)
-            #3
-            elif (start_date < filter_start_date) and (end_date > filter_end_date):
-                start_date = filter_start_date
-                end_date = filter_end_date
-
-                return self.filter_work_hours(start_date = start_date, end_date = end_date)
-            #4
-            elif ((start_date > filter_start_date) and (start_date < filter_end_date)) and (end_date < filter_end_date):
-                self.filter_work_hours(start_date = start_date, end_date = end_date)
-            #5
-            elif ((start_date > filter_start_date) and (start_date < filter_end_date)) and (end_date > filter_end_date):
-                end_date = filter_end_date
-
-                return self.filter_work_hours(start_date = start_date, end_date = end_date)
-            #6
-            elif (start_date > filter_end_date):
-                return result_time
-        
-        else:
-            #print("filter enabled!")
-            return self.filter_work_hours(start_date = start_date, end_date = end_date)
+        #настенное (локальное) время промежутков с точностью до секунды: моменты UTC плюс смещение часового пояса,
+        #без перевода каждой даты через pytz
+        starts = self.to_local_seconds(np.fromiter((start_date.timestamp() for start_date, _ in intervals), dtype=np.float64, count=len(intervals)))
+        ends = self.to_local_seconds(np.fromiter((end_date.timestamp() for _, end_date in intervals), dtype=np.float64, count=len(intervals)))
 
+        if not disable_filter:
+            filter_start_date, filter_end_date = self.get_filter_dates(filter_dates)
+            starts = np.maximum(starts, np.datetime64(filter_start_date.replace(tzinfo=None), 's'))
+            ends = np.minimum(ends, np.datetime64(filter_end_date.replace(tzinfo=None), 's'))
+
+        return self.work_calendar.work_seconds_batch(starts, ends)
 
-    def get_card_stats_by_lists(self, card, disable_filter = False):
     
-        board = self.trello_client.get_board(board_id = card.board_id)
-        lists = board.list_lists()
-        time_in_lists = {list_.id: {"time":timedelta(minutes=0)} for list_ in lists}
+    def to_local_seconds(self, timestamps):
+        #Моменты (секунды UTC от эпохи) в настенное время local_timezone (datetime64[s]) одним векторным проходом:
+        #смещение от UTC берется из таблицы переходов часового пояса pytz двоичным поиском
+        if self.timezone_transitions is None:
+            transition_times = getattr(self.local_timezone, '_utc_transition_times', None)
+            if transition_times:
+                self.timezone_transitions = (np.array(transition_times, dtype='datetime64[s]').astype(np.int64),
+                                             np.array([int(info[0].total_seconds()) for info in self.local_timezone._transition_info], dtype=np.int64))
+            else:
+                self.timezone_transitions = (np.zeros(1, dtype=np.int64),
+                                             np.array([int(self.local_timezone.utcoffset(datetime(2000, 1, 1)).total_seconds())], dtype=np.int64))
+
+        transition_seconds, offsets = self.timezone_transitions
+        seconds = np.floor(timestamps).astype(np.int64)
+        transition_index = np.maximum(np.searchsorted(transition_seconds, seconds, side='right') - 1, 0)
+        return (seconds + offsets[transition_index]).astype('datetime64[s]')
+
+
+    def filter_reports_time(self, start_date, end_date, disable_filter = False, filter_dates = None):
+        #Рабочее время промежутка, обрезанного по отчетному периоду (get_filter_dates)
+        if not disable_filter:
+            filter_start_date, filter_end_date = self.get_filter_dates(filter_dates)
+
+            start_date = max(start_date, filter_start_date)
+            end_date = min(end_date, filter_end_date)
+
+        if start_date >= end_date:
+            return timedelta(hours=0, minutes=0, seconds=0)
+
+        return self.filter_work_hours(start_date = self.unify_time(start_date), end_date = self.unify_time(end_date))
+
+
+    def load_board_metadata(self, board_id):
+        #Загрузка метаданных доски для кэша: из локальных таблиц, а если доски там нет - из Trello
+        query_result = self.local_boards.find_one(board_id = str(board_id))
+        lists_query = self.local_lists.find(board_id = str(board_id))
+
+        if len(lists_query) > 0:
+            board_name = query_result['board_name'] if query_result is not None else lists_query[0]['board_name']
+            return board_name, {list_['list_id']: list_['list_name'] for list_ in lists_query}
+
+        board = self.trello_client.get_board(board_id = board_id)
+        return board.name, {list_.id: list_.name for list_ in board.list_lists(list_filter = 'all')}
+
+
+    def get_card_intervals(self, card):
+        #Промежутки пребывания карточки в списках по истории из Trello: [(list_id, start_date, end_date), ...]
+        movements = [(movement['datetime'], movement['source']['id'], movement['destination']['id']) for movement in card.list_movements()]
+        return self.build_card_intervals(card.list_id, card.created_date, movements)
 
-        ordered_list_movements = sorted(card.list_movements(), key=itemgetter("datetime"))
+
+    def get_local_card_intervals(self, card_id):
+        #Те же промежутки по локальным таблицам cards и card_movements, без запросов к Trello.
+        #None - карточки нет в локальной БД или история перемещений ее доски не загружена (нет строк - не значит "не перемещалась")
+        card_row = self.local_cards.find_one(card_id = str(card_id))
+        if card_row is None or not self.is_movements_loaded(card_row['board_id']):
+            return None
+
+        created_date = self.unify_time(datetime.fromtimestamp(int(str(card_id)[0:8], 16), timezone.utc))
+        movements = [(self.parse_trello_date(row['movement_date']), row['list_before_id'], row['list_after_id']) for row in self.card_movements.find(card_id = str(card_id))]
+        return self.build_card_intervals(card_row['list_id'], created_date, movements)
+
+
+    def build_card_intervals(self, list_id, created_date, movements):
+        #Промежутки по текущему списку, дате создания и перемещениям [(дата, из списка, в список), ...]
+        intervals = []
+        ordered_list_movements = sorted(movements, key=itemgetter(0))
 
         if len(ordered_list_movements) == 0:
+            intervals.append((list_id, created_date, self.unify_time(datetime.now())))
+            return intervals
 
-            time_in_lists[card.list_id]['time'] += self.filter_reports_time(start_date = card.created_date, end_date = self.unify_time(datetime.now()), disable_filter = disable_filter) #!!!!!!!
-        
-        elif len(ordered_list_movements) == 1:
-            time_start = card.created_date
-            time_end = self.unify_time(ordered_list_movements[0]['datetime'])
-            list_id = ordered_list_movements[0]['source']['id']
+        time_start = created_date
+        for movement_date, source_id, _ in ordered_list_movements:
+            time_end = self.unify_time(movement_date)
+            intervals.append((source_id, time_start, time_end))
+            time_start = time_end
+
+        intervals.append((ordered_list_movements[-1][2], time_start, self.unify_time(datetime.now())))
+
+        return intervals
+
+
+    def get_card_stats_by_lists(self, card, disable_filter = False):
+    
+        lists = self.board_cache.get_lists(card.board_id)
+        time_in_lists = {list_id: {"time":timedelta(minutes=0)} for list_id in lists}
+
+        card_intervals = self.get_local_card_intervals(card.id)
+        if card_intervals is None:
+            card_intervals = self.get_card_intervals(card = card)
+        work_seconds = self.filter_work_hours_batch(intervals = [(start_date, end_date) for _, start_date, end_date in card_intervals], disable_filter = disable_filter)
 
-            time_in_lists[list_id]['time'] += self.filter_reports_time(start_date = time_start, end_date = time_end, disable_filter = disable_filter)
+        for (list_id, _, _), seconds in zip(card_intervals, work_seconds):
+            #перемещения могут ссылаться на списки, которых на доске уже нет (карточка перенесена с другой доски)
+            time_in_lists.setdefault(list_id, {"time":timedelta(minutes=0)})['time'] += timedelta(seconds=int(seconds))
 
-            time_start = self.unify_time(ordered_list_movements[0]['datetime'])
-            time_end = self.unify_time(datetime.now())
-            list_id = ordered_list_movements[0]['destination']['id']
+        return time_in_lists
 
-            time_in_lists[list_id]['time'] += self.filter_reports_time(start_date = time_start, end_date = time_end, disable_filter = disable_filter)
 
+    def fetch_card_intervals(self, card_id):
+        #Запрос одной карточки и ее истории перемещений. Ошибка не пробрасывается, а возвращается вместе с результатом,
+        #чтобы сбой одной карточки не прерывал построение всего отчета
+        try:
+            card = self.trello_client.get_card(card_id = card_id)
+            card_intervals = self.get_card_intervals(card = card)
+        except Exception as err:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR]: card {card_id}: {err}')
+            return card_id, [], err
+        else:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG]: got card {card.name, card_id}')
+            return card_id, card_intervals, None
+
+
+    def fetch_cards_intervals(self, card_ids, progress = None, workers = None):
+        #Промежутки карточек: из локальной истории перемещений, а карточки, которых нет в локальной БД
+        #(или история перемещений их доски не загружена), -
+        #параллельным запросом к Trello пулом из workers (по умолчанию self.report_workers) потоков.
+        #Результат [(card_id, промежутки, ошибка), ...] идет в том же порядке, что и card_ids.
+        #progress(обработано, всего) вызывается после каждой карточки
+        card_ids = list(card_ids)
+        workers = self.report_workers if workers is None else max(1, int(workers))
+
+        results = {}
+        for card_id in card_ids:
+            card_intervals = self.get_local_card_intervals(card_id)
+            if card_intervals is not None:
+                results[card_id] = (card_id, card_intervals, None)
+                if progress is not None:
+                    progress(len(results), len(card_ids))
+
+        missing_card_ids = [card_id for card_id in card_ids if card_id not in results]
+
+        if workers == 1 or len(missing_card_ids) <= 1:
+            for card_id in missing_card_ids:
+                results[card_id] = self.fetch_card_intervals(card_id)
+                if progress is not None:
+                    progress(len(results), len(card_ids))
         else:
+            with ThreadPoolExecutor(max_workers = min(workers, len(missing_card_ids))) as executor:
+                for result in executor.map(self.fetch_card_intervals, missing_card_ids):
+                    results[result[0]] = result
+                    if progress is not None:
+                        progress(len(results), len(card_ids))
 
-            for change_index in range(0, len(ordered_list_movements)):
-                list_id = ordered_list_movements[change_index]['source']['id']
+        return [results[card_id] for card_id in card_ids]
 
-                if change_index == 0:
 
-                    time_in_lists[list_id]['time'] += self.filter_reports_time(start_date = card.created_date, end_date = self.unify_time(ordered_list_movements[change_index]['datetime']), disable_filter = disable_filter)
-                    
-                elif change_index > 0:
+    def get_cards_time_by_lists(self, card_ids, disable_filter = False, filter_dates = None, progress = None):
+        #Рабочее время каждой карточки во всех ее списках за один проход: {card_id: {list_id: секунды}}.
+        #Каждая карточка и ее история перемещений запрашиваются из Trello ровно один раз,
+        #рабочее время всех промежутков считается одним вызовом filter_work_hours_batch
+        with metrics.timer('tar_report_stage_seconds', stage = 'card_intervals'):
+            card_results = self.fetch_cards_intervals(card_ids = card_ids, progress = progress)
+        return self.compute_cards_time(card_results, disable_filter = disable_filter, filter_dates = filter_dates)
 
-                    time_start = ordered_list_movements[change_index - 1]['datetime']
-                    time_end = ordered_list_movements[change_index]['datetime']
 
-                    time_in_lists[list_id]['time'] += self.filter_reports_time(start_date = self.unify_time(time_start), end_date = self.unify_time(time_end), disable_filter = disable_filter)
+    def compute_cards_time(self, card_results, disable_filter = False, filter_dates = None):
+        #Рабочее время карточек по результатам fetch_cards_intervals: {card_id: {list_id: секунды}}.
+        #Карточки, которые не удалось получить, в результат не попадают
+        card_ranges = []
+        intervals = []
 
-                    if change_index + 1 == len(ordered_list_movements):
+        for card_id, card_intervals, error in card_results:
+            if error is None:
+                card_ranges.append((card_id, len(intervals), len(intervals) + len(card_intervals)))
+                intervals.extend(card_intervals)
 
-                        time_start = ordered_list_movements[change_index]['datetime']
-                        time_end = datetime.now()
+        with metrics.timer('tar_report_stage_seconds', stage = 'work_hours'):
+            work_seconds = self.filter_work_hours_batch(intervals = [(start_date, end_date) for _, start_date, end_date in intervals], disable_filter = disable_filter, filter_dates = filter_dates)
 
-                        list_id = ordered_list_movements[change_index]['destination']['id']
-                        time_in_lists[list_id]['time'] += self.filter_reports_time(start_date = self.unify_time(time_start), end_date = self.unify_time(time_end), disable_filter = disable_filter)
+        cards_time = {}
+        for card_id, first_interval, last_interval in card_ranges:
+            card_time = cards_time.setdefault(card_id, {})
+            for index in range(first_interval, last_interval):
+                list_id = intervals[index][0]
+                card_time[list_id] = card_time.get(list_id, 0) + int(work_seconds[index])
 
-        return time_in_lists
+        return cards_time
+
+
+    def get_report_key(self, board_id, lists, members, filter_dates = None):
+        #Ключ кэша отчета: параметры запроса, версия рабочего календаря и отметка синхронизации доски
+        if filter_dates is None:
+            filter_dates = self.filter_dates
+        board_row = self.local_boards.find_one(board_id = str(board_id)) or {}
+        return (str(board_id), tuple(lists), tuple(members), tuple(filter_dates), self.work_calendar.version,
+                board_row.get('board_last_modified'), board_row.get('board_last_action'))
+
+
+    def get_team_report_key(self, board_ids, list_names, members, filter_dates = None):
+        #Ключ кэша сводного отчета: первый элемент 'team', вторым идут доски (по ним ReportCache.invalidate
+        #сбрасывает запись при синхронизации любой из досок), в конце - отметки синхронизации всех досок
+        if filter_dates is None:
+            filter_dates = self.filter_dates
+        watermarks = []
+        for board_id in board_ids:
+            board_row = self.local_boards.find_one(board_id = str(board_id)) or {}
+            watermarks.append((board_row.get('board_last_modified'), board_row.get('board_last_action')))
+        return ('team', tuple(str(board_id) for board_id in board_ids), tuple(list_names), tuple(members), tuple(filter_dates),
+                self.work_calendar.version, tuple(watermarks))
+
+
+    def get_report_cache_stats(self):
+        return self.report_cache.get_stats()
 
 
     def get_project_report(self, board_id, lists, members):
-        self.db.drop_table('report')
+        report_key = self.get_report_key(board_id, lists, members)
+        report_lines = self.report_cache.get(report_key)
+
+        if report_lines is None:
+            with metrics.timer('tar_report_stage_seconds', stage = 'build'):
+                report_lines, complete = self.build_project_report(board_id, lists, members)
+            #отчет, в котором не удалось получить часть карточек, не кэшируется
+            if complete:
+                self.report_cache.put(report_key, report_lines)
+        elif report_key == self.report_key:
+            #в таблице report уже этот отчет
+            return
+
+        with metrics.timer('tar_report_stage_seconds', stage = 'report_table'):
+            self.report.truncate()
+            self.report.insert_multiple(report_lines)
+            self.report_key = report_key
+            self.flush_database()
+
+
+    def build_project_report(self, board_id, lists, members, filter_dates = None, progress = None):
+        #Строки отчета и признак того, что из Trello получены все карточки
+        #Карточки выбранных участников: уникальный набор карточек определяется один раз
+        members_cards = {}
+        card_ids = []
+        for member_id in members:
+            members_cards[member_id] = self.local_cards_has_persons.find(person_id = str(member_id), board_id = str(board_id))
+            for result in members_cards[member_id]:
+                if result['card_id'] not in card_ids:
+                    card_ids.append(result['card_id'])
+
+        cards_time = self.get_cards_time_by_lists(card_ids = card_ids, filter_dates = filter_dates, progress = progress)
+
+        #Раскладываем результат по выбранным спискам и участникам
+        report_lines = []
         for list_id in lists:
+            list_name = self.board_cache.get_list_name(board_id, list_id)
+
             for member_id in members:
-                query_result = self.local_cards_has_persons.search((where('board_id') == str(board_id)) & (where('person_id') == str(member_id)))
-                
-                for result in query_result:
-                    try:
-                        card = self.trello_client.get_card(card_id = result['card_id'])
-                        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG]: got card {result["card_name"], result["card_id"]}')
-                    except Exception as err:
-                        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR]: {err}')
-                    else:
-                        card_lists_time = self.get_card_stats_by_lists(card = card)
-
-                        for time in card_lists_time:
-                            if time == list_id:
-                                key = f'{time}'
-                                if card_lists_time.get(key)['time'] > timedelta(minutes=1):
-                                    list_name_query = self.local_lists.get((where('list_id') == str(time)))
-
-                                    self.report.insert({ 'person_id': result['person_id'],
-                                            'person_name': result['person_name'],
-                                            'card_id': result['card_id'], 
-                                            'card_name': result['card_name'], 
-                                            'list_id': time,
-                                            'list_name': list_name_query['list_name'],
-                                            'list_time': str(card_lists_time.get(key)['time']),
-                                            'board_id': result['board_id'],
-                                            'board_name': result['board_name']}
-                                    )
+                for result in members_cards[member_id]:
+                    if result['card_id'] not in cards_time:
+                        continue
+
+                    list_time = timedelta(seconds = cards_time[result['card_id']].get(list_id, 0))
+
+                    if list_time > timedelta(minutes=1):
+                        report_lines.append({ 'person_id': result['person_id'],
+                                'person_name': result['person_name'],
+                                'card_id': result['card_id'], 
+                                'card_name': result['card_name'], 
+                                'list_id': list_id,
+                                'list_name': list_name,
+                                'list_time': str(list_time),
+                                'list_seconds': int(list_time.total_seconds()),
+                                'board_id': result['board_id'],
+                                'board_name': result['board_name']}
+                        )
+
+        return report_lines, len(cards_time) == len(card_ids)
+
+
+    def build_team_report(self, board_ids, list_names, members, filter_dates = None, progress = None):
+        #Сводный отчет по нескольким доскам: списки сопоставляются по имени, строки те же, что у build_project_report.
+        #Карточки участников собираются с каждой доски один раз, доски обрабатываются параллельно
+        #(потоки запросов к Trello делятся между досками), рабочее время всех промежутков всех досок считается
+        #одним вызовом filter_work_hours_batch, поэтому рабочий календарь периода строится один раз
+        board_ids = list(dict.fromkeys(str(board_id) for board_id in board_ids))
+        members = [str(member_id) for member_id in members]
+
+        #{board_id: {member_id: [строки cards_has_persons]}} и уникальные карточки каждой доски
+        members_cards = {}
+        board_card_ids = {}
+        for board_id in board_ids:
+            members_cards[board_id] = {}
+            board_card_ids[board_id] = []
+            for member_id in members:
+                members_cards[board_id][member_id] = self.local_cards_has_persons.find(person_id = member_id, board_id = board_id)
+                for result in members_cards[board_id][member_id]:
+                    if result['card_id'] not in board_card_ids[board_id]:
+                        board_card_ids[board_id].append(result['card_id'])
+
+        total = sum(len(card_ids) for card_ids in board_card_ids.values())
+        board_workers = max(1, min(self.report_workers, len(board_ids)))
+        boards_done = {}
+        progress_lock = threading.Lock()
+
+        def fetch_board(board_id):
+            def board_progress(done, board_total):
+                with progress_lock:
+                    boards_done[board_id] = done
+                    if progress is not None:
+                        progress(sum(boards_done.values()), total)
+
+            return self.fetch_cards_intervals(card_ids = board_card_ids[board_id], progress = board_progress,
+                                              workers = max(1, self.report_workers // board_workers))
+
+        card_results = []
+        with metrics.timer('tar_report_stage_seconds', stage = 'card_intervals'):
+            if board_workers == 1:
+                for board_id in board_ids:
+                    card_results.extend(fetch_board(board_id))
+            else:
+                with ThreadPoolExecutor(max_workers = board_workers) as executor:
+                    for results in executor.map(fetch_board, board_ids):
+                        card_results.extend(results)
+
+        cards_time = self.compute_cards_time(card_results, filter_dates = filter_dates)
+
+        #Раскладываем результат по доскам, спискам с выбранными именами и участникам
+        report_lines = []
+        for board_id in board_ids:
+            board_lists = self.board_cache.get_lists(board_id)
+
+            for list_name in list_names:
+                for list_id in [list_id for list_id, name in board_lists.items() if name == list_name]:
+                    for member_id in members:
+                        for result in members_cards[board_id][member_id]:
+                            if result['card_id'] not in cards_time:
+                                continue
+
+                            list_time = timedelta(seconds = cards_time[result['card_id']].get(list_id, 0))
+
+                            if list_time > timedelta(minutes=1):
+                                report_lines.append({ 'person_id': result['person_id'],
+                                        'person_name': result['person_name'],
+                                        'card_id': result['card_id'],
+                                        'card_name': result['card_name'],
+                                        'list_id': list_id,
+                                        'list_name': list_name,
+                                        'list_time': str(list_time),
+                                        'list_seconds': int(list_time.total_seconds()),
+                                        'board_id': result['board_id'],
+                                        'board_name': result['board_name']}
+                                )
+
+        return report_lines, len(cards_time) == total
+
+
+    def summarize_report_lines(self, lines):
+        #Итоги отчета по сотрудникам, доскам и спискам: {'persons' / 'boards' / 'lists': [(имя, секунды, время), ...]}
+        totals = {'persons': {}, 'boards': {}, 'lists': {}}
+        for line in lines:
+            seconds = int(line.get('list_seconds', 0))
+            for group, field in (('persons', 'person_name'), ('boards', 'board_name'), ('lists', 'list_name')):
+                name = line.get(field, '')
+                totals[group][name] = totals[group].get(name, 0) + seconds
+
+        return {group: [(name, seconds, str(timedelta(seconds = seconds))) for name, seconds in sorted(group_totals.items(), key = itemgetter(1), reverse = True)]
+                for group, group_totals in totals.items()}
+
+
+    def get_list_names(self, board_ids = None):
+        #Имена списков досок board_ids (по умолчанию всех досок) без повторов, в порядке досок и списков
+        if board_ids is None:
+            board_ids = [board['board_id'] for board in self.local_boards.all()]
+        list_names = []
+        for board_id in board_ids:
+            for list_name in self.board_cache.get_lists(str(board_id)).values():
+                if list_name not in list_names:
+                    list_names.append(list_name)
+        return list_names
+
+
+    def submit_report(self, board_id, lists, members, filter_dates):
+        #Постановка отчета в очередь фоновых задач; возвращает job_id.
+        #Параметры (в том числе отчетный период) хранятся в задаче, а не в общем состоянии TarDriver
+        return self.report_jobs.submit({'board_id': board_id, 'lists': list(lists), 'members': list(members), 'filter_dates': list(filter_dates)})
+
+
+    def submit_team_report(self, board_ids, list_names, members, filter_dates):
+        #Постановка сводного отчета по нескольким доскам в очередь фоновых задач; возвращает job_id
+        return self.report_jobs.submit({'mode': 'team', 'board_ids': list(board_ids), 'list_names': list(list_names),
+                                        'members': list(members), 'filter_dates': list(filter_dates)})
+
+
+    def run_report_job(self, job):
+        #Построение отчета фоновой задачей: результат из кэша отчетов или новый расчет с прогрессом по карточкам
+        params = job.params
+        if params.get('mode') == 'team':
+            report_key = self.get_team_report_key(params['board_ids'], params['list_names'], params['members'], params['filter_dates'])
+        else:
+            report_key = self.get_report_key(params['board_id'], params['lists'], params['members'], params['filter_dates'])
+        report_lines = self.report_cache.get(report_key)
+
+        if report_lines is None:
+            with metrics.timer('tar_report_stage_seconds', stage = 'build'):
+                if params.get('mode') == 'team':
+                    report_lines, complete = self.build_team_report(params['board_ids'], params['list_names'], params['members'],
+                                                                    filter_dates = params['filter_dates'], progress = job.set_progress)
+                else:
+                    report_lines, complete = self.build_project_report(params['board_id'], params['lists'], params['members'],
+                                                                       filter_dates = params['filter_dates'], progress = job.set_progress)
+            if complete:
+                self.report_cache.put(report_key, report_lines)
+        else:
+            card_count = len({line['card_id'] for line in report_lines})
+            job.set_progress(card_count, card_count)
+
+        return report_lines
+
+
+    def get_report_job(self, job_id):
+        return self.report_jobs.get(job_id)
+
+
+    def get_report_page(self, page = 1, page_size = 100, sort_by = 'person', descending = False, job_id = None):
+        #Страница отчета с сортировкой на стороне сервера: строки фоновой задачи job_id или таблицы report читаются один раз,
+        #rows - генератор пар (номер строки, строка отчета) для потоковой отрисовки шаблона
+        lines = self.sort_report_lines(self.get_report_lines(job_id), sort_by = sort_by, descending = descending)
+        job = self.report_jobs.get(job_id) if job_id is not None else None
+        total = len(lines)
+        page_size = max(1, int(page_size))
+        pages = max(1, math.ceil(total / page_size))
+        page = min(max(1, int(page)), pages)
+
+        offset = (page - 1) * page_size
+        return {'rows': enumerate(lines[offset:offset + page_size], start = offset + 1),
+                'page': page,
+                'pages': pages,
+                'page_size': page_size,
+                'total': total,
+                'sort_by': sort_by if sort_by in self.report_sort_fields else 'person',
+                'descending': descending,
+                'job_id': job_id,
+                'summary': self.summarize_report_lines(lines) if job is not None and job.params.get('mode') == 'team' else None}
+
+
+    def get_report_lines(self, job_id = None):
+        #Строки отчета фоновой задачи job_id или таблицы report. Строки задачи отдаются без копирования
+        #(тот же список хранится в кэше отчетов) - изменять его нельзя, sort_report_lines возвращает новый список
+        job = self.report_jobs.get(job_id) if job_id is not None else None
+        return (job.result or []) if job is not None else self.report.all()
+
+
+    def sort_report_lines(self, lines, sort_by = 'person', descending = False, group_by = ()):
+        #Сортировка строк отчета по полю sort_by; group_by - поля группировки (сортируются первыми, по возрастанию).
+        #Результат - один новый список ссылок на строки, группы досортировываются в нем же
+        def field_key(sort_field):
+            if sort_field == 'list_seconds':
+                return lambda line: int(line.get('list_seconds', 0))
+            return lambda line: str(line.get(sort_field, '')).lower()
+
+        lines = sorted(lines, key = field_key(self.report_sort_fields.get(sort_by, self.report_sort_fields['person'])), reverse = descending)
+        for group in reversed(group_by):
+            lines.sort(key = field_key(self.report_sort_fields[group]))
+        return lines
+
+
+    def iter_report_rows(self, job_id = None, sort_by = 'person', descending = False, subtotals = ()):
+        #Строки отчета для выгрузки (генератор): пронумерованные строки и, если заданы subtotals ('person' / 'board' / 'list'),
+        #промежуточные итоги групп, которые считаются по ходу выдачи строк, и общий итог в конце
+        subtotals = [group for group in subtotals if group in ('person', 'board', 'list')]
+        group_fields = [self.report_sort_fields[group] for group in subtotals]
+        lines = self.sort_report_lines(self.get_report_lines(job_id), sort_by = sort_by, descending = descending, group_by = subtotals)
+
+        def subtotal_row(level, group_values, seconds):
+            row = {'number': '', 'person_name': '', 'card_name': 'Итого', 'list_name': '', 'board_name': '',
+                   'list_time': str(timedelta(seconds = seconds)), 'list_seconds': seconds, 'subtotal': True}
+            for field, value in zip(group_fields[0:level + 1], group_values):
+                row[field] = value
+            return row
+
+        group_values = None
+        group_seconds = [0] * len(group_fields)
+        total_seconds = 0
+
+        for number, line in enumerate(lines, start = 1):
+            values = tuple(line.get(field, '') for field in group_fields)
+
+            if group_values is not None:
+                #первый уровень, на котором сменилась группа: закрываем ее и все вложенные группы
+                changed = next((level for level in range(len(group_fields)) if values[level] != group_values[level]), None)
+                if changed is not None:
+                    for level in reversed(range(changed, len(group_fields))):
+                        yield subtotal_row(level, group_values, group_seconds[level])
+                        group_seconds[level] = 0
+
+            group_values = values
+            seconds = int(line.get('list_seconds', 0))
+            for level in range(len(group_fields)):
+                group_seconds[level] += seconds
+            total_seconds += seconds
+
+            yield {'number': number, 'person_name': line.get('person_name', ''), 'card_name': line.get('card_name', ''),
+                   'list_name': line.get('list_name', ''), 'board_name': line.get('board_name', ''),
+                   'list_time': line.get('list_time', ''), 'list_seconds': seconds, 'subtotal': False}
+
+        if group_values is not None:
+            for level in reversed(range(len(group_fields))):
+                yield subtotal_row(level, group_values, group_seconds[level])
+
+        if len(group_fields) > 0:
+            row = subtotal_row(-1, (), total_seconds)
+            row['card_name'] = 'Итого по отчету'
+            yield row
 
 
     def convert_seconds_to_readable_time(self, seconds): 
@@ -0,0 +1,78 @@
+import tempfile
+import csv
+import io
+import os
+
+
+#Выгрузка строк отчета (TarDriver.iter_report_rows) в CSV и XLSX.
+#Строки читаются из генератора по одной (отсортированный список ссылок на строки отчета - единственная копия),
+#CSV отдается клиенту частями по мере формирования,
+#XLSX пишется xlsxwriter в режиме constant_memory (в памяти только текущая строка листа) во временный файл,
+#который затем отдается частями и удаляется
+
+
+class ReportExport:
+
+    #Столбцы выгрузки: (поле строки отчета, заголовок)
+    columns = [('number', '№'),
+               ('person_name', 'Сотрудник'),
+               ('card_name', 'Задача'),
+               ('list_name', 'Статус задачи'),
+               ('board_name', 'Проект'),
+               ('list_time', 'Время в статусе (рабочее)'),
+               ('list_seconds', 'Время в статусе, секунд')]
+
+    def __init__(self, rows, chunk_size = 64 * 1024):
+        self.rows = rows
+        self.chunk_size = chunk_size
+
+
+    def csv(self):
+        #Генератор частей CSV-файла (UTF-8 с BOM, чтобы Excel правильно определил кодировку)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter = ';')
+
+        buffer.write('\ufeff')
+        writer.writerow([title for _, title in self.columns])
+
+        for row in self.rows:
+            writer.writerow([row.get(field, '') for field, _ in self.columns])
+            if buffer.tell() >= self.chunk_size:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield buffer.getvalue()
+
+
+    def xlsx(self):
+        #Генератор частей XLSX-файла. xlsxwriter импортируется здесь, чтобы выгрузка CSV работала и без него
+        import xlsxwriter
+
+        file_ = tempfile.NamedTemporaryFile(suffix = '.xlsx', delete = False)
+        file_.close()
+
+        try:
+            workbook = xlsxwriter.Workbook(file_.name, {'constant_memory': True})
+            worksheet = workbook.add_worksheet('Отчет')
+            bold = workbook.add_format({'bold': True})
+
+            worksheet.set_column(0, 0, 6)
+            worksheet.set_column(1, 4, 30)
+            worksheet.set_column(5, 6, 18)
+
+            #в режиме constant_memory строки пишутся строго по порядку
+            worksheet.write_row(0, 0, [title for _, title in self.columns], bold)
+            for row_number, row in enumerate(self.rows, start = 1):
+                worksheet.write_row(row_number, 0, [row.get(field, '') for field, _ in self.columns], bold if row.get('subtotal') else None)
+
+            workbook.close()
+
+            with open(file_.name, 'rb') as xlsx_file:
+                while True:
+                    chunk = xlsx_file.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            os.remove(file_.name)
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime
+import threading
+import uuid
+
+
+class ReportJob:
+
+    #Фоновое построение отчета: собственные параметры (board_id, lists, members, filter_dates), результат и прогресс.
+    #Состояния: 'queued' -> 'running' -> 'done' / 'failed'
+    def __init__(self, params):
+        self.job_id = uuid.uuid4().hex
+        self.params = dict(params)
+        self.status = 'queued'
+        self.done = 0                   #обработано карточек
+        self.total = 0                  #всего карточек в отчете
+        self.result = None              #строки отчета
+        self.error = None
+        self.created = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.finished = None
+        self.lock = threading.Lock()
+
+
+    def set_progress(self, done, total):
+        with self.lock:
+            self.done = done
+            self.total = total
+
+
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+
+    def get_status(self):
+        with self.lock:
+            return {'job_id': self.job_id,
+                    'status': self.status,
+                    'done': self.done,
+                    'total': self.total,
+                    'rows': len(self.result) if self.result is not None else 0,
+                    'error': self.error,
+                    'created': self.created,
+                    'finished': self.finished}
+
+
+class ReportJobs:
+
+    #Пул фоновых задач построения отчетов. runner(job) выполняет задачу и возвращает строки отчета.
+    #Хранится не более max_jobs задач: при переполнении удаляются самые старые завершенные
+    def __init__(self, runner, workers = 2, max_jobs = 50):
+        self.runner = runner
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()       #{job_id: ReportJob}
+        self.executor = ThreadPoolExecutor(max_workers = max(1, int(workers)), thread_name_prefix = 'tar-report')
+        self.lock = threading.Lock()
+
+
+    def submit(self, params):
+        job = ReportJob(params)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            for job_id in [job_id for job_id, old_job in self.jobs.items() if old_job.is_finished()]:
+                if len(self.jobs) <= self.max_jobs:
+                    break
+                del self.jobs[job_id]
+
+        self.executor.submit(self.run, job)
+        return job.job_id
+
+
+    def run(self, job):
+        job.status = 'running'
+        try:
+            result = self.runner(job)
+        except Exception as err:
+            job.error = str(err)
+            job.status = 'failed'
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Report job {job.job_id} failed: {err}')
+        else:
+            job.result = result
+            job.status = 'done'
+        job.finished = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait = wait)
@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+from bisect import bisect_left
+import threading
+import time
+import re
+
+
+#Метрики TarDriver в текстовом формате Prometheus (маршрут /metrics в app.py).
+#
+#Счетчик, текущее значение (gauge) или гистограмма обновляются одним изменением словаря под блокировкой,
+#текст формируется только при запросе /metrics, поэтому без сбора метрик накладные расходы - два вызова perf_counter на операцию.
+#Все модули пишут в общий реестр metrics:
+#
+#   with metrics.timer('tar_report_stage_seconds', stage = 'work_hours'):
+#       ...
+
+
+#Границы корзин гистограмм длительности, секунд
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+#Описания метрик: {имя: (тип, описание)}
+METRICS_HELP = {
+    'tar_trello_requests_total':        ('counter', 'Trello API requests by operation'),
+    'tar_trello_errors_total':          ('counter', 'Failed Trello API requests by operation'),
+    'tar_trello_request_seconds':       ('histogram', 'Trello API request latency by operation'),
+    'tar_sync_phase_seconds':           ('histogram', 'Duration of fill_database / update_database sync phases'),
+    'tar_report_stage_seconds':         ('histogram', 'Duration of report building stages'),
+    'tar_storage_seconds':              ('histogram', 'Time spent in storage reads and writes by backend, table and operation'),
+    'tar_trello_retries_total':         ('counter', 'Retried Trello API requests by reason'),
+    'tar_trello_throttle_seconds':      ('histogram', 'Time Trello API requests waited for the rate limit'),
+    'tar_trello_queue_depth':           ('gauge', 'Trello API requests waiting for the rate limit'),
+    'tar_trello_connections':           ('gauge', 'Trello HTTP connection pool: opened, idle and reused connections'),
+}
+
+
+class Metrics:
+
+    #Реестр счетчиков, текущих значений и гистограмм: {(имя, метки): значение} и {(имя, метки): [счетчики корзин, сумма, число]}
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+
+    def inc(self, name, value = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        #Замер длительности блока; время записывается и при исключении внутри блока
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+
+    def format_labels(self, labels, extra = ()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ''
+        values = [(label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in labels]
+        return '{' + ','.join(f'{label}="{value}"' for label, value in values) + '}'
+
+
+    def render(self):
+        #Текст всех метрик в формате Prometheus (text/plain; version=0.0.4)
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            counters.update(gauges)
+            histograms = {key: (list(histogram[0]), histogram[1], histogram[2]) for key, histogram in self.histograms.items()}
+
+        lines = []
+        names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+        for name in names:
+            metric_type, description = METRICS_HELP.get(name, ('histogram' if any(key[0] == name for key in histograms) else
+                                                               'gauge' if any(key[0] == name for key in gauges) else 'counter', name))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+            for (metric_name, labels), value in sorted(counters.items()):
+                if metric_name == name:
+                    lines.append(f'{name}{self.format_labels(labels)} {value}')
+
+            for (metric_name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{self.format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_sum{self.format_labels(labels)} {total:.6f}')
+                lines.append(f'{name}_count{self.format_labels(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def trello_operation(method, path):
+    #Метка операции запроса к Trello: идентификаторы в пути заменяются на :id ('GET /boards/:id/actions')
+    path = '/' + str(path).strip('/')
+    return f'{method} ' + re.sub(r'/[0-9a-fA-F]{24}(?=/|$)', '/:id', path)
+
+
+#Общий реестр метрик процесса
+metrics = Metrics()
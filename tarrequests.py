@@ -0,0 +1,346 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from tarmetrics import metrics
+import threading
+import requests
+import random
+import time
+
+
+#Планировщик HTTP-запросов к Trello: передается в TrelloClient как http_service и повторяет его интерфейс
+#request(method, url, **kwargs).
+#
+#   - ограничение частоты (token bucket): не больше rate запросов в секунду с запасом burst
+#     (лимит Trello - 100 запросов за 10 секунд на токен; за любые 10 секунд корзина пропускает не больше
+#     burst + rate * 10 запросов, по умолчанию 15 + 7.5 * 10 = 90);
+#   - повтор запросов при ответах 429 и 5xx и ошибках соединения с экспоненциальной паузой; пауза из заголовка
+#     Retry-After ответа 429 соблюдается всеми потоками, а не только получившим ответ. Изменяющие запросы
+#     (POST / PUT / DELETE - создание досок, списков, карточек) повторяются только если Trello их точно не выполнил:
+#     ответ 429 или ошибка установки соединения; при 5xx и тайм-ауте чтения повтор мог бы создать дубликаты;
+#   - одинаковые GET-запросы, выполняющиеся одновременно (например, одна и та же доска из нескольких потоков отчета),
+#     отправляются в Trello один раз, остальные потоки получают тот же ответ;
+#   - api_root подменяет адрес API (https://api.trello.com/1) - например, на локальный HTTP-сервер для проверок.
+#
+#TrelloSession - общая для потока синхронизации и потоков отчетов сессия requests с пулом постоянных (keep-alive)
+#соединений, сжатием ответов и тайм-аутом каждого запроса; планировщик отправляет запросы через нее.
+
+
+TRELLO_API_ROOT = 'https://api.trello.com/1'
+
+#Методы, которые можно повторить после ответа 5xx или обрыва соединения в любой момент
+RETRY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class TokenBucket:
+
+    #Корзина на capacity запросов, пополняется со скоростью rate запросов в секунду
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        #Ожидание свободного запроса; возвращает время ожидания, секунды
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+
+class InFlightRequest:
+
+    #Выполняющийся GET-запрос, ответ которого ждут совпадающие запросы других потоков
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class TrelloRequestScheduler:
+
+    def __init__(self,
+                        http_service = requests,            #модуль requests или requests.Session
+                        rate = 7.5,                         #запросов в секунду, None - без ограничения
+                        burst = 15,                         #запросов подряд без ожидания
+                        max_retries = 5,                    #повторов одного запроса
+                        backoff_base = 1.0,                 #первая пауза перед повтором, секунды
+                        backoff_max = 60.0,                 #наибольшая пауза, секунды
+                        coalesce = True,                    #объединять одинаковые одновременные GET-запросы
+                        api_root = None):                   #адрес API вместо https://api.trello.com/1
+
+        self.http_service = http_service
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.coalesce = coalesce
+        self.api_root = api_root.rstrip('/') if api_root else None
+
+        self.in_flight = {}                 #{ключ запроса: InFlightRequest}
+        self.blocked_until = 0.0            #до этого момента (time.monotonic) запросы не отправляются - Retry-After ответа 429
+        self.lock = threading.Lock()
+
+        self.stats = {'calls': 0,           #вызовов request()
+                      'sent': 0,            #отправлено HTTP-запросов, с повторами
+                      'retries': 0,
+                      'rate_limited': 0,    #ответов 429
+                      'server_errors': 0,   #ответов 5xx
+                      'connection_errors': 0,
+                      'failed': 0,          #запросов, не выполненных и после всех повторов
+                      'coalesced': 0,       #запросов, получивших ответ совпадающего запроса
+                      'queue_depth': 0,     #запросов, ожидающих отправки
+                      'max_queue_depth': 0,
+                      'throttle_seconds': 0.0}
+
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.stats['calls'] += 1
+
+        if self.api_root is not None and url.startswith(TRELLO_API_ROOT):
+            url = self.api_root + url[len(TRELLO_API_ROOT):]
+
+        if not self.coalesce or method.upper() != 'GET':
+            return self.send(method, url, **kwargs)
+
+        key = (url, tuple(sorted((str(name), str(value)) for name, value in (kwargs.get('params') or {}).items())))
+        with self.lock:
+            call = self.in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self.in_flight[key] = InFlightRequest()
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.response
+
+        try:
+            call.response = self.send(method, url, **kwargs)
+            return call.response
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call.done.set()
+
+
+    def send(self, method, url, **kwargs):
+        #Отправка с ограничением частоты и повторами; после всех повторов возвращается последний ответ
+        #(TrelloClient превратит его в исключение) или пробрасывается последняя ошибка соединения
+        attempt = 0
+        not_before = 0.0
+        retry_always = method.upper() in RETRY_METHODS
+        while True:
+            self.wait_turn(not_before)
+
+            try:
+                with self.lock:
+                    self.stats['sent'] += 1
+                response = self.http_service.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                reason = 'connection'
+                with self.lock:
+                    self.stats['connection_errors'] += 1
+                if attempt >= self.max_retries or not (retry_always or self.is_connect_error(err)):
+                    self.count_failure()
+                    raise
+                delay = self.backoff(attempt)
+                error = err
+            else:
+                if response.status_code == 429:
+                    reason = 'rate_limited'
+                    with self.lock:
+                        self.stats['rate_limited'] += 1
+                elif response.status_code >= 500:
+                    reason = 'server_error'
+                    with self.lock:
+                        self.stats['server_errors'] += 1
+                else:
+                    return response
+
+                if attempt >= self.max_retries or (reason == 'server_error' and not retry_always):
+                    self.count_failure()
+                    return response
+
+                retry_after = self.get_retry_after(response)
+                delay = retry_after if retry_after is not None else self.backoff(attempt)
+                error = f'HTTP {response.status_code}'
+
+                if response.status_code == 429:
+                    #лимит общий для токена - приостанавливаем все потоки
+                    with self.lock:
+                        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+            attempt += 1
+            not_before = time.monotonic() + delay
+            with self.lock:
+                self.stats['retries'] += 1
+            metrics.inc('tar_trello_retries_total', reason = reason)
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] Trello request retry {attempt}/{self.max_retries} in {delay:.1f} s: {error}')
+
+
+    def wait_turn(self, not_before = 0.0):
+        #Ожидание очереди: пауза повтора, Retry-After и token bucket. Время ожидания идет в статистику
+        with self.lock:
+            self.stats['queue_depth'] += 1
+            self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], self.stats['queue_depth'])
+            metrics.set_gauge('tar_trello_queue_depth', self.stats['queue_depth'])
+
+        waited = 0.0
+        try:
+            while True:
+                with self.lock:
+                    delay = max(not_before, self.blocked_until) - time.monotonic()
+                if delay <= 0:
+                    break
+                time.sleep(delay)
+                waited += delay
+
+            if self.bucket is not None:
+                waited += self.bucket.acquire()
+        finally:
+            with self.lock:
+                self.stats['queue_depth'] -= 1
+                self.stats['throttle_seconds'] += waited
+                metrics.set_gauge('tar_trello_queue_depth', self.stats['queue_depth'])
+
+        if waited > 0:
+            metrics.observe('tar_trello_throttle_seconds', waited)
+        return waited
+
+
+    def is_connect_error(self, err):
+        #Ошибка до отправки запроса (соединение не установлено) - запрос до Trello не дошел
+        if isinstance(err, requests.ConnectTimeout):
+            return True
+        reason = getattr(err.args[0], 'reason', err.args[0]) if err.args else None
+        return isinstance(reason, (ConnectTimeoutError, NewConnectionError))
+
+
+    def backoff(self, attempt):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.5)
+
+
+    def get_retry_after(self, response):
+        #Пауза из заголовка Retry-After: число секунд или HTTP-дата; None - заголовка нет или он не разобран
+        value = response.headers.get('Retry-After') if response.headers is not None else None
+        if not value:
+            return None
+        try:
+            return min(self.backoff_max, max(0.0, float(value)))
+        except ValueError:
+            pass
+        try:
+            return min(self.backoff_max, max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()))
+        except (TypeError, ValueError):
+            return None
+
+
+    def count_failure(self):
+        with self.lock:
+            self.stats['failed'] += 1
+
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['throttle_seconds'] = round(stats['throttle_seconds'], 3)
+        return stats
+
+
+class TrelloSession(requests.Session):
+
+    #Сессия с пулом из pool_size соединений на хост. Пул блокирующий: если все соединения заняты, поток ждет
+    #освободившееся, а не открывает лишнее. Заголовки задаются один раз при создании, поэтому сессию можно
+    #использовать из нескольких потоков (пул urllib3 и хранилище cookie потокобезопасны)
+    def __init__(self, pool_size = 10, timeout = (5, 30)):
+        super().__init__()
+        self.pool_size = pool_size
+        self.timeout = timeout              #(подключение, чтение), секунды - если при вызове тайм-аут не задан
+        self.adapter = HTTPAdapter(pool_connections = 4, pool_maxsize = pool_size, pool_block = True)
+        self.mount('https://', self.adapter)
+        self.mount('http://', self.adapter)
+        self.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0,
+                      'errors': 0,
+                      'compressed': 0,      #ответов, пришедших сжатыми
+                      'seconds': 0.0}       #суммарное время запросов
+
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        started = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except Exception:
+            with self.stats_lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.stats_lock:
+                self.stats['requests'] += 1
+                self.stats['seconds'] += elapsed
+
+        if response.headers.get('Content-Encoding') in ('gzip', 'deflate'):
+            with self.stats_lock:
+                self.stats['compressed'] += 1
+        return response
+
+
+    def get_stats(self):
+        #Статистика сессии и пулов соединений urllib3: открыто соединений, запросов через пулы, свободных соединений
+        with self.stats_lock:
+            stats = dict(self.stats)
+
+        stats['connections'] = 0
+        stats['pool_requests'] = 0
+        stats['idle_connections'] = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['connections'] += pool.num_connections
+            stats['pool_requests'] += pool.num_requests
+            stats['idle_connections'] += self.count_idle(pool)
+
+        stats['pool_size'] = self.pool_size
+        stats['average_ms'] = round(stats['seconds'] / stats['requests'] * 1000, 1) if stats['requests'] else 0.0
+        stats['reused'] = stats['pool_requests'] - stats['connections'] if stats['pool_requests'] >= stats['connections'] else 0
+        stats['seconds'] = round(stats['seconds'], 3)
+        return stats
+
+
+    @staticmethod
+    def count_idle(pool):
+        #Очередь пула urllib3 заранее заполнена pool_size заглушками None: свободными считаются только открытые соединения
+        if pool.pool is None:
+            return 0
+        with pool.pool.mutex:
+            return sum(1 for conn in pool.pool.queue if conn is not None)
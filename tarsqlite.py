@@ -0,0 +1,385 @@
+from tinydb.table import Document
+from tarmetrics import metrics
+from datetime import datetime
+import threading
+import sqlite3
+import json
+import os
+
+
+#Хранение таблиц TarDriver в SQLite.
+#
+#SQLiteDatabase повторяет интерфейс TarDatabase / IndexedTable из tarstorage.py (table(), find(), find_one(), insert(),
+#insert_multiple(), update(), update_where(), remove(), remove_where(), truncate(), all(), flush(), close()), поэтому TarDriver
+#работает с любым из хранилищ одинаково. Поля из SCHEMA хранятся в отдельных столбцах с объявленными типами
+#(TEXT / INTEGER - те же типы, что TarDriver записывает в документы), остальные поля документа -
+#в столбце extra в виде JSON. Индексы создаются по тем же описаниям indexes, что и хеш-индексы IndexedTable.
+#
+#База открывается в режиме WAL: у каждого потока свое соединение, читатели (страницы Flask) не ждут поток
+#синхронизации, а он не ждет их. Каждая операция записи - отдельная транзакция.
+#Время операций с таблицами пишется в метрику tar_storage_seconds (см. tarmetrics.py).
+
+
+#Столбцы (с типами) и ограничения таблиц: {таблица: ({столбец: тип}, ограничения)}.
+#Идентификаторы Trello, имена и даты хранятся строками (TEXT), флаги и секунды - числами (INTEGER)
+SCHEMA = {
+    'boards':               ({'board_id': 'TEXT', 'board_name': 'TEXT', 'board_description': 'TEXT', 'board_last_modified': 'TEXT',
+                              'board_last_action': 'TEXT', 'board_movements_loaded': 'INTEGER'},
+                             ['UNIQUE (board_id)']),
+    'lists':                ({'list_id': 'TEXT', 'list_name': 'TEXT', 'list_last_modified': 'TEXT', 'board_id': 'TEXT', 'board_name': 'TEXT'},
+                             ['UNIQUE (list_id)',
+                              'FOREIGN KEY (board_id) REFERENCES boards (board_id) ON DELETE CASCADE']),
+    #списки Trello не удаляются, а архивируются (в БД остаются и архивные), поэтому строка lists удаляется
+    #только вместе с доской - карточки удаляются вместе с ней, как и при удалении доски
+    'cards':                ({'card_id': 'TEXT', 'card_name': 'TEXT', 'list_id': 'TEXT', 'list_name': 'TEXT', 'board_id': 'TEXT',
+                              'board_name': 'TEXT', 'card_list_entered': 'TEXT'},
+                             ['UNIQUE (card_id)',
+                              'FOREIGN KEY (board_id) REFERENCES boards (board_id) ON DELETE CASCADE',
+                              'FOREIGN KEY (list_id) REFERENCES lists (list_id) ON DELETE CASCADE']),
+    #строка на каждую карточку участника на доске команды: person_id не уникален и не может быть целью внешнего ключа
+    'persons':              ({'person_id': 'TEXT', 'person_username': 'TEXT', 'person_fullname': 'TEXT', 'status': 'TEXT', 'last_modified': 'TEXT'},
+                             []),
+    #person_id не ссылается на persons: persons не уникальна по person_id и перезаписывается целиком (fill_persons),
+    #а связи участников с карточками при этом сохраняются и перестраиваются только для изменившихся участников
+    'cards_has_persons':    ({'card_id': 'TEXT', 'card_name': 'TEXT', 'person_id': 'TEXT', 'person_name': 'TEXT', 'list_id': 'TEXT',
+                              'list_name': 'TEXT', 'board_id': 'TEXT', 'board_name': 'TEXT'},
+                             ['FOREIGN KEY (card_id) REFERENCES cards (card_id) ON DELETE CASCADE']),
+    #настройки рабочего времени хранятся строками ('09:00:00', '5')
+    'worktime':             ({'work_day_starts': 'TEXT', 'work_day_ends': 'TEXT', 'work_day_duration': 'TEXT', 'lunch_hours_starts': 'TEXT',
+                              'lunch_hours_ends': 'TEXT', 'lunch_duration': 'TEXT', 'day_work_hours': 'TEXT', 'work_days': 'TEXT',
+                              'week_work_hours': 'TEXT', 'update_period': 'TEXT', 'first_weekday': 'TEXT'},
+                             []),
+    #история перемещений не ссылается на boards: при полной перезагрузке доски она сохраняется
+    'card_movements':       ({'action_id': 'TEXT', 'card_id': 'TEXT', 'board_id': 'TEXT', 'list_before_id': 'TEXT', 'list_after_id': 'TEXT',
+                              'movement_date': 'TEXT'},
+                             ['UNIQUE (action_id)']),
+    #строки последнего построенного отчета - снимок, не зависящий от последующих изменений карточек
+    'report':               ({'person_id': 'TEXT', 'person_name': 'TEXT', 'card_id': 'TEXT', 'card_name': 'TEXT', 'list_id': 'TEXT',
+                              'list_name': 'TEXT', 'list_time': 'TEXT', 'list_seconds': 'INTEGER', 'board_id': 'TEXT', 'board_name': 'TEXT'},
+                             []),
+}
+
+#Версия схемы (PRAGMA user_version): файлы БД прежних версий перестраиваются при открытии (SQLiteDatabase.upgrade_schema).
+#1 - типы столбцов и внешний ключ cards.list_id
+SCHEMA_VERSION = 1
+
+#Ключ таблицы: повторная вставка документа с тем же ключом обновляет существующую строку
+UNIQUE_KEYS = {'boards': 'board_id', 'lists': 'list_id', 'cards': 'card_id', 'card_movements': 'action_id'}
+
+#Порядок переноса таблиц из tar_database.json (сначала родительские таблицы внешних ключей)
+MIGRATION_ORDER = ['boards', 'lists', 'cards', 'persons', 'cards_has_persons', 'card_movements', 'worktime', 'report']
+
+
+class SQLiteDatabase:
+
+    def __init__(self, path, timeout = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self.tables = {}
+        self.connections = {}               #{ident потока: соединение}
+        self.lock = threading.Lock()
+
+        connection = self.connection()
+        connection.execute('PRAGMA journal_mode = WAL')
+        is_new = connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name <> 'sqlite_sequence'").fetchone()[0] == 0
+        with connection:
+            for name, (columns, constraints) in SCHEMA.items():
+                connection.execute(f'CREATE TABLE IF NOT EXISTS {name} ({", ".join(self.table_definition(name))})')
+
+                #столбцы, добавленные в SCHEMA после создания файла БД (прежние значения остаются в extra)
+                existing_columns = {row[1] for row in connection.execute(f'PRAGMA table_info({name})')}
+                for column, column_type in columns.items():
+                    if column not in existing_columns:
+                        connection.execute(f'ALTER TABLE {name} ADD COLUMN {column} {column_type}')
+
+        if is_new:
+            connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        elif connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            self.upgrade_schema()
+
+
+    @staticmethod
+    def table_definition(name):
+        columns, constraints = SCHEMA[name]
+        return (['doc_id INTEGER PRIMARY KEY AUTOINCREMENT'] + [f'{column} {column_type}' for column, column_type in columns.items()] +
+                ['extra TEXT'] + constraints)
+
+
+    def upgrade_schema(self):
+        #Перестройка таблиц файла БД прежней версии схемы (типы столбцов и ограничения SQLite не меняет через ALTER TABLE):
+        #новая таблица, копирование строк с теми же doc_id, замена старой. Строки, нарушающие новые внешние ключи
+        #(карточки несуществующих списков и связи этих карточек), удаляются, как и при переносе из tar_database.json
+        connection = self.connection()
+        connection.execute('PRAGMA foreign_keys = OFF')
+        try:
+            connection.execute('BEGIN')
+            for name in MIGRATION_ORDER:
+                columns = ', '.join(['doc_id'] + list(SCHEMA[name][0]) + ['extra'])
+                connection.execute(f'CREATE TABLE {name}_upgrade ({", ".join(self.table_definition(name))})')
+                connection.execute(f'INSERT INTO {name}_upgrade ({columns}) SELECT {columns} FROM {name}')
+                connection.execute(f'DROP TABLE {name}')
+                connection.execute(f'ALTER TABLE {name}_upgrade RENAME TO {name}')
+
+            removed = 0
+            violations = connection.execute('PRAGMA foreign_key_check').fetchall()
+            while violations:
+                for table_name, doc_id, _, _ in violations:
+                    removed += connection.execute(f'DELETE FROM {table_name} WHERE doc_id = ?', (doc_id,)).rowcount
+                violations = connection.execute('PRAGMA foreign_key_check').fetchall()
+
+            connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.execute('PRAGMA foreign_keys = ON')
+
+        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] "{self.path}" upgraded to schema version {SCHEMA_VERSION}, {removed} orphaned rows removed')
+
+
+    def connection(self):
+        #Соединение текущего потока; соединения завершившихся потоков закрываются
+        ident = threading.get_ident()
+        with self.lock:
+            connection = self.connections.get(ident)
+            if connection is None:
+                alive = {thread.ident for thread in threading.enumerate()}
+                for dead_ident in [dead_ident for dead_ident in self.connections if dead_ident not in alive]:
+                    self.connections.pop(dead_ident).close()
+
+                connection = sqlite3.connect(self.path, timeout = self.timeout, check_same_thread = False)
+                connection.execute('PRAGMA foreign_keys = ON')
+                connection.execute('PRAGMA synchronous = NORMAL')
+                self.connections[ident] = connection
+            return connection
+
+
+    def table(self, name, indexes = ()):
+        if name not in self.tables:
+            self.tables[name] = SQLiteTable(self, name)
+        self.tables[name].create_indexes(indexes)
+        return self.tables[name]
+
+
+    def flush(self):
+        #Каждая запись уже зафиксирована транзакцией; переносим журнал WAL в основной файл, не дожидаясь читателей
+        self.connection().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+
+
+    def is_empty(self):
+        connection = self.connection()
+        return all(connection.execute(f'SELECT 1 FROM {name} LIMIT 1').fetchone() is None for name in SCHEMA)
+
+
+    def migrate_from_json(self, json_path = None):
+        #Однократный перенос данных из tar_database.json (по умолчанию - в каталоге файла SQLite, а не в текущем):
+        #выполняется, только если база SQLite пуста, после переноса файл переименовывается в tar_database.json.migrated.
+        #Строки, ссылающиеся на отсутствующие доски, списки и карточки, не переносятся
+        #(история перемещений досок без отметки board_movements_loaded догружается из Trello в TarDriver.warm_start)
+        if json_path is None:
+            json_path = os.path.join(os.path.dirname(os.path.abspath(self.path)), 'tar_database.json')
+        if not os.path.exists(json_path) or not self.is_empty():
+            return 0
+
+        with open(json_path, encoding = 'utf-8') as file_:
+            content = file_.read()
+        data = json.loads(content) if content.strip() else {}
+
+        migrated = 0
+        board_ids = set()
+        list_ids = set()
+        card_ids = set()
+        for name in MIGRATION_ORDER:
+            documents = [document for _, document in sorted(data.get(name, {}).items(), key = lambda item: int(item[0]))]
+
+            if name in ('lists', 'cards'):
+                documents = [document for document in documents if document.get('board_id') in board_ids]
+            if name == 'cards':
+                documents = [document for document in documents if document.get('list_id') is None or document.get('list_id') in list_ids]
+            elif name == 'cards_has_persons':
+                documents = [document for document in documents if document.get('card_id') in card_ids]
+
+            self.table(name).insert_multiple(documents)
+            migrated += len(documents)
+
+            if name == 'boards':
+                board_ids = {document.get('board_id') for document in documents}
+            elif name == 'lists':
+                list_ids = {document.get('list_id') for document in documents}
+            elif name == 'cards':
+                card_ids = {document.get('card_id') for document in documents}
+
+        os.replace(json_path, json_path + '.migrated')
+        print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [MSG] {migrated} records migrated from "{json_path}" to "{self.path}"')
+        return migrated
+
+
+class SQLiteTable:
+
+    def __init__(self, database, name):
+        if name not in SCHEMA:
+            raise ValueError(f'Unknown table "{name}"')
+
+        self.database = database
+        self.name = name
+        self.columns = list(SCHEMA[name][0])
+        self.unique_key = UNIQUE_KEYS.get(name)
+
+
+    def create_indexes(self, indexes):
+        #Индексы SQL по описаниям вида ['board_id', ('board_id', 'list_name')]
+        index_fields = [tuple(fields) if isinstance(fields, (tuple, list)) else (fields,) for fields in indexes]
+        connection = self.database.connection()
+        with connection:
+            for fields in index_fields:
+                if self.unique_key is not None and fields == (self.unique_key,):
+                    continue        #индекс уже создан ограничением UNIQUE
+                connection.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.name}_{"_".join(fields)} ON {self.name} ({", ".join(self.field_sql(field) for field in fields)})')
+
+
+    def field_sql(self, field):
+        #Выражение SQL для поля документа: столбец таблицы или значение из JSON столбца extra
+        if field in self.columns:
+            return field
+        return f"json_extract(extra, '$.{field}')"
+
+
+    def to_row(self, document):
+        extra = {field: value for field, value in document.items() if field not in self.columns}
+        return [document.get(column) for column in self.columns] + [json.dumps(extra, ensure_ascii = False) if extra else None]
+
+
+    def to_document(self, row):
+        #NULL в столбце - поле отсутствует в документе, как в TinyDB
+        document = {column: value for column, value in zip(self.columns, row[1:-1]) if value is not None}
+        if row[-1]:
+            document.update(json.loads(row[-1]))
+        return Document(document, row[0])
+
+
+    def where_sql(self, fields):
+        if not fields:
+            return '', []
+        return ' WHERE ' + ' AND '.join(f'{self.field_sql(field)} IS ?' for field in fields), list(fields.values())
+
+
+    def insert_sql(self):
+        sql = f'INSERT INTO {self.name} ({", ".join(self.columns)}, extra) VALUES ({", ".join("?" * (len(self.columns) + 1))})'
+        if self.unique_key is not None:
+            sql += f' ON CONFLICT ({self.unique_key}) DO UPDATE SET ' + ', '.join(f'{column} = excluded.{column}' for column in self.columns + ['extra'])
+        return sql
+
+
+    def insert(self, document):
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'write'):
+            connection = self.database.connection()
+            with connection:
+                cursor = connection.execute(self.insert_sql(), self.to_row(document))
+            return cursor.lastrowid
+
+
+    def insert_multiple(self, documents):
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'write'):
+            connection = self.database.connection()
+            doc_ids = []
+            with connection:
+                sql = self.insert_sql()
+                for document in documents:
+                    doc_ids.append(connection.execute(sql, self.to_row(document)).lastrowid)
+            return doc_ids
+
+
+    def find_ids(self, fields):
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'read'):
+            where, params = self.where_sql(fields)
+            return [row[0] for row in self.database.connection().execute(f'SELECT doc_id FROM {self.name}{where} ORDER BY doc_id', params)]
+
+
+    def find(self, **fields):
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'read'):
+            where, params = self.where_sql(fields)
+            rows = self.database.connection().execute(f'SELECT doc_id, {", ".join(self.columns)}, extra FROM {self.name}{where} ORDER BY doc_id', params)
+            return [self.to_document(row) for row in rows]
+
+
+    def find_one(self, **fields):
+        documents = self.find(**fields)
+        return documents[0] if documents else None
+
+
+    def all(self):
+        return self.find()
+
+
+    def update(self, fields, cond = None, doc_ids = None):
+        #Изменение полей документов doc_ids (или всех документов таблицы); условия Query TinyDB не поддерживаются
+        if cond is not None:
+            raise ValueError('SQLiteTable.update supports doc_ids only, use update_where()')
+
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'write'):
+            connection = self.database.connection()
+            with connection:
+                if doc_ids is None:
+                    doc_ids = [row[0] for row in connection.execute(f'SELECT doc_id FROM {self.name}')]
+
+                updated_ids = []
+                for doc_id in doc_ids:
+                    row = connection.execute(f'SELECT doc_id, {", ".join(self.columns)}, extra FROM {self.name} WHERE doc_id = ?', (doc_id,)).fetchone()
+                    if row is None:
+                        continue
+                    document = self.to_document(row)
+                    document.update(fields)
+                    connection.execute(f'UPDATE {self.name} SET {", ".join(f"{column} = ?" for column in self.columns)}, extra = ? WHERE doc_id = ?',
+                                       self.to_row(document) + [doc_id])
+                    updated_ids.append(doc_id)
+            return updated_ids
+
+
+    def update_where(self, values, **fields):
+        doc_ids = self.find_ids(fields)
+        return self.update(values, doc_ids = doc_ids) if doc_ids else []
+
+
+    def remove(self, cond = None, doc_ids = None):
+        #Удаление документов doc_ids; условия Query TinyDB не поддерживаются
+        if cond is not None or doc_ids is None:
+            raise ValueError('SQLiteTable.remove supports doc_ids only, use remove_where()')
+
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'write'):
+            connection = self.database.connection()
+            removed_ids = []
+            with connection:
+                for doc_id in doc_ids:
+                    if connection.execute(f'DELETE FROM {self.name} WHERE doc_id = ?', (doc_id,)).rowcount > 0:
+                        removed_ids.append(doc_id)
+            return removed_ids
+
+
+    def remove_where(self, **fields):
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'write'):
+            where, params = self.where_sql(fields)
+            connection = self.database.connection()
+            with connection:
+                doc_ids = [row[0] for row in connection.execute(f'SELECT doc_id FROM {self.name}{where}', params)]
+                connection.execute(f'DELETE FROM {self.name}{where}', params)
+            return doc_ids
+
+
+    def truncate(self):
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'write'):
+            connection = self.database.connection()
+            with connection:
+                connection.execute(f'DELETE FROM {self.name}')
+
+
+    def __len__(self):
+        with metrics.timer('tar_storage_seconds', backend = 'sqlite', table = self.name, operation = 'read'):
+            return self.database.connection().execute(f'SELECT COUNT(*) FROM {self.name}').fetchone()[0]
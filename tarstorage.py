@@ -0,0 +1,310 @@
+from tinydb import TinyDB
+from tinydb.storages import Storage
+from tinydb.middlewares import Middleware
+from tinydb.table import Table, Document
+from tarmetrics import metrics
+from datetime import datetime
+import threading
+import json
+import time
+import os
+
+
+#Хранение tar_database.json.
+#
+#AtomicJSONStorage пишет файл целиком во временный файл рядом с основным, делает fsync и заменяет
+#основной файл через os.replace. Читатель всегда видит либо старую, либо новую полную версию файла,
+#но не наполовину записанную.
+#
+#BufferedMiddleware держит базу в памяти и записывает ее на диск не после каждой вставки, а при явном
+#flush() (конец фазы синхронизации, отчета, изменения настроек), после max_pending_writes изменений
+#или если с первого незаписанного изменения прошло больше max_delay секунд (проверяется при очередной записи).
+#Таблицы (IndexedTable) изменяют данные под блокировкой middleware, flush() под ней же снимает копию базы
+#и сериализует уже копию, не мешая потоку синхронизации. Автоматическая запись идет в отдельном потоке,
+#чтобы операция таблицы, вызвавшая ее, не держала блокировку на время сериализации и fsync.
+#При аварийном завершении процесса теряются только изменения после последнего flush(); файл при этом
+#остается целым. Локальные таблицы boards / lists / cards восстанавливаются следующей синхронизацией с Trello.
+#
+#Время чтения и записи файла и операций с таблицами пишется в метрику tar_storage_seconds (см. tarmetrics.py).
+
+
+class AtomicJSONStorage(Storage):
+
+    def __init__(self, path, encoding = 'utf-8', **kwargs):
+        self.path = path
+        self.encoding = encoding
+        self.kwargs = kwargs
+
+
+    def read(self):
+        with metrics.timer('tar_storage_seconds', backend = 'tinydb', table = '', operation = 'file_read'):
+            try:
+                with open(self.path, encoding = self.encoding) as file_:
+                    content = file_.read()
+            except FileNotFoundError:
+                return None
+
+            if not content.strip():
+                return None
+
+            return json.loads(content)
+
+
+    def write(self, data):
+        with metrics.timer('tar_storage_seconds', backend = 'tinydb', table = '', operation = 'file_write'):
+            content = json.dumps(data, **self.kwargs)
+            temp_path = self.path + '.tmp'
+
+            with open(temp_path, 'w', encoding = self.encoding) as file_:
+                file_.write(content)
+                file_.flush()
+                os.fsync(file_.fileno())
+
+            os.replace(temp_path, self.path)
+
+
+    def close(self):
+        pass
+
+
+class BufferedMiddleware(Middleware):
+
+    def __init__(self, storage_cls, max_pending_writes = 1000, max_delay = 5.0):
+        super().__init__(storage_cls)
+        self.max_pending_writes = max_pending_writes
+        self.max_delay = max_delay
+
+        self.cache = None
+        self.pending_writes = 0             #число изменений с последнего flush()
+        self.first_pending_write = None     #время первого незаписанного изменения
+        self.flushes = 0                    #число записей на диск
+        self.lock = threading.RLock()       #общая с таблицами блокировка изменений данных
+        self.write_lock = threading.Lock()  #запись файла - по одной, в порядке снятия копий
+        self.flush_thread = None            #поток автоматической записи (после max_pending_writes / max_delay)
+
+
+    def read(self):
+        with self.lock:
+            if self.cache is None:
+                self.cache = self.storage.read()
+            return self.cache
+
+
+    def write(self, data):
+        with self.lock:
+            self.cache = data
+            self.pending_writes += 1
+            if self.first_pending_write is None:
+                self.first_pending_write = time.monotonic()
+
+            if self.pending_writes >= self.max_pending_writes or time.monotonic() - self.first_pending_write >= self.max_delay:
+                self.start_background_flush()
+
+
+    def start_background_flush(self):
+        #write() вызывается внутри операции таблицы, которая держит self.lock: flush() здесь же сериализовал бы
+        #и писал файл, не отпуская блокировку, и читатели таблиц ждали бы fsync. Поэтому запись уходит в отдельный
+        #поток - он снимет копию, когда операция отпустит блокировку, и запишет файл уже без нее
+        if self.flush_thread is not None and self.flush_thread.is_alive():
+            return
+        self.flush_thread = threading.Thread(target = self.background_flush, name = 'tar-storage-flush', daemon = True)
+        self.flush_thread.start()
+
+
+    def background_flush(self):
+        try:
+            #если файл сейчас пишет другой поток, изменения запишет следующий flush()
+            self.flush(blocking = False)
+        except Exception as error:
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Не удалось записать базу на диск: {error}')
+
+
+    def flush(self, blocking = True):
+        #Запись накопленных изменений на диск одним атомарным сохранением файла
+        if not self.write_lock.acquire(blocking):
+            return
+        try:
+            #копия документов под блокировкой изменений - сериализуется уже без нее
+            with self.lock:
+                if self.pending_writes == 0:
+                    return
+                snapshot = {table_name: {doc_id: dict(document) for doc_id, document in table.items()}
+                            for table_name, table in self.cache.items()}
+                pending_writes = self.pending_writes
+                first_pending_write = self.first_pending_write
+                self.pending_writes = 0
+                self.first_pending_write = None
+
+            try:
+                self.storage.write(snapshot)
+            except Exception:
+                with self.lock:
+                    self.pending_writes += pending_writes
+                    self.first_pending_write = min(first_pending_write, self.first_pending_write or first_pending_write)
+                raise
+
+            with self.lock:
+                self.flushes += 1
+        finally:
+            self.write_lock.release()
+
+
+    def close(self):
+        flush_thread = self.flush_thread
+        if flush_thread is not None:
+            flush_thread.join()
+        self.flush()
+        self.storage.close()
+
+
+class IndexedTable(Table):
+
+    #Таблица TinyDB с хеш-индексами по полям: indexes = ['board_id', ('board_id', 'list_name'), ...].
+    #Индекс {значения полей: множество doc_id} обновляется при каждой вставке, изменении и удалении,
+    #а после загрузки БД строится заново при первом обращении. find() / find_one() / remove_where() / update_where()
+    #выбирают подходящий индекс, поэтому их стоимость пропорциональна размеру результата, а не таблицы.
+    #Блокировка изменений общая с BufferedMiddleware, чтобы flush() снимал копию базы между изменениями
+    def __init__(self, storage, name, indexes = (), **kwargs):
+        super().__init__(storage, name, **kwargs)
+        self.index_fields = [tuple(fields) if isinstance(fields, (tuple, list)) else (fields,) for fields in indexes]
+        self.indexes = None                 #{поля: {значения: {doc_id, ...}}}, None - индексы еще не построены
+        self.document_keys = {}             #{doc_id: {поля: значения}} - для удаления документа из индексов
+        self.index_lock = getattr(storage, 'lock', None) or threading.RLock()
+
+
+    def rebuild_indexes(self):
+        with self.index_lock:
+            self.indexes = {fields: {} for fields in self.index_fields}
+            self.document_keys = {}
+            for doc_id, document in self._read_table().items():
+                self.index_document(int(doc_id), document)
+
+
+    def ensure_indexes(self):
+        if self.indexes is None:
+            self.rebuild_indexes()
+
+
+    def index_document(self, doc_id, document):
+        keys = {fields: tuple(document.get(field) for field in fields) for fields in self.index_fields}
+        for fields, key in keys.items():
+            self.indexes[fields].setdefault(key, set()).add(doc_id)
+        self.document_keys[doc_id] = keys
+
+
+    def unindex_documents(self, doc_ids):
+        #Удаление doc_id из всех индексов (документы могли быть уже изменены или удалены)
+        for doc_id in doc_ids:
+            for fields, key in self.document_keys.pop(doc_id, {}).items():
+                ids = self.indexes[fields].get(key)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del self.indexes[fields][key]
+
+
+    def insert(self, document):
+        with self.index_lock, metrics.timer('tar_storage_seconds', backend = 'tinydb', table = self.name, operation = 'write'):
+            self.ensure_indexes()
+            doc_id = super().insert(document)
+            self.index_document(doc_id, document)
+            return doc_id
+
+
+    def insert_multiple(self, documents):
+        with self.index_lock, metrics.timer('tar_storage_seconds', backend = 'tinydb', table = self.name, operation = 'write'):
+            self.ensure_indexes()
+            documents = list(documents)
+            doc_ids = super().insert_multiple(documents)
+            for doc_id, document in zip(doc_ids, documents):
+                self.index_document(doc_id, document)
+            return doc_ids
+
+
+    def update(self, fields, cond = None, doc_ids = None):
+        with self.index_lock, metrics.timer('tar_storage_seconds', backend = 'tinydb', table = self.name, operation = 'write'):
+            self.ensure_indexes()
+            updated_ids = super().update(fields, cond, doc_ids)
+            self.reindex_documents(updated_ids)
+            return updated_ids
+
+
+    def remove(self, cond = None, doc_ids = None):
+        with self.index_lock, metrics.timer('tar_storage_seconds', backend = 'tinydb', table = self.name, operation = 'write'):
+            self.ensure_indexes()
+            removed_ids = super().remove(cond, doc_ids)
+            self.unindex_documents(removed_ids)
+            return removed_ids
+
+
+    def truncate(self):
+        with self.index_lock, metrics.timer('tar_storage_seconds', backend = 'tinydb', table = self.name, operation = 'write'):
+            super().truncate()
+            self.indexes = {fields: {} for fields in self.index_fields}
+            self.document_keys = {}
+
+
+    def reindex_documents(self, doc_ids):
+        if not doc_ids:
+            return
+        table = self._read_table()
+        self.unindex_documents(doc_ids)
+        for doc_id in doc_ids:
+            if str(doc_id) in table:
+                self.index_document(doc_id, table[str(doc_id)])
+
+
+    def find_ids(self, fields):
+        #doc_id документов, у которых значения полей равны fields (в порядке вставки)
+        with self.index_lock, metrics.timer('tar_storage_seconds', backend = 'tinydb', table = self.name, operation = 'read'):
+            self.ensure_indexes()
+
+            #самый подробный индекс, все поля которого заданы в запросе
+            best_fields = None
+            for index_fields in self.index_fields:
+                if set(index_fields) <= fields.keys() and (best_fields is None or len(index_fields) > len(best_fields)):
+                    best_fields = index_fields
+
+            table = self._read_table()
+
+            if best_fields is None:
+                candidate_ids = [int(doc_id) for doc_id in table]
+            else:
+                candidate_ids = sorted(self.indexes[best_fields].get(tuple(fields[field] for field in best_fields), ()))
+
+            return [doc_id for doc_id in candidate_ids
+                    if str(doc_id) in table and all(table[str(doc_id)].get(field) == value for field, value in fields.items())]
+
+
+    def find(self, **fields):
+        #Документы с заданными значениями полей: table.find(board_id = '...', list_name = 'В Работе')
+        with self.index_lock:
+            table = self._read_table()
+            return [Document(table[str(doc_id)], doc_id) for doc_id in self.find_ids(fields)]
+
+
+    def find_one(self, **fields):
+        documents = self.find(**fields)
+        return documents[0] if documents else None
+
+
+    def remove_where(self, **fields):
+        with self.index_lock:
+            doc_ids = self.find_ids(fields)
+            return self.remove(doc_ids = doc_ids) if doc_ids else []
+
+
+    def update_where(self, values, **fields):
+        with self.index_lock:
+            doc_ids = self.find_ids(fields)
+            return self.update(values, doc_ids = doc_ids) if doc_ids else []
+
+
+class TarDatabase(TinyDB):
+
+    #TinyDB, у которой все таблицы - IndexedTable: db.table('cards', indexes = ['card_id', ...])
+    table_class = IndexedTable
+
+
+    def flush(self):
+        self.storage.flush()
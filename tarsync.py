@@ -0,0 +1,90 @@
+from datetime import datetime
+from collections import deque
+import threading
+import random
+import time
+
+
+class SyncScheduler:
+
+    #Планировщик синхронизации локальной БД в отдельном управляемом потоке.
+    #cycle() выполняет один цикл и возвращает словарь статистики, period() - пауза между циклами в секундах.
+    #При ошибках пауза растет экспоненциально (backoff_base * 2^n, не более backoff_max) со случайным разбросом
+    def __init__(self, cycle, period, backoff_base = 5, backoff_max = 600, history_size = 50):
+        self.cycle = cycle
+        self.period = period
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.history = deque(maxlen = history_size)     #статистика последних циклов
+        self.failures = 0                               #число ошибок подряд
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.lock = threading.Lock()
+
+
+    def start(self):
+        #Запуск потока синхронизации (повторный вызов при работающем потоке ничего не делает)
+        with self.lock:
+            if self.is_running():
+                return
+            self.stop_event.clear()
+            self.wake_event.clear()
+            self.thread = threading.Thread(target = self.run, name = 'tar-sync', daemon = True)
+            self.thread.start()
+
+
+    def stop(self, timeout = None):
+        #Остановка потока: текущий цикл доводится до конца, ожидание между циклами прерывается
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+    def trigger_now(self):
+        #Запуск следующего цикла без ожидания периода
+        self.wake_event.set()
+
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def next_delay(self):
+        if self.failures == 0:
+            return self.period()
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self.failures - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+
+    def run_cycle(self):
+        #Один цикл с замером длительности; ошибка цикла не останавливает поток
+        started = time.monotonic()
+        stats = {'started': datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'error': None}
+
+        try:
+            stats.update(self.cycle() or {})
+        except Exception as err:
+            self.failures += 1
+            stats['error'] = str(err)
+            print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: [ERROR] Sync cycle failed ({self.failures} in a row): {err}')
+        else:
+            self.failures = 0
+
+        stats['duration'] = round(time.monotonic() - started, 3)
+        self.history.append(stats)
+        return stats
+
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.run_cycle()
+
+            self.wake_event.wait(timeout = self.next_delay())
+            self.wake_event.clear()
+
+
+    def get_stats(self):
+        return list(self.history)
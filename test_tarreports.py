@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+import random
+import threading
+import time
+import pytest
+
+
+#Сводный отчет по нескольким доскам при параллельных запросах к Trello: порядок строк не зависит от того,
+#в каком порядке пришли ответы, а ошибка одной доски не прерывает отчет по остальным
+
+
+pytest.importorskip('trello')
+
+#период заканчивается до начала сегодняшнего дня, чтобы время карточек в текущем списке не зависело от момента построения
+TODAY = datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+FILTER_DATES = [(TODAY - timedelta(days = 365)).strftime("%Y-%m-%d %H:%M:%S"), (TODAY - timedelta(seconds = 1)).strftime("%Y-%m-%d %H:%M:%S")]
+
+
+@pytest.fixture
+def team_driver(tmp_path, monkeypatch):
+    from tarbench import FakeTrelloClient
+    from tardriver import TarDriver
+
+    #TarDriver ищет tar_database.json для переноса в текущем каталоге
+    monkeypatch.chdir(tmp_path)
+    client = FakeTrelloClient(boards = 3, lists = 5, cards = 40, members = 6, movements = 6, seed = 7)
+    driver = TarDriver(trello_client = client, database_path = str(tmp_path / 'tar_database.json'))
+    driver.fill_database()
+    driver.filter_dates = FILTER_DATES
+    board_ids = [board['board_id'] for board in driver.local_boards.all() if board['board_name'] != 'КАДРЫ']
+    yield driver, client, board_ids
+    driver.close_database()
+
+
+def break_board(driver, client, failing_board_id):
+    #Промежутки всех карточек запрашиваются из Trello (история перемещений досок считается незагруженной),
+    #ответы приходят со случайной задержкой, карточки failing_board_id отвечают ошибкой
+    for board in driver.local_boards.all():
+        driver.local_boards.update_where({'board_movements_loaded': False}, board_id = board['board_id'])
+
+    get_card = client.get_card
+    delays = random.Random(failing_board_id)
+    delays_lock = threading.Lock()
+
+    def flaky_get_card(card_id):
+        with delays_lock:
+            delay = delays.uniform(0, 0.005)
+        time.sleep(delay)
+        if card_id in client.cards[failing_board_id]:
+            raise RuntimeError(f'board {failing_board_id} is unavailable')
+        return get_card(card_id)
+
+    client.get_card = flaky_get_card
+
+
+def line_keys(lines):
+    return [(line['board_id'], line['list_name'], line['person_id'], line['card_id'], line['list_id']) for line in lines]
+
+
+def assert_same_lines(lines, expected):
+    assert line_keys(lines) == line_keys(expected)
+    assert lines == expected
+
+
+def test_team_report_isolates_failing_board(team_driver):
+    driver, client, board_ids = team_driver
+    healthy_board_ids = [board_ids[0], board_ids[2]]
+    list_names = driver.get_list_names(board_ids)
+    members = list(driver.team)
+
+    driver.report_workers = 1
+    expected, complete = driver.build_team_report(healthy_board_ids, list_names, members)
+    assert complete and expected
+
+    break_board(driver, client, board_ids[1])
+    driver.report_workers = 8
+    progress = []
+    lines, complete = driver.build_team_report(board_ids, list_names, members, progress = lambda done, total: progress.append((done, total)))
+
+    assert not complete
+    assert board_ids[1] not in {line['board_id'] for line in lines}
+    assert_same_lines(lines, expected)
+    #ошибочные карточки тоже считаются обработанными
+    assert max(progress) == (progress[0][1], progress[0][1])
+
+
+def test_report_jobs_with_failing_board(team_driver):
+    driver, client, board_ids = team_driver
+    list_names = driver.get_list_names(board_ids)
+    members = list(driver.team)
+    project_lists = list(driver.board_cache.get_lists(board_ids[0]))
+
+    driver.report_workers = 1
+    expected_team, _ = driver.build_team_report([board_ids[0], board_ids[2]], list_names, members)
+    expected_project, _ = driver.build_project_report(board_ids[0], project_lists, members)
+
+    break_board(driver, client, board_ids[1])
+    driver.report_workers = 8
+    job_ids = [driver.submit_team_report(board_ids, list_names, members, FILTER_DATES),
+               driver.submit_report(board_ids[0], project_lists, members, FILTER_DATES),
+               driver.submit_report(board_ids[1], list(driver.board_cache.get_lists(board_ids[1])), members, FILTER_DATES)]
+
+    deadline = time.monotonic() + 60
+    while not all(driver.get_report_job(job_id).is_finished() for job_id in job_ids) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    team_job, project_job, failing_job = (driver.get_report_job(job_id) for job_id in job_ids)
+    assert [job.status for job in (team_job, project_job, failing_job)] == ['done', 'done', 'done']
+    assert_same_lines(team_job.result, expected_team)
+    assert_same_lines(project_job.result, expected_project)
+    assert failing_job.result == []
+    assert team_job.done == team_job.total
+
+    #неполные отчеты не кэшируются, полный отчет по исправной доске - кэшируется
+    assert driver.report_cache.get(driver.get_team_report_key(board_ids, list_names, members, FILTER_DATES)) is None
+    assert driver.report_cache.get(driver.get_report_key(board_ids[1], list(driver.board_cache.get_lists(board_ids[1])), members, FILTER_DATES)) is None
+    assert driver.report_cache.get(driver.get_report_key(board_ids[0], project_lists, members, FILTER_DATES)) is not None
@@ -0,0 +1,174 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import threading
+import time
+import pytest
+import requests
+from tarrequests import TokenBucket, TrelloRequestScheduler, TrelloSession
+
+
+#Проверки планировщика запросов к Trello на локальном HTTP-сервере: пауза Retry-After ответа 429,
+#повторы только тех изменяющих запросов, которые Trello точно не выполнил, объединение одинаковых GET
+
+
+class TrelloStandIn(BaseHTTPRequestHandler):
+
+    #Ответы по пути запроса: /limited - два ответа 429 с Retry-After, /broken - всегда 500, /slow - ответ через 0.3 с
+    protocol_version = 'HTTP/1.1'
+    hits = {}
+    lock = threading.Lock()
+
+    def handle_request(self):
+        path = urlparse(self.path).path
+        with self.lock:
+            key = (self.command, path)
+            self.hits[key] = self.hits.get(key, 0) + 1
+            hit = self.hits[key]
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        if path == '/1/limited' and hit <= 2:
+            self.reply(429, b'rate limit', {'Retry-After': '0.3'})
+        elif path == '/1/broken':
+            self.reply(500, b'')
+        else:
+            if path == '/1/slow':
+                time.sleep(0.3)
+            self.reply(200, b'{"id": "%d"}' % hit)
+
+    def reply(self, status, body, headers = None):
+        try:
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass        #клиент уже закрыл соединение по тайм-ауту
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api_root():
+    TrelloStandIn.hits = {}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TrelloStandIn)
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/1'
+    server.shutdown()
+    server.server_close()
+
+
+def make_scheduler(api_root, **kwargs):
+    params = {'http_service': TrelloSession(pool_size = 8, timeout = (1, 0.2)), 'rate': None, 'max_retries': 3,
+              'backoff_base': 0.01, 'backoff_max': 1.0, 'api_root': api_root}
+    params.update(kwargs)
+    return TrelloRequestScheduler(**params)
+
+
+def test_rate_limited_request_waits_retry_after(api_root):
+    scheduler = make_scheduler(api_root)
+    started = time.monotonic()
+    response = scheduler.request('GET', 'https://api.trello.com/1/limited')
+
+    assert response.status_code == 200
+    assert TrelloStandIn.hits[('GET', '/1/limited')] == 3
+    assert time.monotonic() - started >= 0.55
+    stats = scheduler.get_stats()
+    assert stats['rate_limited'] == 2
+    assert stats['retries'] == 2
+
+
+def test_write_is_retried_after_rate_limit(api_root):
+    #ответ 429 - запрос не выполнен, повтор POST безопасен
+    response = make_scheduler(api_root).request('POST', api_root + '/limited', data = {'name': 'Новый проект'})
+    assert response.status_code == 200
+    assert TrelloStandIn.hits[('POST', '/1/limited')] == 3
+
+
+@pytest.mark.parametrize('method', ['POST', 'PUT', 'DELETE'])
+def test_write_is_not_retried_on_server_error(api_root, method):
+    scheduler = make_scheduler(api_root)
+    response = scheduler.request(method, api_root + '/broken')
+
+    assert response.status_code == 500
+    assert TrelloStandIn.hits[(method, '/1/broken')] == 1
+    assert scheduler.get_stats()['failed'] == 1
+
+
+def test_read_is_retried_on_server_error(api_root):
+    response = make_scheduler(api_root).request('GET', api_root + '/broken')
+    assert response.status_code == 500
+    assert TrelloStandIn.hits[('GET', '/1/broken')] == 4
+
+
+def test_write_is_not_retried_after_read_timeout(api_root):
+    #сервер мог выполнить запрос до тайм-аута чтения - повтор создал бы дубликат
+    with pytest.raises(requests.ReadTimeout):
+        make_scheduler(api_root).request('POST', api_root + '/slow')
+    assert TrelloStandIn.hits[('POST', '/1/slow')] == 1
+
+
+def test_write_is_retried_when_connection_is_refused():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TrelloStandIn)
+    closed_root = f'http://127.0.0.1:{server.server_address[1]}/1'
+    server.server_close()
+
+    scheduler = make_scheduler(closed_root, max_retries = 2)
+    with pytest.raises(requests.ConnectionError):
+        scheduler.request('POST', closed_root + '/boards')
+    assert scheduler.get_stats()['sent'] == 3
+
+
+def test_concurrent_identical_gets_are_coalesced(api_root):
+    scheduler = make_scheduler(api_root, http_service = TrelloSession(pool_size = 8, timeout = (1, 5)))
+    barrier = threading.Barrier(8)
+
+    def fetch(_):
+        barrier.wait()
+        return scheduler.request('GET', api_root + '/slow', params = {'fields': 'name'}).json()
+
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        results = list(executor.map(fetch, range(8)))
+
+    assert TrelloStandIn.hits[('GET', '/1/slow')] == 1
+    assert results == [{'id': '1'}] * 8
+    assert scheduler.get_stats()['coalesced'] == 7
+
+
+def test_different_params_are_not_coalesced(api_root):
+    scheduler = make_scheduler(api_root, http_service = TrelloSession(pool_size = 8, timeout = (1, 5)))
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        list(executor.map(lambda fields: scheduler.request('GET', api_root + '/slow', params = {'fields': fields}), ['name', 'desc']))
+    assert TrelloStandIn.hits[('GET', '/1/slow')] == 2
+
+
+def test_default_rate_stays_below_trello_limit():
+    #за любые 10 секунд корзина пропускает не больше burst + rate * 10 запросов; лимит Trello - 100
+    bucket = TrelloRequestScheduler().bucket
+    assert bucket.capacity + bucket.rate * 10 <= 90
+
+
+def test_token_bucket_waits_after_burst():
+    bucket = TokenBucket(rate = 50, capacity = 5)
+    assert sum(bucket.acquire() for _ in range(5)) == 0
+
+    started = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.18
+
+
+def test_idle_connections_count_open_connections_only(api_root):
+    #пул urllib3 заполнен заглушками None, свободными должны считаться только открытые соединения
+    session = TrelloSession(pool_size = 8, timeout = (1, 5))
+    session.get(api_root + '/cards').close()
+    stats = session.get_stats()
+    assert stats['connections'] == 1
+    assert stats['idle_connections'] == 1
@@ -0,0 +1,90 @@
+import sqlite3
+import pytest
+from tarsqlite import SCHEMA, SCHEMA_VERSION, SQLiteDatabase
+
+
+#Схема SQLite: типы столбцов, внешние ключи и перестройка файлов БД прежней версии схемы
+
+
+def column_types(path, name):
+    connection = sqlite3.connect(path)
+    try:
+        return {row[1]: row[2] for row in connection.execute(f'PRAGMA table_info({name})')}
+    finally:
+        connection.close()
+
+
+def fill_board(database):
+    database.table('boards').insert({'board_id': 'b1', 'board_name': 'Проект', 'board_movements_loaded': True})
+    database.table('lists').insert_multiple([{'list_id': 'l1', 'list_name': 'В Работе', 'board_id': 'b1'},
+                                             {'list_id': 'l2', 'list_name': 'Готово', 'board_id': 'b1'}])
+    database.table('cards').insert_multiple([{'card_id': 'c1', 'card_name': 'Первая', 'list_id': 'l1', 'board_id': 'b1'},
+                                             {'card_id': 'c2', 'card_name': 'Вторая', 'list_id': 'l2', 'board_id': 'b1'}])
+    database.table('cards_has_persons').insert_multiple([{'card_id': 'c1', 'person_id': 'p1', 'board_id': 'b1'},
+                                                         {'card_id': 'c2', 'person_id': 'p1', 'board_id': 'b1'}])
+
+
+def test_columns_have_declared_types(tmp_path):
+    path = str(tmp_path / 'tar_database.sqlite3')
+    database = SQLiteDatabase(path)
+    for name, (columns, _) in SCHEMA.items():
+        assert column_types(path, name) == dict({'doc_id': 'INTEGER', 'extra': 'TEXT'}, **columns)
+    database.close()
+
+
+def test_documents_keep_python_types(tmp_path):
+    database = SQLiteDatabase(str(tmp_path / 'tar_database.sqlite3'))
+    fill_board(database)
+    database.table('worktime').insert({'work_days': '5', 'first_weekday': '0', 'holidays': ['2024-01-01']})
+    database.table('report').insert({'card_id': 'c1', 'list_seconds': 3600, 'list_time': '1:00:00'})
+
+    assert database.table('boards').find_one(board_id = 'b1')['board_movements_loaded'] == 1
+    assert database.table('worktime').all()[0] == {'work_days': '5', 'first_weekday': '0', 'holidays': ['2024-01-01']}
+    assert database.table('report').all()[0]['list_seconds'] == 3600
+    database.close()
+
+
+def test_card_requires_existing_list(tmp_path):
+    database = SQLiteDatabase(str(tmp_path / 'tar_database.sqlite3'))
+    fill_board(database)
+    with pytest.raises(sqlite3.IntegrityError):
+        database.table('cards').insert({'card_id': 'c3', 'list_id': 'missing', 'board_id': 'b1'})
+
+    #удаление доски удаляет ее списки, карточки и связи карточек с участниками
+    database.table('boards').remove_where(board_id = 'b1')
+    assert [len(database.table(name)) for name in ('lists', 'cards', 'cards_has_persons')] == [0, 0, 0]
+    database.close()
+
+
+def test_old_schema_is_upgraded(tmp_path):
+    #файл БД без типов столбцов и без внешнего ключа cards.list_id, с карточкой несуществующего списка
+    path = str(tmp_path / 'tar_database.sqlite3')
+    connection = sqlite3.connect(path)
+    for name, (columns, constraints) in SCHEMA.items():
+        constraints = [constraint for constraint in constraints if 'REFERENCES lists' not in constraint]
+        connection.execute(f'CREATE TABLE {name} ({", ".join(["doc_id INTEGER PRIMARY KEY AUTOINCREMENT"] + list(columns) + ["extra TEXT"] + constraints)})')
+    connection.execute("INSERT INTO boards (doc_id, board_id, board_movements_loaded) VALUES (1, 'b1', 1)")
+    connection.execute("INSERT INTO lists (doc_id, list_id, board_id) VALUES (1, 'l1', 'b1')")
+    connection.execute("INSERT INTO cards (doc_id, card_id, list_id, board_id, extra) VALUES (5, 'c1', 'l1', 'b1', '{\"labels\": [\"a\"]}'), (6, 'c2', 'gone', 'b1', NULL)")
+    connection.execute("INSERT INTO cards_has_persons (doc_id, card_id, person_id) VALUES (1, 'c1', 'p1'), (2, 'c2', 'p1')")
+    connection.execute("INSERT INTO card_movements (doc_id, action_id, card_id) VALUES (1, 'a1', 'c2')")
+    connection.commit()
+    connection.close()
+
+    database = SQLiteDatabase(path)
+    assert column_types(path, 'cards')['list_id'] == 'TEXT'
+    cards = database.table('cards').all()
+    assert [(card.doc_id, card['card_id'], card['labels']) for card in cards] == [(5, 'c1', ['a'])]
+    assert [row['card_id'] for row in database.table('cards_has_persons').all()] == ['c1']
+    assert len(database.table('card_movements')) == 1
+    assert database.connection().execute('PRAGMA user_version').fetchone()[0] == SCHEMA_VERSION
+    assert database.connection().execute('PRAGMA foreign_keys').fetchone()[0] == 1
+
+    #новые doc_id продолжают прежнюю нумерацию
+    assert database.table('cards').insert({'card_id': 'c3', 'list_id': 'l1', 'board_id': 'b1'}) == 7
+    database.close()
+
+    #повторное открытие не перестраивает таблицы
+    database = SQLiteDatabase(path)
+    assert len(database.table('cards')) == 2
+    database.close()
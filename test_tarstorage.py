@@ -0,0 +1,43 @@
+import json
+import threading
+import time
+from tarstorage import AtomicJSONStorage, BufferedMiddleware, TarDatabase
+
+
+#Автоматическая запись BufferedMiddleware не должна держать блокировку таблиц на время сериализации и fsync
+
+
+class SlowJSONStorage(AtomicJSONStorage):
+
+    def write(self, data):
+        time.sleep(0.3)
+        super().write(data)
+
+
+def test_auto_flush_does_not_block_readers(tmp_path):
+    path = tmp_path / 'tar_database.json'
+    db = TarDatabase(str(path), storage = BufferedMiddleware(SlowJSONStorage, max_pending_writes = 50, max_delay = 100))
+    cards = db.table('cards', indexes = ['card_id'])
+
+    stop = threading.Event()
+    waits = []
+
+    def read_cards():
+        while not stop.is_set():
+            started = time.perf_counter()
+            cards.find(card_id = 'card-5')
+            waits.append(time.perf_counter() - started)
+            time.sleep(0.001)
+
+    reader = threading.Thread(target = read_cards)
+    reader.start()
+    for number in range(200):
+        cards.insert({'card_id': f'card-{number}'})
+        time.sleep(0.002)
+    stop.set()
+    reader.join()
+
+    assert db.storage.flushes >= 1
+    assert max(waits) < 0.15
+    db.close()
+    assert len(json.loads(path.read_text(encoding = 'utf-8'))['cards']) == 200
@@ -0,0 +1,226 @@
+from datetime import datetime, date, timedelta, timezone
+import random
+import numpy as np
+import pytest
+from workcalendar import WorkCalendar
+
+
+#Сверка расчета рабочего времени WorkCalendar (work_seconds в закрытой форме и work_seconds_batch по префиксным суммам)
+#с прямым проходом по дням, скопированным из прежнего TarDriver.filter_work_hours
+
+
+SCHEDULE = (9 * 3600, 18 * 3600, 13 * 3600, 14 * 3600)                 #09:00-18:00, обед 13:00-14:00
+SHORT_SCHEDULE = (10 * 3600, 15 * 3600, 12 * 3600, 12 * 3600 + 1800)    #10:00-15:00, обед 12:00-12:30
+HOLIDAYS = [date(2024, 1, 1), date(2024, 1, 2), date(2024, 3, 8), date(2024, 5, 1), date(2024, 5, 9)]
+WORKDAY_EXCEPTIONS = [date(2024, 4, 27), date(2024, 11, 2)]            #рабочие субботы
+
+CALENDARS = {
+    'default': {},
+    'holidays': {'holidays': HOLIDAYS, 'workday_exceptions': {day: SCHEDULE for day in WORKDAY_EXCEPTIONS}},
+    'six_days_from_sunday': {'work_days': 6, 'first_weekday': 6, 'weekday_schedules': {4: SHORT_SCHEDULE}, 'holidays': HOLIDAYS},
+}
+
+
+def reference_schedule(day, work_days = 5, first_weekday = 0, weekday_schedules = None, holidays = None, workday_exceptions = None):
+    if day in (workday_exceptions or {}):
+        return workday_exceptions[day]
+    if day in (holidays or []):
+        return None
+    if weekday_schedules and day.weekday() in weekday_schedules:
+        return weekday_schedules[day.weekday()]
+    return SCHEDULE if (day.weekday() - first_weekday) % 7 < work_days else None
+
+
+def to_time(seconds):
+    return (datetime.min + timedelta(seconds = seconds)).time()
+
+
+def reference_work_seconds(start_date, end_date, **calendar):
+    #Ветвление по дням из прежнего TarDriver.filter_work_hours без изменений; вместо проверки weekday() < 5
+    #и общего расписания из worktime - расписание дня из reference_schedule()
+    result_time = timedelta(hours=0, minutes=0, seconds=0)
+    calculated_end_time = timedelta(hours=0, minutes=0, seconds=0)
+    twenty_four_hours_delta = timedelta(hours=23, minutes=59, seconds=59)
+
+    while start_date <= end_date: 
+        till_the_end_of_he_day_delta = twenty_four_hours_delta - timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)
+        calculated_end_time =  (start_date + till_the_end_of_he_day_delta)
+
+        if calculated_end_time >= end_date:
+            if calculated_end_time.time() > end_date.time():
+                calculated_end_time = end_date
+
+        schedule = reference_schedule(start_date.date(), **calendar)
+        if schedule is not None: #этот день не выходной
+            work_day_starts, work_day_ends, lunch_starts, lunch_ends = (to_time(seconds) for seconds in schedule)
+            day_work_hours = to_time(schedule[2] - schedule[0] + schedule[1] - schedule[3])
+
+            if (calculated_end_time.time() < work_day_starts):#промежуток кончился раньше рабочего дня
+                pass
+
+            elif (calculated_end_time.time() > work_day_starts) and (calculated_end_time.time() <= lunch_starts):#промежуток кончился после начала рабочего дня но раньше обеда:
+                
+                if start_date.time() <= work_day_starts:
+                    result_time += timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
+                                                timedelta(hours=work_day_starts.hour, minutes=work_day_starts.minute, seconds=work_day_starts.second)
+
+                else:
+                    result_time += timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
+                                                timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)
+
+            elif (calculated_end_time.time() > lunch_starts) and (calculated_end_time.time() < lunch_ends):#промежуток кончился после начала обеда но раньше конца обеда:
+                if start_date.time() <= work_day_starts:
+                    result_time += timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
+                                                timedelta(hours=work_day_starts.hour, minutes=work_day_starts.minute, seconds=work_day_starts.second)
+
+                elif (start_date.time() > work_day_starts) and (start_date.time() < lunch_starts):
+                    result_time += timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
+                                                timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)
+
+                elif (start_date.time() >= lunch_starts):
+                    pass
+
+            elif (calculated_end_time.time() >= lunch_ends) and (calculated_end_time.time() < work_day_ends):#промежуток кончился после конца обеда но раньше конца дня
+                if start_date.time() <= work_day_starts:
+                    result_time += (timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
+                                                timedelta(hours=work_day_starts.hour, minutes=work_day_starts.minute, seconds=work_day_starts.second)) + \
+                                                (timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
+                                                timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second))
+
+                elif (start_date.time() > work_day_starts) and (start_date.time() < lunch_starts):
+                    result_time += (timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
+                                                timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)) + \
+                                                (timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
+                                                timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second))     
+
+                elif (start_date.time() >= lunch_starts) and (start_date.time() < lunch_ends):
+                    result_time += (timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
+                                    timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second)) 
+
+                elif (start_date.time() >= lunch_ends):
+                    result_time += (timedelta(hours=calculated_end_time.hour, minutes=calculated_end_time.minute, seconds=calculated_end_time.second) - \
+                                    timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)) 
+
+            elif (calculated_end_time.time() >= work_day_ends):#промежуток кончился позже рабочего дня
+                if start_date.time() <= work_day_starts:
+                    result_time += timedelta(hours=day_work_hours.hour, minutes=day_work_hours.minute, seconds=day_work_hours.second)
+                
+                elif (start_date.time() > work_day_starts) and (start_date.time() < lunch_starts):
+                    result_time += (timedelta(hours=lunch_starts.hour, minutes=lunch_starts.minute, seconds=lunch_starts.second) - \
+                                                timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second)) + \
+                                                (timedelta(hours=work_day_ends.hour, minutes=work_day_ends.minute, seconds=work_day_ends.second) - \
+                                                timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second))  
+                
+                elif (start_date.time() >= lunch_starts) and (start_date.time() < lunch_ends):
+                    result_time += (timedelta(hours=work_day_ends.hour, minutes=work_day_ends.minute, seconds=work_day_ends.second) - \
+                                    timedelta(hours=lunch_ends.hour, minutes=lunch_ends.minute, seconds=lunch_ends.second))
+
+                elif (start_date.time() >= lunch_ends) and (start_date.time() <= work_day_ends):
+                    result_time += (timedelta(hours=work_day_ends.hour, minutes=work_day_ends.minute, seconds=work_day_ends.second) - \
+                                    timedelta(hours=start_date.hour, minutes=start_date.minute, seconds=start_date.second))
+
+                elif (start_date.time() > work_day_ends):
+                    pass
+
+        start_date += (till_the_end_of_he_day_delta + timedelta(minutes=1))
+
+    return int(result_time.total_seconds())
+
+
+def make_calendar(work_days = 5, first_weekday = 0, weekday_schedules = None, holidays = None, workday_exceptions = None):
+    return WorkCalendar(schedule = SCHEDULE, work_days = work_days, first_weekday = first_weekday, weekday_schedules = weekday_schedules,
+                        holidays = holidays, workday_exceptions = workday_exceptions)
+
+
+def check_intervals(calendar_args, intervals):
+    calendar = make_calendar(**calendar_args)
+    expected = [reference_work_seconds(start_date, end_date, **calendar_args) if start_date <= end_date else 0 for start_date, end_date in intervals]
+
+    assert [calendar.work_seconds(start_date, end_date) for start_date, end_date in intervals] == expected
+
+    starts = np.array([start_date for start_date, _ in intervals], dtype = 'datetime64[s]')
+    ends = np.array([end_date for _, end_date in intervals], dtype = 'datetime64[s]')
+    #пакетный расчет не считает пустые промежутки (start >= end)
+    expected_batch = [seconds if start_date < end_date else 0 for seconds, (start_date, end_date) in zip(expected, intervals)]
+    assert calendar.work_seconds_batch(starts, ends).tolist() == expected_batch
+
+
+EDGE_CASES = [
+    #один день
+    (datetime(2024, 6, 3, 10, 0), datetime(2024, 6, 3, 12, 30)),
+    (datetime(2024, 6, 3, 7, 0), datetime(2024, 6, 3, 8, 59, 59)),
+    (datetime(2024, 6, 3, 18, 0, 1), datetime(2024, 6, 3, 23, 0)),
+    (datetime(2024, 6, 3, 9, 0), datetime(2024, 6, 3, 9, 0)),
+    #через обед и внутри обеда
+    (datetime(2024, 6, 3, 12, 0), datetime(2024, 6, 3, 15, 0)),
+    (datetime(2024, 6, 3, 13, 10), datetime(2024, 6, 3, 13, 50)),
+    (datetime(2024, 6, 3, 13, 30), datetime(2024, 6, 3, 14, 30)),
+    (datetime(2024, 6, 3, 0, 0), datetime(2024, 6, 3, 23, 59, 59)),
+    #выходные
+    (datetime(2024, 6, 8, 10, 0), datetime(2024, 6, 9, 17, 0)),
+    (datetime(2024, 6, 7, 17, 0), datetime(2024, 6, 10, 10, 0)),
+    (datetime(2024, 6, 5, 12, 0), datetime(2024, 6, 19, 16, 45, 30)),
+    #праздники и рабочие исключения
+    (datetime(2023, 12, 29, 15, 0), datetime(2024, 1, 3, 11, 0)),
+    (datetime(2024, 3, 8, 9, 0), datetime(2024, 3, 8, 18, 0)),
+    (datetime(2024, 4, 26, 16, 0), datetime(2024, 4, 29, 10, 0)),
+    (datetime(2024, 4, 27, 12, 59, 59), datetime(2024, 4, 27, 14, 0, 1)),
+    (datetime(2024, 4, 30, 10, 0), datetime(2024, 5, 13, 10, 0)),
+    #длинные промежутки и конец раньше начала
+    (datetime(2021, 2, 15, 11, 11, 11), datetime(2024, 11, 5, 8, 8, 8)),
+    (datetime(2024, 6, 3, 12, 0), datetime(2024, 6, 3, 11, 0)),
+    (datetime(2024, 6, 10, 12, 0), datetime(2024, 6, 3, 11, 0)),
+]
+
+
+@pytest.mark.parametrize('calendar_name', sorted(CALENDARS))
+def test_edge_cases(calendar_name):
+    check_intervals(CALENDARS[calendar_name], EDGE_CASES)
+
+
+@pytest.mark.parametrize('calendar_name', sorted(CALENDARS))
+def test_random_intervals(calendar_name):
+    generator = random.Random(calendar_name)
+    base_date = datetime(2022, 1, 1)
+    intervals = []
+    for _ in range(2000):
+        start_date = base_date + timedelta(seconds = generator.randint(0, 3 * 365 * 86400))
+        intervals.append((start_date, start_date + timedelta(seconds = generator.choice([generator.randint(0, 86400), generator.randint(0, 120 * 86400)]))))
+    check_intervals(CALENDARS[calendar_name], intervals)
+
+
+def test_intervals_across_dst():
+    #Промежутки через переходы на летнее и зимнее время: расчет идет по настенному времени часового пояса
+    pytz = pytest.importorskip('pytz')
+    berlin = pytz.timezone('Europe/Berlin')
+    intervals = []
+    for transition in (datetime(2024, 3, 31, 1, 0, tzinfo = timezone.utc), datetime(2024, 10, 27, 1, 0, tzinfo = timezone.utc)):
+        for hours_before, hours_after in ((30, 2), (2, 30), (80, 80), (1, 1)):
+            intervals.append(((transition - timedelta(hours = hours_before)).astimezone(berlin).replace(tzinfo = None),
+                              (transition + timedelta(hours = hours_after)).astimezone(berlin).replace(tzinfo = None)))
+    for calendar_args in CALENDARS.values():
+        check_intervals(calendar_args, intervals)
+
+
+def test_tardriver_batch_matches_scalar_across_dst(tmp_path):
+    #TarDriver.filter_work_hours_batch (перевод в местное время по таблице переходов часового пояса)
+    #и filter_work_hours по датам, переведенным через pytz, дают одинаковый результат
+    pytest.importorskip('trello')
+    from tarbench import FakeTrelloClient
+    from tardriver import TarDriver
+
+    for zone in ('Europe/Berlin', 'America/New_York', 'Asia/Tomsk'):
+        driver = TarDriver(trello_client = FakeTrelloClient(boards = 0, cards = 0, members = 1), database_path = str(tmp_path / f'{zone.replace("/", "_")}.json'),
+                           local_timezone = zone)
+        generator = random.Random(zone)
+        intervals = []
+        for year in (2010, 2015, 2024):
+            for month, day in ((3, 31), (10, 27), (11, 3), (3, 10)):
+                transition = datetime(year, month, day, 12, 0, tzinfo = timezone.utc)
+                for _ in range(25):
+                    start_date = transition - timedelta(seconds = generator.randint(0, 5 * 86400), microseconds = generator.randint(0, 999999))
+                    intervals.append((start_date, start_date + timedelta(seconds = generator.randint(0, 10 * 86400))))
+
+        expected = [driver.filter_work_hours(driver.unify_time(start_date), driver.unify_time(end_date)).total_seconds() for start_date, end_date in intervals]
+        assert driver.filter_work_hours_batch(intervals, disable_filter = True).tolist() == expected
+        driver.close_database()
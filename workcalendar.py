@@ -0,0 +1,186 @@
+from datetime import datetime, timedelta
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+
+LAST_SECOND_OF_DAY = 23 * 3600 + 59 * 60 + 59
+
+
+class WorkCalendar:
+
+    #Рабочий календарь в памяти. Собирается один раз из записи таблицы worktime (from_worktime),
+    #после чего расчет рабочего времени не обращается ни к TinyDB, ни к strptime.
+    #График дня - кортеж секунд от начала дня: (начало дня, конец дня, начало обеда, конец обеда), None - выходной
+    def __init__(self,
+                        schedule,                           #график рабочего дня по умолчанию
+                        work_days = 5,                      #число рабочих дней в неделе
+                        first_weekday = 0,                  #первый день недели (0 - понедельник)
+                        weekday_schedules = None,           #{день недели: график} - отдельный график для дня недели
+                        holidays = None,                    #праздничные (нерабочие) даты
+                        workday_exceptions = None,          #{дата: график} - рабочие даты вне обычной недели
+                        update_period = 120,                #период обновления БД, секунды
+                        settings = None,                    #исходная запись worktime
+                        version = 0):
+
+        self.schedule = schedule
+        self.work_days = work_days
+        self.first_weekday = first_weekday
+        self.update_period = update_period
+        self.settings = dict(settings or {})
+        self.version = version
+
+        #график для каждого дня недели
+        self.weekday_schedule = []
+        for weekday in range(7):
+            if weekday_schedules and weekday in weekday_schedules:
+                self.weekday_schedule.append(weekday_schedules[weekday])
+            elif (weekday - first_weekday) % 7 < work_days:
+                self.weekday_schedule.append(schedule)
+            else:
+                self.weekday_schedule.append(None)
+
+        self.weekday_seconds = [self.partial_seconds(day_schedule, 0, LAST_SECOND_OF_DAY) for day_schedule in self.weekday_schedule]
+        self.week_seconds = sum(self.weekday_seconds)
+        self.base_day_seconds = self.partial_seconds(schedule, 0, LAST_SECOND_OF_DAY)
+
+        #особые даты (праздники и рабочие исключения) в отсортированном виде для поиска по диапазону
+        self.special_schedule = dict(workday_exceptions or {})
+        for day in (holidays or []):
+            self.special_schedule[day] = None
+        self.special_days = sorted(self.special_schedule)
+
+        self.weekday_schedule_array = np.array([self.schedule_to_array(day_schedule) for day_schedule in self.weekday_schedule], dtype=np.int64)
+
+
+    @classmethod
+    def from_worktime(cls, record, version = 0):
+        #Сборка календаря из записи таблицы worktime
+        time_format = "%H:%M:%S"
+        date_format = "%Y-%m-%d"
+
+        def seconds(value):
+            time_ = datetime.strptime(value, time_format).time()
+            return time_.hour * 3600 + time_.minute * 60 + time_.second
+
+        def parse_schedule(work_hours, lunch_hours):
+            return (seconds(work_hours[0]), seconds(work_hours[1]), seconds(lunch_hours[0]), seconds(lunch_hours[1]))
+
+        schedule = parse_schedule([record['work_day_starts'], record['work_day_ends']], [record['lunch_hours_starts'], record['lunch_hours_ends']])
+
+        weekday_schedules = {int(weekday): parse_schedule(hours[0:2], hours[2:4]) for weekday, hours in record.get('weekday_schedules', {}).items()}
+        holidays = [datetime.strptime(day, date_format).date() for day in record.get('holidays', [])]
+        workday_exceptions = {datetime.strptime(day, date_format).date(): schedule for day in record.get('workday_exceptions', [])}
+
+        return cls(schedule = schedule,
+                   work_days = int(record['work_days']),
+                   first_weekday = int(record.get('first_weekday', 0)),
+                   weekday_schedules = weekday_schedules,
+                   holidays = holidays,
+                   workday_exceptions = workday_exceptions,
+                   update_period = seconds(record.get('update_period', '00:02:00')),
+                   settings = record,
+                   version = version)
+
+
+    def schedule_to_array(self, schedule):
+        #Выходной день представляется нулевым графиком: любое пересечение с ним равно нулю
+        return schedule if schedule is not None else (0, 0, 0, 0)
+
+
+    def schedule_for(self, day):
+        #График конкретной даты с учетом праздников и исключений
+        if day in self.special_schedule:
+            return self.special_schedule[day]
+        return self.weekday_schedule[day.weekday()]
+
+
+    def partial_seconds(self, schedule, start_seconds, end_seconds):
+        #Рабочие секунды внутри одного дня в промежутке [start_seconds, end_seconds] (секунды от начала дня)
+        if schedule is None:
+            return 0
+
+        work_day_starts, work_day_ends, lunch_starts, lunch_ends = schedule
+        before_lunch = min(end_seconds, lunch_starts) - max(start_seconds, work_day_starts)
+        after_lunch = min(end_seconds, work_day_ends) - max(start_seconds, lunch_ends)
+        return max(before_lunch, 0) + max(after_lunch, 0)
+
+
+    def full_days_seconds(self, first_day, last_day):
+        #Рабочие секунды полных дней [first_day, last_day]: целые недели умножением,
+        #остаток недели (не более 6 дней) и особые даты внутри диапазона - отдельно
+        if first_day > last_day:
+            return 0
+
+        weeks, rest_days = divmod((last_day - first_day).days + 1, 7)
+        first_weekday = first_day.weekday()
+
+        result_seconds = weeks * self.week_seconds + sum(self.weekday_seconds[(first_weekday + day) % 7] for day in range(rest_days))
+
+        for day in self.special_days[bisect_left(self.special_days, first_day):bisect_right(self.special_days, last_day)]:
+            result_seconds += self.partial_seconds(self.special_schedule[day], 0, LAST_SECOND_OF_DAY) - self.weekday_seconds[day.weekday()]
+
+        return result_seconds
+
+
+    def work_seconds(self, start_date, end_date):
+        #Рабочие секунды в промежутке [start_date, end_date] (настенное время). Стоимость не зависит от длины промежутка
+        if start_date > end_date:
+            return 0
+
+        start_day = start_date.date()
+        end_day = end_date.date()
+        start_seconds = start_date.hour * 3600 + start_date.minute * 60 + start_date.second
+        end_seconds = end_date.hour * 3600 + end_date.minute * 60 + end_date.second
+
+        if start_day == end_day:
+            return self.partial_seconds(self.schedule_for(start_day), start_seconds, end_seconds)
+
+        return self.partial_seconds(self.schedule_for(start_day), start_seconds, LAST_SECOND_OF_DAY) \
+                + self.partial_seconds(self.schedule_for(end_day), 0, end_seconds) \
+                + self.full_days_seconds(start_day + timedelta(days=1), end_day - timedelta(days=1))
+
+
+    def work_seconds_batch(self, starts, ends):
+        #Рабочие секунды сразу для массивов начал и концов промежутков (numpy datetime64[s], настенное время).
+        #Считается одним векторным проходом по префиксным суммам рабочих секунд каждого дня окна
+        result_seconds = np.zeros(len(starts), dtype=np.int64)
+
+        valid = starts < ends
+        if not valid.any():
+            return result_seconds
+
+        start_days = starts.astype('datetime64[D]')
+        end_days = ends.astype('datetime64[D]')
+        start_seconds = (starts - start_days).astype(np.int64)
+        end_seconds = (ends - end_days).astype(np.int64)
+
+        #график и рабочие секунды каждого дня окна, префиксные суммы
+        first_day = start_days[valid].min()
+        last_day = end_days[valid].max()
+        window_days = np.arange(first_day, last_day + 1)
+        weekdays = (window_days.astype(np.int64) + 3) % 7 #1970-01-01 - четверг
+        day_schedules = self.weekday_schedule_array[weekdays]
+
+        for day in self.special_days[bisect_left(self.special_days, first_day.item()):bisect_right(self.special_days, last_day.item())]:
+            day_schedules[(np.datetime64(day, 'D') - first_day).astype(np.int64)] = self.schedule_to_array(self.special_schedule[day])
+
+        def partial_day_seconds(schedules, from_seconds, to_seconds):
+            before_lunch = np.minimum(to_seconds, schedules[:, 2]) - np.maximum(from_seconds, schedules[:, 0])
+            after_lunch = np.minimum(to_seconds, schedules[:, 1]) - np.maximum(from_seconds, schedules[:, 3])
+            return np.maximum(before_lunch, 0) + np.maximum(after_lunch, 0)
+
+        prefix_seconds = np.concatenate(([0], np.cumsum(partial_day_seconds(day_schedules, 0, LAST_SECOND_OF_DAY))))
+
+        first_index = np.where(valid, (start_days - first_day).astype(np.int64), 0)
+        last_index = np.where(valid, (end_days - first_day).astype(np.int64), 0)
+        first_schedules = day_schedules[first_index]
+        last_schedules = day_schedules[last_index]
+
+        same_day_seconds = partial_day_seconds(first_schedules, start_seconds, end_seconds)
+        several_days_seconds = partial_day_seconds(first_schedules, start_seconds, LAST_SECOND_OF_DAY) \
+                                + partial_day_seconds(last_schedules, 0, end_seconds) \
+                                + np.maximum(prefix_seconds[last_index] - prefix_seconds[np.minimum(first_index + 1, last_index)], 0)
+
+        result_seconds = np.where(first_index == last_index, same_day_seconds, several_days_seconds)
+
+        return np.where(valid, result_seconds, 0).astype(np.int64)